@@ -0,0 +1,465 @@
+"""
+Throughput and latency of every endpoint against a seeded database.
+
+Every scenario sends a fixed number of requests from a fixed number
+of threads, one User per thread, either through the Flask test client
+or over HTTP to a server started on a local port. The results can be
+saved as a JSON baseline, and a later run compared against it fails
+when a metric regressed by more than the threshold.
+
+Usage: python -m benchmarks.endpoints [--users 50] [--jokes-per-user 20]
+           [--requests 200] [--concurrency 4] [--server]
+           [--baseline benchmarks/baselines/endpoints.json]
+           [--save-baseline] [--threshold 0.25]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from werkzeug.utils import import_string
+
+from benchmarks.sqlite_profile import percentile
+from project.synthetic import USERNAME
+from project.synthetic import WORDS as SEARCH_WORDS
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baselines',
+                                'endpoints.json')
+PASSWORD = 'benchmark1'
+# Words the jokes made while benchmarking are made of, plenty
+# of them, so that the jokes are no near duplicates
+SYLLABLES = ('ba', 'ko', 'ri', 'zu', 'me', 'ta', 'no', 'vi', 'lo', 'shi',
+             'pe', 'gra', 'du', 'fen', 'mo', 'ki')
+WORDS = tuple(sorted({''.join(random.Random(index).sample(SYLLABLES, 3))
+                      for index in range(1000)}))
+# Settings that must match for a comparison to mean anything
+COMPARABLE = ('users', 'jokes_per_user', 'requests', 'concurrency',
+              'transport', 'config')
+# Lower is better for these, higher for the rest
+LATENCIES = ('p50', 'p95', 'p99')
+
+
+def make_joke(rng: random.Random, number: int) -> str:
+    """
+    A joke unlike any other, even to the near-duplicate check
+    :param rng: seeded random generator
+    :param number: unique number of the joke
+    :return: joke text
+    """
+    return 'Joke %d: %s' % (number, ' '.join(rng.sample(WORDS, 12)))
+
+
+class StubSource(ThreadingHTTPServer):
+    """Local FOREIGN_API source for /import-joke"""
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.served = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with server.lock:
+                    server.served += 1
+                    joke = make_joke(server.rng, -server.served)
+                payload = json.dumps(dict(joke=joke)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%d/api' % self.server_port
+
+
+def make_config(base: str, path: str, source_url: str):
+    """
+    App config for the benchmark database
+    :param base: import string of the config class to start from
+    :param path: SQLite database file
+    :param source_url: URL of the stub joke source
+    :return: config class
+    """
+    return type('BenchmarkConfig', (import_string(base),), dict(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + path,
+        JOKES_LIMIT=10 ** 9,
+        RATE_LIMIT_ENABLED=False,
+        QUERY_BUDGET_STRICT=False,
+        METRICS_DIR=None,
+        FOREIGN_API={'bench': {'url': source_url, 'buffer_size': 0}},
+    ))
+
+
+def seed(engine, args, rng: random.Random) -> dict:
+    """
+    Load Users, their Jokes and Actions with the synthetic
+    data generator, the same number of Jokes for every User
+    :param engine: engine of the migrated database
+    :param args: command line arguments
+    :param rng: seeded random generator
+    :return: dict of user_id to list of its joke_ids
+    """
+    from project import password_hasher
+    from project.synthetic import generate
+
+    generate(engine, args.users, args.users * args.jokes_per_user,
+             args.users * args.actions_per_user,
+             password=password_hasher.generate(PASSWORD),
+             joke_skew=0.0, days=1.0, minhash=True,
+             seed=rng.getrandbits(64))
+    jokes = {user_id: [] for user_id in range(1, args.users + 1)}
+    with engine.connect() as connection:
+        for joke_id, user_id in connection.execute(
+                'SELECT joke_id, user_id FROM joke ORDER BY joke_id'):
+            jokes[user_id].append(joke_id)
+    return jokes
+
+
+class InProcessTransport:
+    """Requests through the Flask test client"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def client(self):
+        client = self.app.test_client()
+
+        def send(method, path, headers=None, data=None, json=None):
+            return client.open(path, method=method, headers=headers,
+                               data=data, json=json).status_code
+        return send
+
+    def close(self):
+        pass
+
+
+class ServerTransport:
+    """Requests over HTTP to the app served on a local port"""
+
+    def __init__(self, app):
+        import requests
+        from werkzeug.serving import WSGIRequestHandler
+        from werkzeug.serving import make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.requests = requests
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def client(self):
+        session = self.requests.Session()
+
+        def send(method, path, headers=None, data=None, json=None):
+            return session.request(method, self.url + path, headers=headers,
+                                   data=data, json=json).status_code
+        return send
+
+    def close(self):
+        self.server.shutdown()
+
+
+class Worker:
+    """One thread's User, its token and Jokes"""
+
+    def __init__(self, user_id: int, token: str, jokes: list, seed: int):
+        self.user_id = user_id
+        self.username = USERNAME % user_id
+        self.headers = dict(Authorization='Bearer ' + token)
+        self.jokes = list(jokes)
+        self.rng = random.Random(seed)
+        self.made = 0
+        self.spare_tokens = []
+
+    def new_joke(self) -> str:
+        self.made += 1
+        return make_joke(self.rng, 10 ** 9 * self.user_id + self.made)
+
+    def new_username(self) -> str:
+        self.made += 1
+        return 'new%dx%d' % (self.user_id, self.made)
+
+
+def scenarios() -> list:
+    """
+    One request maker per endpoint, in the order they run.
+    A maker takes the Worker and the request number
+    :return: list of (name, method, path, maker)
+    """
+    def authorized(**kwargs):
+        return lambda worker, number: dict(headers=worker.headers, **kwargs)
+
+    return [
+        ('index', 'GET', '/', lambda worker, number: {}),
+        ('register', 'POST', '/register', lambda worker, number: dict(
+            data=dict(username=worker.new_username(), password=PASSWORD))),
+        ('login', 'POST', '/login', lambda worker, number: dict(
+            data=dict(username=worker.username, password=PASSWORD))),
+        ('create-joke', 'PUT', '/create-joke', lambda worker, number: dict(
+            headers=worker.headers, data=dict(content=worker.new_joke()))),
+        ('create-jokes', 'PUT', '/create-jokes', lambda worker, number: dict(
+            headers=worker.headers,
+            json=[worker.new_joke() for _ in range(10)])),
+        ('import-joke', 'PUT', '/import-joke', authorized(
+            data=dict(source='bench'))),
+        ('get-joke-by-id', 'GET', '/get-joke-by-id',
+         lambda worker, number: dict(headers=worker.headers, data=dict(
+             joke_id=worker.rng.choice(worker.jokes)))),
+        ('my-jokes', 'GET', '/my-jokes?limit=50', authorized()),
+        ('update-joke', 'PATCH', '/update-joke', lambda worker, number: dict(
+            headers=worker.headers, data=dict(
+                joke_id=worker.rng.choice(worker.jokes),
+                content=worker.new_joke()))),
+        ('search-jokes', 'GET', '/search-jokes', lambda worker, number: dict(
+            headers=worker.headers, data=dict(
+                q=worker.rng.choice(SEARCH_WORDS), scope='all'))),
+        ('random-joke', 'GET', '/random-joke', authorized()),
+        ('activity', 'GET', '/activity?granularity=hour', authorized()),
+        ('metrics', 'GET', '/metrics', lambda worker, number: {}),
+        ('delete-joke', 'DELETE', '/delete-joke', lambda worker, number: dict(
+            headers=worker.headers,
+            data=dict(joke_id=worker.jokes.pop()))),
+        ('logout', 'POST', '/logout', lambda worker, number: dict(
+            headers=dict(Authorization='Bearer ' +
+                         worker.spare_tokens.pop()))),
+    ]
+
+
+def run_scenario(transport, workers: list, method: str, path: str,
+                 maker, requests: int) -> dict:
+    """
+    Send 'requests' requests split over the workers' threads
+    :return: dict of rps, p50, p95, p99 in seconds and errors
+    """
+    latencies, errors = [], []
+    lock = threading.Lock()
+    share = [requests // len(workers) + (index < requests % len(workers))
+             for index in range(len(workers))]
+    start = threading.Barrier(len(workers) + 1)
+
+    def drive(worker, count):
+        send = transport.client()
+        mine, failed = [], 0
+        start.wait()
+        for number in range(count):
+            kwargs = maker(worker, number)
+            started = time.perf_counter()
+            status = send(method, path, **kwargs)
+            mine.append(time.perf_counter() - started)
+            failed += status >= 400
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=drive, args=(worker, count))
+               for worker, count in zip(workers, share)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return dict(
+        rps=len(latencies) / elapsed if elapsed else 0.0,
+        p50=percentile(latencies, 50),
+        p95=percentile(latencies, 95),
+        p99=percentile(latencies, 99),
+        errors=sum(errors),
+    )
+
+
+def run(args) -> dict:
+    """
+    Seed a database in a temporary directory and run every scenario
+    :param args: command line arguments
+    :return: results document
+    """
+    from flask_jwt_extended import create_access_token
+
+    from project import action_log
+    from project import create_app
+    from project import db
+
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp()
+    # Separate streams, so no two of them make the same jokes
+    source = StubSource(random.Random(rng.getrandbits(64)))
+    try:
+        app = create_app(make_config(
+            args.config, os.path.join(directory, 'bench.db'), source.url))
+        with app.app_context():
+            jokes = seed(db.engine, args, rng)
+            workers = []
+            for index in range(args.concurrency):
+                user_id = index % args.users + 1
+                worker = Worker(user_id,
+                                create_access_token(identity=user_id),
+                                jokes[user_id], rng.getrandbits(64))
+                worker.spare_tokens = [
+                    create_access_token(identity=user_id)
+                    for _ in range(args.requests + args.warmup)]
+                workers.append(worker)
+
+        transport = (ServerTransport if args.server
+                     else InProcessTransport)(app)
+        results = {}
+        try:
+            for name, method, path, maker in scenarios():
+                if args.only and name not in args.only:
+                    continue
+                if args.warmup:
+                    run_scenario(transport, workers, method, path, maker,
+                                 args.warmup)
+                results[name] = run_scenario(transport, workers, method,
+                                             path, maker, args.requests)
+                print_result(name, results[name])
+        finally:
+            transport.close()
+            action_log.flush()
+    finally:
+        source.shutdown()
+        shutil.rmtree(directory)
+
+    return dict(
+        meta=dict(
+            users=args.users, jokes_per_user=args.jokes_per_user,
+            actions_per_user=args.actions_per_user,
+            requests=args.requests, concurrency=args.concurrency,
+            transport='server' if args.server else 'in-process',
+            config=args.config, seed=args.seed,
+            python=platform.python_version(),
+            sqlite=sqlite3.sqlite_version,
+            machine=platform.machine(),
+            date=datetime.now().isoformat(timespec='seconds'),
+        ),
+        scenarios=results,
+    )
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Metrics that regressed past the threshold, a fraction of the
+    baseline value. A 'thresholds' dict of metric to fraction in
+    the baseline file overrides it for that metric
+    :param results: results document of this run
+    :param baseline: results document saved earlier
+    :param threshold: allowed relative regression
+    :return: list of messages, empty if nothing regressed
+    """
+    thresholds = baseline.get('thresholds', {})
+    regressions = []
+    for name, before in sorted(baseline['scenarios'].items()):
+        after = results['scenarios'].get(name)
+        if after is None:
+            continue
+        for metric in ('rps',) + LATENCIES:
+            allowed = thresholds.get(metric, threshold)
+            old, new = before[metric], after[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = change > allowed if metric in LATENCIES \
+                else -change > allowed
+            if worse:
+                regressions.append('%s %s: %.4g -> %.4g (%+.0f%%)' % (
+                    name, metric, old, new, change * 100))
+    return regressions
+
+
+def print_result(name: str, result: dict):
+    print('%-15s %9.1f %9.2f %9.2f %9.2f %7d' % (
+        name, result['rps'], result['p50'] * 1000, result['p95'] * 1000,
+        result['p99'] * 1000, result['errors']), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--jokes-per-user', type=int, default=20)
+    parser.add_argument('--actions-per-user', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='unmeasured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--server', action='store_true',
+                        help='serve the app on a local port, '
+                             'instead of the test client')
+    parser.add_argument('--config', default='config.ProductionConfig')
+    parser.add_argument('--seed', type=int, default=2020)
+    parser.add_argument('--only', nargs='*',
+                        help='names of the scenarios to run')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store this run as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed regression, a fraction')
+    parser.add_argument('--output', help='also write the results here')
+    args = parser.parse_args()
+    if args.concurrency > args.users:
+        parser.error('--concurrency must not exceed --users')
+    if args.jokes_per_user < args.requests + args.warmup:
+        # delete-joke takes a seeded or created joke per request
+        args.jokes_per_user = args.requests + args.warmup
+
+    print('%-15s %9s %9s %9s %9s %7s' % (
+        'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    results = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print('Saved the baseline to %s' % args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s, run with --save-baseline' % args.baseline)
+        return
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if any(baseline['meta'].get(key) != results['meta'][key]
+           for key in COMPARABLE):
+        print('The baseline was run with other settings: %s' %
+              json.dumps(baseline['meta']))
+    regressions = compare(results, baseline, args.threshold)
+    for message in regressions:
+        print('REGRESSION ' + message)
+    if regressions:
+        sys.exit(1)
+    print('No regression past %.0f%%' % (args.threshold * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Read/write concurrency of the default SQLite engine
+against the ProductionConfig profile.
+
+Readers fetch jokes by primary key while writers insert
+Action rows, one transaction each, the way log_action used to.
+
+Usage: python -m benchmarks.sqlite_profile [--seconds 5]
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+from config import ProductionConfig
+from project.models import Action
+from project.models import Joke
+from project.models import User
+from project.models import db
+from project.sqlite_pragmas import apply_pragmas
+
+
+def make_engine(path: str, profile: str):
+    """
+    Engine the app would build for the profile
+    :param path: database file
+    :param profile: 'default' or 'production'
+    :return: SQLAlchemy engine
+    """
+    url = 'sqlite:///' + path
+    if profile == 'default':
+        return create_engine(url, poolclass=NullPool)
+    engine = create_engine(url, **ProductionConfig.SQLALCHEMY_ENGINE_OPTIONS)
+    apply_pragmas(engine, ProductionConfig.SQLITE_PRAGMAS)
+    return engine
+
+
+def seed(engine, jokes: int):
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), dict(
+            id=1, username='benchmark', password='-'))
+        connection.execute(Joke.__table__.insert(), [dict(
+            joke_id=joke_id, content='Joke number %d' % joke_id, user_id=1)
+            for joke_id in range(1, jokes + 1)])
+
+
+def reader(engine, jokes, stop, latencies, errors):
+    while not stop.is_set():
+        statement = Joke.__table__.select().where(
+            Joke.__table__.c.joke_id == random.randint(1, jokes))
+        started = time.perf_counter()
+        try:
+            with engine.connect() as connection:
+                connection.execute(statement).fetchall()
+        except OperationalError:
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+def writer(engine, stop, latencies, errors):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            with engine.begin() as connection:
+                connection.execute(Action.__table__.insert(), dict(
+                    user_ip_address='127.0.0.1', action_time=datetime.now(),
+                    action_path='/benchmark', user_id=1))
+        except OperationalError:
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+def run(profile: str, args) -> dict:
+    directory = tempfile.mkdtemp()
+    try:
+        engine = make_engine(os.path.join(directory, 'bench.db'), profile)
+        seed(engine, args.jokes)
+
+        stop = threading.Event()
+        reads, writes, errors = [], [], []
+        threads = [threading.Thread(
+            target=reader, args=(engine, args.jokes, stop, reads, errors))
+            for _ in range(args.readers)]
+        threads += [threading.Thread(
+            target=writer, args=(engine, stop, writes, errors))
+            for _ in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+    return dict(
+        profile=profile,
+        reads=len(reads) / args.seconds,
+        writes=len(writes) / args.seconds,
+        read_p99=percentile(reads, 99),
+        write_p99=percentile(writes, 99),
+        errors=len(errors),
+    )
+
+
+def percentile(samples: list, rank: int) -> float:
+    if len(samples) < 2:
+        return samples[0] if samples else 0.0
+    return statistics.quantiles(samples, n=100)[rank - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--jokes', type=int, default=10000)
+    args = parser.parse_args()
+
+    print('%-11s %10s %10s %14s %14s %7s' % (
+        'profile', 'reads/s', 'writes/s', 'read p99 ms',
+        'write p99 ms', 'errors'))
+    for profile in ('default', 'production'):
+        result = run(profile, args)
+        print('%-11s %10.0f %10.0f %14.2f %14.2f %7d' % (
+            result['profile'], result['reads'], result['writes'],
+            result['read_p99'] * 1000, result['write_p99'] * 1000,
+            result['errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+Cold start time of a worker: imports and create_app() in a new process.
+
+Every run starts a new interpreter that imports the project and calls
+create_app(), by default on a database already at the latest schema,
+as a restarted worker finds it, or with --fresh on a new one. One more
+run under python -X importtime breaks the imports down by package.
+With --record the medians are appended to a history file, and a run
+fails when it is slower than the last recorded one by the threshold.
+
+Usage: python -m benchmarks.startup [--runs 10] [--fresh] [--top 15]
+           [--history benchmarks/baselines/startup.jsonl] [--record]
+           [--threshold 0.2]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+DEFAULT_HISTORY = os.path.join(os.path.dirname(__file__), 'baselines',
+                               'startup.jsonl')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Timings compared against the last recorded run
+TIMINGS = ('imports', 'create_app', 'process')
+
+# Run in the new interpreter, argv is the config and the database URI
+CHILD = '''
+import json
+import sys
+import time
+
+started = time.perf_counter()
+from project import create_app
+imported = time.perf_counter()
+
+from werkzeug.utils import import_string
+create_app(type('StartupConfig', (import_string(sys.argv[1]),), dict(
+    SQLALCHEMY_DATABASE_URI=sys.argv[2], METRICS_DIR=None)))
+created = time.perf_counter()
+print(json.dumps(dict(imports=imported - started,
+                      create_app=created - imported)))
+'''
+
+
+def start(config: str, database: str, importtime: bool = False) -> tuple:
+    """
+    Time one new process importing the project and calling create_app()
+    :param config: import string of the config class
+    :param database: SQLite database file
+    :param importtime: run under python -X importtime
+    :return: (dict of imports, create_app and process seconds, stderr)
+    """
+    command = [sys.executable] + (['-X', 'importtime'] if importtime
+                                  else []) + ['-c', CHILD, config,
+                                              'sqlite:///' + database]
+    started = time.perf_counter()
+    finished = subprocess.run(command, cwd=ROOT, capture_output=True,
+                              text=True)
+    elapsed = time.perf_counter() - started
+    if finished.returncode:
+        sys.exit('The worker failed to start:\n' + finished.stderr)
+    timings = json.loads(finished.stdout.strip().splitlines()[-1])
+    timings['process'] = elapsed
+    return timings, finished.stderr
+
+
+def import_breakdown(stderr: str) -> dict:
+    """
+    Sum the self time of python -X importtime lines by package
+    :param stderr: importtime output
+    :return: dict of top-level package to seconds
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0.0) + int(own) / 1e6
+    return packages
+
+
+def run(args) -> dict:
+    """
+    Start the worker args.runs times, with a new database per run
+    if args.fresh, else one database migrated by a first run
+    :param args: command line arguments
+    :return: results document
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        database = os.path.join(directory, 'startup.db')
+        if not args.fresh:
+            start(args.config, database)
+
+        samples = {timing: [] for timing in TIMINGS}
+        for number in range(args.runs):
+            if args.fresh:
+                database = os.path.join(directory, 'startup%d.db' % number)
+            timings, _ = start(args.config, database)
+            for timing in TIMINGS:
+                samples[timing].append(timings[timing])
+
+        if args.fresh:
+            database = os.path.join(directory, 'importtime.db')
+        _, stderr = start(args.config, database, importtime=True)
+    finally:
+        shutil.rmtree(directory)
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    packages = import_breakdown(stderr)
+    return dict(
+        date=datetime.now().isoformat(timespec='seconds'),
+        commit=commit,
+        runs=args.runs,
+        fresh=args.fresh,
+        config=args.config,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        median={timing: statistics.median(values)
+                for timing, values in samples.items()},
+        minimum={timing: min(values) for timing, values in samples.items()},
+        imports=dict(sorted(packages.items(), key=lambda item: -item[1])),
+    )
+
+
+def compare(results: dict, previous: dict, threshold: float) -> list:
+    """
+    Median timings slower than the previous run by the threshold
+    :param results: results document of this run
+    :param previous: last recorded results document
+    :param threshold: allowed relative regression
+    :return: list of messages, empty if nothing regressed
+    """
+    regressions = []
+    for timing in TIMINGS:
+        old, new = previous['median'][timing], results['median'][timing]
+        if old and (new - old) / old > threshold:
+            regressions.append('%s: %.1fms -> %.1fms (%+.0f%%)' % (
+                timing, old * 1000, new * 1000, (new - old) / old * 100))
+    return regressions
+
+
+def last_recorded(path: str, results: dict):
+    """
+    Last history entry taken with the same settings
+    :param path: history file, one JSON document per line
+    :param results: results document of this run
+    :return: results document or None
+    """
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as file:
+        for line in file:
+            entry = json.loads(line)
+            if all(entry.get(key) == results[key]
+                   for key in ('fresh', 'config', 'python', 'machine')):
+                previous = entry
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--fresh', action='store_true',
+                        help='start on a new database every run')
+    parser.add_argument('--config', default='config.ProductionConfig')
+    parser.add_argument('--top', type=int, default=15,
+                        help='packages listed in the import breakdown')
+    parser.add_argument('--history', default=DEFAULT_HISTORY)
+    parser.add_argument('--record', action='store_true',
+                        help='append this run to the history')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed regression, a fraction')
+    args = parser.parse_args()
+
+    results = run(args)
+    print('%-12s %9s %9s' % ('timing', 'median ms', 'min ms'))
+    for timing in TIMINGS:
+        print('%-12s %9.1f %9.1f' % (timing, results['median'][timing] * 1000,
+                                     results['minimum'][timing] * 1000))
+    total = sum(results['imports'].values())
+    print('\n%-24s %9s %6s' % ('imports by package', 'self ms', 'share'))
+    for package, seconds in list(results['imports'].items())[:args.top]:
+        print('%-24s %9.1f %5.0f%%' % (package, seconds * 1000,
+                                       seconds / total * 100))
+
+    previous = last_recorded(args.history, results)
+    regressions = []
+    if previous is not None:
+        print('\nCompared to %s (%s)' % (previous['date'],
+                                         previous['commit']))
+        regressions = compare(results, previous, args.threshold)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if not regressions:
+            print('No regression past %.0f%%' % (args.threshold * 100))
+    if args.record:
+        os.makedirs(os.path.dirname(args.history), exist_ok=True)
+        with open(args.history, 'a') as file:
+            file.write(json.dumps(results) + '\n')
+        print('Recorded in %s' % args.history)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
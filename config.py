@@ -1,4 +1,10 @@
 """Flask configuration"""
+import os
+import tempfile
+
+from sqlalchemy.pool import QueuePool
+
+basedir = os.path.abspath(os.path.dirname(__file__))
 
 
 class Config:
@@ -11,9 +17,18 @@ class Config:
     # Database
     SQLALCHEMY_DATABASE_URI = "sqlite:///sqlite_db/catalogue.db"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # PRAGMAs run on every new connection, see ProductionConfig
+    SQLITE_PRAGMAS = {}
 
     # JWT
     JWT_SECRET_KEY = 'super-secret'
+    JWT_BLACKLIST_ENABLED = True
+    JWT_BLACKLIST_TOKEN_CHECKS = ['access']
+    # Bloom filter of revoked tokens, sized for this many at this error rate
+    REVOKED_TOKENS_CAPACITY = 100000
+    REVOKED_TOKENS_ERROR_RATE = 0.001
+    # Seconds before a worker sees tokens revoked by the other workers
+    REVOKED_TOKENS_SYNC_INTERVAL = 1.0
 
     # Tests
     FAKE_DATABASE_URI = "sqlite:///tests/test.db"
@@ -26,6 +41,8 @@ class Config:
     FAKE_JOKE = 'A horse and a pigeon walk into a bar...'
     ANOTHER_FAKE_JOKE = 'What\'s the best thing about Switzerland? ' \
                         'I don\'t know, but the flag is a big plus.'
+    YET_ANOTHER_FAKE_JOKE = 'I told my wife she was drawing her eyebrows ' \
+                            'too high. She looked surprised.'
 
     # Messages
     BAD_PARAMETER = "User\'s name can only contain digits " \
@@ -33,10 +50,176 @@ class Config:
                     "characters long, 20 characters at max"
     TOO_LONG = b"Joke string is too long. Max allowed size is 900 characters"
 
+    # Action log
+    ACTION_LOG_QUEUE_SIZE = 10000
+    ACTION_LOG_BATCH_SIZE = 500
+    ACTION_LOG_FLUSH_INTERVAL = 1.0  # seconds
+    # One of 'drop-newest', 'drop-oldest' or 'block'
+    ACTION_LOG_OVERFLOW_POLICY = 'drop-newest'
+
+    # Action retention, see python manage.py maintain-actions
+    ACTION_RETENTION_DAYS = 30
+    ACTION_ARCHIVE_DIR = os.path.join(basedir, 'archive')
+    ACTION_MAINTENANCE_CHUNK = 5000  # rows per transaction
+    ACTION_MAINTENANCE_PAUSE = 0.05  # seconds between chunks
+    # Days of /activity counts kept per granularity, None keeps all
+    ACTION_COUNT_RETENTION_DAYS = {'minute': 7, 'hour': None, 'day': None}
+
+    # /activity windows
+    ACTIVITY_DEFAULT_BUCKETS = 60
+    ACTIVITY_MAX_BUCKETS = 1440
+
+    # Login
+    USER_CACHE_SIZE = 10000
+    # Seconds a worker may log in with credentials
+    # changed or deleted by another worker
+    USER_CACHE_TTL = 30.0
+
+    # Password hashing
+    BCRYPT_LOG_ROUNDS = 12
+    # Pool processes, 0 hashes on the request thread
+    PASSWORD_HASHING_WORKERS = 2
+    # Calls allowed to wait for a busy pool before answering 503
+    PASSWORD_HASHING_QUEUE_SIZE = 16
+    PASSWORD_HASHING_TIMEOUT = 5.0  # seconds
+
     # Bounds
     JOKES_LIMIT = 100
+    BULK_JOKES_LIMIT = 100  # jokes in one /create-jokes request
+
+    # /get-joke-by-id cache
+    JOKE_CACHE_ENABLED = True
+    JOKE_CACHE_SIZE = 10000
+    JOKE_CACHE_TTL = 300  # seconds
+
+    # /my-jokes pages
+    MY_JOKES_PAGE_SIZE = 50
+    MY_JOKES_MAX_PAGE_SIZE = 500
+    MY_JOKES_STREAM_BATCH = 500  # rows fetched at a time when streaming
+
+    # Least estimated Jaccard similarity of a reworded copy of a joke
+    NEAR_DUPLICATE_THRESHOLD = 0.65
+
+    # /random-joke draws of deleted joke_ids before reloading the ids,
+    # see project.sampling
+    RANDOM_JOKE_ATTEMPTS = 16
+    # joke_ids kept per worker, 8 bytes each, a larger
+    # catalogue is sampled by drawing ids instead
+    RANDOM_JOKE_MAX_IDS = 1000000
+
+    # /search-jokes pages
+    SEARCH_PAGE_SIZE = 20
+    SEARCH_MAX_PAGE_SIZE = 100
+
+    # /metrics, see project.metrics
+    METRICS_ENABLED = True
+    METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1.0, 2.5, 5.0, 10.0)  # seconds
+    # Shared by the workers of the host, None for a single process
+    METRICS_DIR = None
+    METRICS_SYNC_INTERVAL = 5.0  # seconds between writes of a worker
+    # Seconds after its last write a worker's file is dropped
+    METRICS_STALE_AFTER = 60.0
+
+    # SQL statements per request, see project.query_profiler
+    QUERY_PROFILER_ENABLED = True
+    SLOW_QUERY_THRESHOLD = 0.1  # seconds
+    QUERY_REPEAT_THRESHOLD = 5  # identical statements in one request
+    # Fail the request instead of logging when a budget is exceeded
+    QUERY_BUDGET_STRICT = TESTING
+    # Most statements a request of the route may run, one more than
+    # measured as workers may sync the token denylist on any request
+    QUERY_BUDGETS = {
+        '/register': 1,
+        '/login': 3,
+        '/logout': 3,
+        '/create-joke': 7,
+        '/import-joke': 7,
+        '/create-jokes': 9,
+        '/get-joke-by-id': 3,
+        '/my-jokes': 4,
+        '/update-joke': 7,
+        '/delete-joke': 5,
+        '/activity': 3,
+        '/search-jokes': 2,
+        '/random-joke': 3,
+        '/metrics': 0,
+    }
+
+    # Token buckets per route and client, see project.rate_limit.
+    # Off here, the tests log in far more often than any client should
+    RATE_LIMIT_ENABLED = False
+    # Shared by the workers of the host, on tmpfs where there is one
+    RATE_LIMIT_STORE = os.path.join(
+        '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+        'joke-rest-api-rate-limits.db')
+    RATE_LIMIT_PRUNE_EVERY = 1000  # checks between dropping full buckets
+    # Route to {'ip' or 'user': (burst size, seconds to refill it)}
+    RATE_LIMITS = {
+        '/login': {'ip': (10, 60)},
+        '/register': {'ip': (5, 60)},
+        '/import-joke': {'user': (30, 60), 'ip': (60, 60)},
+        '/create-jokes': {'user': (10, 60)},
+    }
 
     # Foreign APIs
+    FOREIGN_API_DEFAULTS = {
+        'field': 'joke',  # key of the joke in the JSON answer
+        'connect_timeout': 3.05,  # seconds
+        'read_timeout': 5.0,  # seconds
+        'retries': 2,
+        'backoff': 0.2,  # seconds, doubled on every retry
+        'pool_size': 10,  # keep-alive connections per worker
+        'buffer_size': 20,  # prefetched jokes per worker, 0 disables
+        'low_water': 5,  # refill the buffer once it is down to this
+    }
+    # Seconds without prefetching after a failed refill, doubled
+    # on every failure in a row, up to the max
+    PREFETCH_ERROR_BACKOFF = 1.0
+    PREFETCH_ERROR_BACKOFF_MAX = 300.0
+    # Seconds without an import from a source before its refills stop
+    PREFETCH_IDLE_TIMEOUT = 600.0
     FOREIGN_API = {
-        'geek-jokes': 'https://geek-jokes.sameerkumar.website/api?format=json',
+        'geek-jokes': {
+            'url': 'https://geek-jokes.sameerkumar.website/api?format=json',
+        },
+    }
+
+
+class ProductionConfig(Config):
+    """
+    Config for multi-threaded workers, selected with
+    APP_CONFIG=config.ProductionConfig
+    """
+
+    FLASK_ENV = "production"
+    TESTING = False
+
+    # WAL lets readers run alongside the writer, NORMAL syncs
+    # at checkpoints only, which is safe in WAL mode
+    SQLITE_PRAGMAS = {
+        'busy_timeout': 5000,  # milliseconds
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,  # bytes
+        'cache_size': -64 * 1024,  # negative is KiB
+        'temp_store': 'MEMORY',
+    }
+
+    RATE_LIMIT_ENABLED = True
+    QUERY_BUDGET_STRICT = False
+    METRICS_DIR = os.path.join(
+        '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+        'joke-rest-api-metrics')
+
+    # Keep connections, and their PRAGMAs, between requests
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'poolclass': QueuePool,
+        'pool_size': 8,
+        'max_overflow': 8,
+        'pool_timeout': 10,  # seconds
+        'connect_args': {
+            'check_same_thread': False,
+            'timeout': 5,  # seconds
+        },
     }
@@ -0,0 +1,189 @@
+"""
+Management commands, run as: python manage.py <command>
+See python manage.py --help for the list
+"""
+from datetime import datetime
+from datetime import timedelta
+
+import click
+from flask import current_app
+from flask.cli import FlaskGroup
+
+from project import create_app
+from project import db
+
+
+@click.group(cls=FlaskGroup, create_app=lambda script_info: create_app())
+def cli():
+    """Management commands of the jokes API"""
+
+
+@cli.command()
+def migrate():
+    """Apply pending schema migrations"""
+    from project.migrations import upgrade_schema
+
+    applied = upgrade_schema(db.engine)
+    for item in applied:
+        click.echo('Applied %d: %s' % (item.version, item.description))
+    if not applied:
+        click.echo('Schema is up to date')
+
+
+@cli.command()
+def migrations():
+    """List schema migrations and whether they are applied"""
+    from project.migrations import MIGRATIONS
+    from project.migrations import applied_versions
+
+    applied = applied_versions(db.engine)
+    for item in MIGRATIONS:
+        click.echo('[%s] %d: %s' % ('x' if item.version in applied else ' ',
+                                    item.version, item.description))
+
+
+@cli.command('maintain-actions')
+@click.option('--days', type=int, default=None,
+              help='Keep this many days of raw actions '
+                   '[default: ACTION_RETENTION_DAYS]')
+@click.option('--chunk', type=int, default=None,
+              help='Rows per transaction '
+                   '[default: ACTION_MAINTENANCE_CHUNK]')
+def maintain_actions(days, chunk):
+    """Roll up, archive and delete old actions and activity counts"""
+    from project.maintenance import maintain_actions
+    from project.maintenance import prune_counts
+
+    config = current_app.config
+    days = config['ACTION_RETENTION_DAYS'] if days is None else days
+    chunk = chunk or config['ACTION_MAINTENANCE_CHUNK']
+    stats = maintain_actions(
+        db.engine,
+        cutoff=datetime.now() - timedelta(days=days),
+        archive_dir=config['ACTION_ARCHIVE_DIR'],
+        chunk_size=chunk,
+        pause=config['ACTION_MAINTENANCE_PAUSE'],
+    )
+    click.echo('Moved %(actions)d actions in %(chunks)d chunks, '
+               'updated %(rollups)d hourly counts' % stats)
+
+    for granularity, kept in config['ACTION_COUNT_RETENTION_DAYS'].items():
+        if kept is None:
+            continue
+        deleted = prune_counts(
+            db.engine, granularity,
+            cutoff=datetime.now() - timedelta(days=kept),
+            chunk_size=chunk,
+            pause=config['ACTION_MAINTENANCE_PAUSE'],
+        )
+        click.echo('Deleted %d per-%s activity counts' % (
+            deleted, granularity))
+
+
+@cli.command('rebuild-search')
+def rebuild_search():
+    """Re-index every joke for full-text search"""
+    from project.search import rebuild_search_index
+
+    indexed = rebuild_search_index(db.engine)
+    click.echo('Indexed %d jokes' % indexed)
+
+
+@cli.command('dedupe-jokes')
+@click.option('--threshold', type=float, default=None,
+              help='Least estimated Jaccard similarity '
+                   '[default: NEAR_DUPLICATE_THRESHOLD]')
+@click.option('--delete', is_flag=True,
+              help='Delete the newer joke of every near-duplicate pair')
+def dedupe_jokes(threshold, delete):
+    """List, or delete, jokes that nearly duplicate an older one"""
+    from project.models import Joke
+    from project.near_duplicates import near_duplicates_in_catalogue
+
+    if threshold is None:
+        threshold = current_app.config['NEAR_DUPLICATE_THRESHOLD']
+    found = 0
+    for joke_id, original_id, score in near_duplicates_in_catalogue(
+            db.session, threshold):
+        found += 1
+        click.echo('Joke %d is %.0f%% similar to joke %d' % (
+            joke_id, score * 100, original_id))
+        if delete:
+            db.session.delete(Joke.query.get(joke_id))
+            db.session.commit()
+    click.echo('%s %d near-duplicate jokes' % (
+        'Deleted' if delete else 'Found', found))
+
+
+@cli.command('prune-revoked-tokens')
+def prune_revoked_tokens():
+    """Delete the revocations of expired tokens"""
+    from project import token_denylist
+
+    click.echo('Deleted %d expired revocations' % token_denylist.prune())
+
+
+def parse_path_weight(context, parameter, values):
+    weights = {}
+    for value in values:
+        path, _, weight = value.rpartition('=')
+        try:
+            weights[path] = float(weight)
+        except ValueError:
+            raise click.BadParameter('%r is not PATH=WEIGHT' % value)
+    return weights or None
+
+
+@cli.command('generate-data')
+@click.option('--users', type=int, default=10000, show_default=True)
+@click.option('--jokes', type=int, default=200000, show_default=True)
+@click.option('--actions', type=int, default=800000, show_default=True)
+@click.option('--joke-skew', type=float, default=1.0, show_default=True,
+              help='Zipf exponent of the jokes per user, 0 is uniform')
+@click.option('--action-skew', type=float, default=1.0, show_default=True,
+              help='Zipf exponent of the actions per user, 0 is uniform')
+@click.option('--path', 'paths', multiple=True, callback=parse_path_weight,
+              metavar='PATH=WEIGHT',
+              help='Share of the actions on a path, repeated for every '
+                   'path [default: project.synthetic.PATH_WEIGHTS]')
+@click.option('--days', type=float, default=30.0, show_default=True,
+              help='Time span of the actions, up to now')
+@click.option('--password', default='synthetic1', show_default=True,
+              help='Password of every user, hashed once')
+@click.option('--minhash', is_flag=True,
+              help='Compute near-duplicate signatures, about 2.5ms a joke')
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.option('--statement-rows', type=int, default=500, show_default=True)
+@click.option('--transaction-rows', type=int, default=250000,
+              show_default=True)
+def generate_data(users, jokes, actions, joke_skew, action_skew, paths,
+                  days, password, minhash, seed, statement_rows,
+                  transaction_rows):
+    """Bulk-load synthetic users, jokes and actions for scale testing"""
+    from project import password_hasher
+    from project.synthetic import USERNAME
+    from project.synthetic import generate
+
+    try:
+        stats = generate(
+            db.engine, users, jokes, actions,
+            password=password_hasher.generate(password),
+            joke_skew=joke_skew, action_skew=action_skew, paths=paths,
+            days=days, joke_limit=current_app.config['JOKES_LIMIT'],
+            minhash=minhash, seed=seed, statement_rows=statement_rows,
+            transaction_rows=transaction_rows,
+        )
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    click.echo('Added %(users)d users, %(jokes)d jokes, %(actions)d actions '
+               'and %(counts)d activity counts in %(seconds).1fs' % stats)
+    if stats['jokes'] and not minhash:
+        click.echo('Skipped MinHash signatures: near-duplicate checks and '
+                   'dedupe-jokes do not see these jokes, use --minhash')
+    if users:
+        click.echo('Log in as %s, or any user after it, password %r' % (
+            USERNAME % stats['first_user_id'], password))
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,19 +1,63 @@
+import os
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from config import Config
-from flask_bcrypt import Bcrypt
 
 app = Flask(__name__)
-bcrypt = Bcrypt(app)
 
 db = SQLAlchemy()
 
+from .action_buffer import ActionLog
+from .user_cache import UserCache
+from .joke_cache import JokeCache
+from .hashing import PasswordHasher
+from .foreign_api import ForeignApis
+from .prefetch import JokePrefetcher
+from .revocation import TokenDenylist
+from .metrics import Metrics
+from .query_profiler import QueryProfiler
+from .rate_limit import RateLimiter
+
+action_log = ActionLog()
+user_cache = UserCache()
+joke_cache = JokeCache()
+password_hasher = PasswordHasher()
+foreign_apis = ForeignApis()
+prefetcher = JokePrefetcher(foreign_apis)
+token_denylist = TokenDenylist()
+metrics = Metrics()
+query_profiler = QueryProfiler()
+rate_limiter = RateLimiter()
+metrics.add_collector(prefetcher.samples)
+
 
-def create_app():
-    app.config.from_object(Config)
+def create_app(config_object=None):
+    app.config.from_object(
+        config_object or os.environ.get('APP_CONFIG') or Config)
     db.init_app(app)
+    action_log.init_app(app)
+    user_cache.init_app(app)
+    joke_cache.init_app(app)
+    password_hasher.init_app(app)
+    foreign_apis.init_app(app)
+    prefetcher.init_app(app)
+    token_denylist.init_app(app)
+    # Before the rate limiter, to time its checks too
+    metrics.init_app(app)
+    query_profiler.init_app(app)
+    rate_limiter.init_app(app)
 
     with app.app_context():
         from . import routes
-        db.create_all()
+        from .migrations import schema_is_current
+        from .migrations import upgrade_schema
+        from .sqlite_pragmas import apply_pragmas
+        if app.config['SQLITE_PRAGMAS']:
+            apply_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
+        # Schema work only on a new or outdated database, or
+        # one missing the table of a model added without a migration
+        if not schema_is_current(db.engine, db.Model.metadata):
+            upgrade_schema(db.engine, db.Model.metadata)
+        token_denylist.load()
         return app
@@ -0,0 +1,258 @@
+"""Write-behind buffer for the Action log"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy import select
+
+from .analytics import count_actions
+from .analytics import count_logged_actions
+from .models import Action
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop-newest', 'drop-oldest', 'block')
+
+
+class ActionLog:
+    """
+    Buffers Action rows in a bounded in-process queue and
+    bulk-inserts them from a background writer thread.
+    Their pre-aggregated counts are added once the rows are
+    committed, so failing to count never loses an Action.
+    The action_id range of a batch that could not be counted
+    is counted again from the table on the next write or flush
+    A batch is written as soon as it is full or once
+    ACTION_LOG_FLUSH_INTERVAL seconds have passed since
+    its first entry was queued, whichever comes first
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = None
+        self.batch_size = None
+        self.flush_interval = None
+        self.overflow_policy = None
+        self.dropped = 0
+        self.written = 0
+        self.uncounted = 0
+        self._uncounted_ranges = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the buffer settings from the app config
+        and register the shutdown flush
+        :param app: Flask application
+        :return: None
+        """
+        policy = app.config['ACTION_LOG_OVERFLOW_POLICY']
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown action log overflow policy %r' % policy)
+
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['ACTION_LOG_QUEUE_SIZE'])
+        self.batch_size = app.config['ACTION_LOG_BATCH_SIZE']
+        self.flush_interval = app.config['ACTION_LOG_FLUSH_INTERVAL']
+        self.overflow_policy = policy
+        atexit.register(self.stop)
+
+    def record(self, req_obj, user_id: int):
+        """
+        Queue one Action row for the background writer
+        :param req_obj: current request context
+        :param user_id: actor's user_id
+        :return: None
+        """
+        self._ensure_writer()
+        self._put(dict(
+            user_ip_address=req_obj.remote_addr,
+            action_time=datetime.now(),
+            action_path=req_obj.path,
+            user_id=user_id,
+        ))
+
+    def flush(self):
+        """
+        Synchronously write everything that is currently queued
+        and wait for the batch the writer may be holding
+        :return: number of rows written by this call
+        """
+        total = 0
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                break
+            self._write(batch)
+            total += len(batch)
+        self.queue.join()
+        if self._uncounted_ranges:
+            with self.app.app_context():
+                self._recount()
+        return total
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop the background writer and flush what is left
+        :param timeout: seconds to wait for the writer thread
+        :return: None
+        """
+        self._stopped.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
+
+    @property
+    def pending(self) -> int:
+        """Number of rows waiting to be written"""
+        return self.queue.qsize()
+
+    def _put(self, entry: dict):
+        if self.overflow_policy == 'block':
+            self.queue.put(entry)
+            return
+
+        try:
+            self.queue.put_nowait(entry)
+            return
+        except queue.Full:
+            pass
+
+        if self.overflow_policy == 'drop-oldest':
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(entry)
+            except queue.Full:
+                pass
+        self._count_dropped(1)
+
+    def _count_dropped(self, amount: int):
+        with self._lock:
+            self.dropped += amount
+
+    def _ensure_writer(self):
+        # The thread is started lazily so that forked
+        # workers each get their own writer
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='action-log-writer', daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._collect()
+            if batch:
+                self._write(batch)
+
+    def _collect(self) -> list:
+        """
+        Wait for the first entry, then keep collecting
+        until the batch is full or the flush interval is over
+        :return: list of Action row mappings
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if deadline is None:
+                timeout = self.flush_interval
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            if self._stopped.is_set():
+                break
+        return batch
+
+    def _drain(self, limit: int) -> list:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list):
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    connection.execute(Action.__table__.insert(), batch)
+                    # The transaction holds the write lock, the
+                    # batch got the ids up to the largest one
+                    last = connection.execute(select([
+                        func.max(Action.__table__.c.action_id)])).scalar()
+                self._recount()
+                self._count(batch, last - len(batch) + 1, last)
+        except Exception:
+            logger.exception('Could not write %d actions', len(batch))
+            self._count_dropped(len(batch))
+        else:
+            with self._lock:
+                self.written += len(batch)
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def _count(self, batch: list, first: int, last: int):
+        """
+        Add the committed batch to the activity counts in a
+        transaction of their own. If that fails its action_id
+        range is kept for _recount()
+        :param batch: list of Action row mappings
+        :param first: action_id of the first row
+        :param last: action_id of the last row
+        :return: None
+        """
+        try:
+            with db.engine.begin() as connection:
+                count_actions(connection, batch)
+        except Exception:
+            logger.exception('Could not count %d actions', len(batch))
+            with self._lock:
+                self.uncounted += len(batch)
+                self._uncounted_ranges.append((first, last))
+
+    def _recount(self):
+        """
+        Count the batches that could not be counted, from the table
+        :return: None
+        """
+        with self._lock:
+            ranges, self._uncounted_ranges = self._uncounted_ranges, []
+        for first, last in ranges:
+            try:
+                with db.engine.begin() as connection:
+                    count_logged_actions(connection, first, last)
+            except Exception:
+                logger.exception('Could not count actions %d to %d',
+                                 first, last)
+                with self._lock:
+                    self._uncounted_ranges.append((first, last))
+            else:
+                with self._lock:
+                    self.uncounted -= last - first + 1
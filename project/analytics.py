@@ -0,0 +1,195 @@
+"""Action counts pre-aggregated as actions are logged"""
+import sqlite3
+from collections import Counter
+from datetime import datetime
+from datetime import timedelta
+
+from sqlalchemy import bindparam
+from sqlalchemy import text
+
+from .models import ActionCount
+from .models import db
+
+# Bucket width and truncation of each granularity
+GRANULARITIES = {
+    'minute': (timedelta(minutes=1),
+               lambda moment: moment.replace(second=0, microsecond=0)),
+    'hour': (timedelta(hours=1),
+             lambda moment: moment.replace(minute=0, second=0,
+                                           microsecond=0)),
+    'day': (timedelta(days=1),
+            lambda moment: moment.replace(hour=0, minute=0, second=0,
+                                          microsecond=0)),
+}
+
+# Counts of every user together are kept under this user_id
+ALL_USERS = 0
+
+# INSERT ... ON CONFLICT DO UPDATE needs SQLite 3.24
+UPSERT = sqlite3.sqlite_version_info >= (3, 24)
+
+UPSERT_COUNT = text(
+    'INSERT INTO action_count '
+    '(granularity, user_id, bucket, action_path, count) '
+    'VALUES (:granularity, :user_id, :bucket, :action_path, :count) '
+    'ON CONFLICT (granularity, user_id, bucket, action_path) '
+    'DO UPDATE SET count = count + excluded.count'
+).bindparams(bindparam('bucket', type_=db.DateTime))
+
+# UPSERT_COUNT of older SQLite, the INSERT only if nothing was updated
+ADD_TO_COUNT = text(
+    'UPDATE action_count SET count = count + :count '
+    'WHERE granularity = :granularity AND user_id = :user_id '
+    'AND bucket = :bucket AND action_path = :action_path'
+).bindparams(bindparam('bucket', type_=db.DateTime))
+INSERT_COUNT = text(
+    'INSERT INTO action_count '
+    '(granularity, user_id, bucket, action_path, count) '
+    'VALUES (:granularity, :user_id, :bucket, :action_path, :count)'
+).bindparams(bindparam('bucket', type_=db.DateTime))
+
+
+def add_counts(connection, counts: list):
+    """
+    Add to the counts, creating the missing ones
+    :param connection: connection in a transaction
+    :param counts: list of dicts of granularity, user_id,
+    bucket, action_path and count
+    :return: None
+    """
+    if UPSERT:
+        connection.execute(UPSERT_COUNT, counts)
+        return
+    # The first write took the lock, no other worker
+    # can insert the count between the two statements
+    for count in counts:
+        if not connection.execute(ADD_TO_COUNT, **count).rowcount:
+            connection.execute(INSERT_COUNT, **count)
+
+
+def count_actions(connection, actions: list) -> int:
+    """
+    Add a batch of logged actions to the counts of every
+    granularity, per user and for all users together
+    :param connection: connection in the transaction inserting them
+    :param actions: Action row mappings
+    :return: number of counts touched
+    """
+    counts = Counter()
+    for action in actions:
+        for granularity, (_, truncate) in GRANULARITIES.items():
+            bucket = truncate(action['action_time'])
+            for user_id in (action['user_id'], ALL_USERS):
+                counts[granularity, user_id, bucket,
+                       action['action_path']] += 1
+    if counts:
+        add_counts(connection, [
+            dict(granularity=granularity, user_id=user_id, bucket=bucket,
+                 action_path=path, count=count)
+            for (granularity, user_id, bucket, path), count in counts.items()
+        ])
+    return len(counts)
+
+
+# GRANULARITIES truncation of the stored action_time text,
+# its first 'length' characters and the zeros of the rest
+BUCKET_TEXT = {
+    'minute': (16, ':00.000000'),
+    'hour': (13, ':00:00.000000'),
+    'day': (10, ' 00:00:00.000000'),
+}
+
+SELECT_LOGGED_COUNTS = (
+    'SELECT :granularity, {user_id}, '
+    'substr(action_time, 1, :length) || :zeros, action_path, count(*) '
+    'FROM action WHERE action_id BETWEEN :first_action_id '
+    'AND :last_action_id '
+    'GROUP BY 2, 3, 4'
+)
+UPSERT_LOGGED_COUNTS = (
+    'INSERT INTO action_count '
+    '(granularity, user_id, bucket, action_path, count) ' +
+    SELECT_LOGGED_COUNTS + ' '
+    'ON CONFLICT (granularity, user_id, bucket, action_path) '
+    'DO UPDATE SET count = count + excluded.count'
+)
+
+
+def count_logged_actions(connection, first_action_id: int = 1,
+                         last_action_id: int = None) -> int:
+    """
+    count_actions() of Actions already in the table, aggregated
+    by SQLite instead of row by row, for bulk loads and for
+    batches whose counts could not be added
+    :param connection: connection in the transaction inserting them
+    :param first_action_id: count the Actions from this action_id on
+    :param last_action_id: up to this one, the last one if None
+    :return: number of counts touched
+    """
+    bounds = dict(first_action_id=first_action_id,
+                  last_action_id=2 ** 63 - 1 if last_action_id is None
+                  else last_action_id)
+    touched = 0
+    for granularity, (length, zeros) in BUCKET_TEXT.items():
+        for user_id in ('user_id', str(ALL_USERS)):
+            parameters = dict(bounds, granularity=granularity,
+                              length=length, zeros=zeros)
+            if UPSERT:
+                touched += connection.execute(
+                    text(UPSERT_LOGGED_COUNTS.format(user_id=user_id)),
+                    **parameters).rowcount
+                continue
+            counts = [
+                dict(granularity=granularity, user_id=row[1],
+                     bucket=datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S.%f'),
+                     action_path=row[3], count=row[4])
+                for row in connection.execute(
+                    text(SELECT_LOGGED_COUNTS.format(user_id=user_id)),
+                    **parameters)]
+            if counts:
+                add_counts(connection, counts)
+            touched += len(counts)
+    return touched
+
+
+def bucket_range(granularity: str, start=None, end=None, buckets: int = 60):
+    """
+    Normalize a time window to whole buckets, by default
+    the last 'buckets' buckets up to now
+    :param granularity: key of GRANULARITIES
+    :param start: datetime or None
+    :param end: datetime or None, exclusive
+    :param buckets: window length when start is not given
+    :return: (start, end) truncated to the granularity
+    """
+    width, truncate = GRANULARITIES[granularity]
+    if end is None:
+        end = truncate(datetime.now()) + width
+    else:
+        end = truncate(end)
+    start = end - width * buckets if start is None else truncate(start)
+    return start, end
+
+
+def query_counts(granularity: str, user_id: int, start, end,
+                 action_path: str = None) -> list:
+    """
+    Counts of the window, one indexed range scan of action_count
+    :param granularity: key of GRANULARITIES
+    :param user_id: User identity or ALL_USERS
+    :param start: first bucket
+    :param end: bucket after the last one
+    :param action_path: only count this path if given
+    :return: list of (bucket, action_path, count) ordered by bucket
+    """
+    query = db.session.query(
+        ActionCount.bucket, ActionCount.action_path, ActionCount.count
+    ).filter(
+        ActionCount.granularity == granularity,
+        ActionCount.user_id == user_id,
+        ActionCount.bucket >= start,
+        ActionCount.bucket < end,
+    )
+    if action_path is not None:
+        query = query.filter(ActionCount.action_path == action_path)
+    return query.order_by(ActionCount.bucket, ActionCount.action_path).all()
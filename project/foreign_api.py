@@ -0,0 +1,135 @@
+"""Pooled HTTP clients for the FOREIGN_API joke sources"""
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ForeignApiError(Exception):
+    """Raised when a source did not answer with a joke"""
+
+
+class RetryableError(ForeignApiError):
+    """Raised for failures worth another attempt"""
+
+
+class ForeignApiClient:
+    """
+    Keep-alive client for one source. Connection errors,
+    timeouts and 5xx answers are retried up to 'retries'
+    times with exponential backoff and full jitter
+    """
+
+    def __init__(self, name: str, settings: dict):
+        self.name = name
+        self.url = settings['url']
+        self.field = settings['field']
+        self.timeout = (settings['connect_timeout'],
+                        settings['read_timeout'])
+        self.retries = settings['retries']
+        self.backoff = settings['backoff']
+        # Imported by the first client rather than at startup,
+        # requests is among the slowest imports of the app
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.retryable = (requests.ConnectionError, requests.Timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=settings['pool_size'],
+                              max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch_joke(self) -> str:
+        """
+        Get one joke from the source
+        :return: joke text
+        :raise ForeignApiError: if every attempt failed
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self._get()
+            except RetryableError as error:
+                if attempt == self.retries:
+                    raise
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                logger.info('%s: %s, retrying in %.2fs',
+                            self.name, error, delay)
+                time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+    def _get(self) -> str:
+        try:
+            response = self.session.get(self.url, timeout=self.timeout)
+        except self.retryable as error:
+            raise RetryableError(str(error))
+
+        if response.status_code >= 500:
+            raise RetryableError('HTTP %d' % response.status_code)
+        if response.status_code != 200:
+            raise ForeignApiError('HTTP %d' % response.status_code)
+
+        try:
+            return response.json()[self.field]
+        except (ValueError, KeyError, TypeError):
+            raise ForeignApiError('No %r in the answer' % self.field)
+
+
+class ForeignApis:
+    """
+    One ForeignApiClient per FOREIGN_API source, made on first use.
+    Settings of a source override FOREIGN_API_DEFAULTS
+    """
+
+    def __init__(self, app=None):
+        self.settings = {}
+        self._clients = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the sources from the app config
+        :param app: Flask application
+        :return: None
+        """
+        self.settings = {
+            name: dict(app.config['FOREIGN_API_DEFAULTS'], **settings)
+            for name, settings in app.config['FOREIGN_API'].items()
+        }
+        self.close()
+
+    def __contains__(self, source: str) -> bool:
+        return source in self.settings
+
+    def client(self, source: str) -> ForeignApiClient:
+        """
+        Client of the source, pools are not shared with forked workers
+        :param source: FOREIGN_API key
+        :return: ForeignApiClient
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._pid = os.getpid()
+            if source not in self._clients:
+                self._clients[source] = ForeignApiClient(
+                    source, self.settings[source])
+            return self._clients[source]
+
+    def fetch_joke(self, source: str) -> str:
+        return self.client(source).fetch_joke()
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
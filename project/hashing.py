@@ -0,0 +1,174 @@
+"""Password hashing off the request thread"""
+import atexit
+import os
+import threading
+from concurrent.futures import BrokenExecutor
+from concurrent.futures import TimeoutError
+
+import bcrypt
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool cannot take more work"""
+
+
+def hash_password(password: str, rounds: int) -> str:
+    """
+    Bcrypt-hash the password, runs in a pool worker
+    :param password: plain password
+    :param rounds: bcrypt cost factor
+    :return: hash as str
+    """
+    return bcrypt.hashpw(
+        password.encode('utf-8'), bcrypt.gensalt(rounds)
+    ).decode('utf-8')
+
+
+def check_password(hashcode: str, candidate: str) -> bool:
+    """
+    Validate the candidate password against the hash, runs in a pool worker
+    :param hashcode: Bcrypt-hashed password
+    :param candidate: candidate password
+    :return: True if matched, else False
+    """
+    return bcrypt.checkpw(candidate.encode('utf-8'), hashcode.encode('utf-8'))
+
+
+def cost_of(hashcode) -> int:
+    """
+    Read the cost factor from a '$2b$12$...' hash
+    :param hashcode: Bcrypt-hashed password, str or bytes
+    :return: cost factor or 0 if the hash cannot be parsed
+    """
+    if isinstance(hashcode, bytes):
+        hashcode = hashcode.decode('utf-8')
+    try:
+        return int(hashcode.split('$')[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a process pool of PASSWORD_HASHING_WORKERS.
+    At most PASSWORD_HASHING_QUEUE_SIZE calls may wait for a
+    worker, calls over that raise HashingBusy at once.
+    With no workers configured bcrypt runs on the calling thread
+    """
+
+    def __init__(self, app=None):
+        self.rounds = None
+        self.workers = 0
+        self.timeout = None
+        self._slots = None
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the pool settings from the app config
+        :param app: Flask application
+        :return: None
+        """
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.workers = app.config['PASSWORD_HASHING_WORKERS']
+        self.timeout = app.config['PASSWORD_HASHING_TIMEOUT']
+        self._slots = threading.BoundedSemaphore(
+            self.workers + app.config['PASSWORD_HASHING_QUEUE_SIZE']
+        )
+        atexit.register(self.shutdown)
+
+    def generate(self, password: str) -> str:
+        """
+        Hash a password at the configured cost
+        :param password: plain password
+        :return: hash as str
+        """
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, hashcode, candidate: str) -> bool:
+        """
+        Validate a password against its hash
+        :param hashcode: Bcrypt-hashed password, str or bytes
+        :param candidate: candidate password
+        :return: True if matched, else False
+        """
+        if isinstance(hashcode, bytes):
+            hashcode = hashcode.decode('utf-8')
+        return self._run(check_password, hashcode, candidate)
+
+    def needs_rehash(self, hashcode) -> bool:
+        """
+        Check whether the hash was made at an older cost factor
+        :param hashcode: Bcrypt-hashed password, str or bytes
+        :return: True if the hash should be upgraded
+        """
+        return cost_of(hashcode) < self.rounds
+
+    def shutdown(self):
+        """
+        Stop the pool and wait for its processes, so
+        that none of them outlives the interpreter
+        :return: None
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._executor_pid == os.getpid():
+            executor.shutdown(wait=True)
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise HashingBusy()
+        executor = self._pool()
+        try:
+            future = executor.submit(function, *args)
+        except BrokenExecutor:
+            slots.release()
+            self._discard(executor)
+            raise HashingBusy()
+        except BaseException:
+            slots.release()
+            raise
+        # A running task cannot be cancelled, the slot is
+        # held until it is done, even past the timeout
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingBusy()
+        except BrokenExecutor:
+            # A pool worker died, the next call gets a new pool
+            self._discard(executor)
+            raise HashingBusy()
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        # A broken pool has no live work left. Not waiting leaves
+        # its management thread racing the closed pipes and a
+        # worker process the exit handler then waits on forever
+        executor.shutdown(wait=True)
+
+    def _pool(self):
+        # Imported with the first pool, not at startup
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # A forked worker process must not reuse its parent's pool
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('forkserver'),
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
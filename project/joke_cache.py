@@ -0,0 +1,73 @@
+"""Read-through cache of single Jokes used by /get-joke-by-id"""
+from .lru import LRUCache
+from .lru import invalidate_on_change
+from .models import Joke
+from .models import db
+
+
+class JokeCache:
+    """
+    Bounded LRU map with TTL of (user_id, joke_id) to the User's
+    jokes_version and the Joke content. An entry is dropped whenever
+    its Joke is changed or deleted through the ORM of this process,
+    and ignored once the version moved on in another one
+    """
+
+    def __init__(self, app=None):
+        self.entries = LRUCache()
+        self.enabled = False
+        self.stale = 0
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the cache settings from the app config
+        :param app: Flask application
+        :return: None
+        """
+        self.enabled = app.config['JOKE_CACHE_ENABLED']
+        self.entries.maxsize = app.config['JOKE_CACHE_SIZE']
+        self.entries.ttl = app.config['JOKE_CACHE_TTL']
+        self.entries.clear()
+        if not self._listening:
+            invalidate_on_change(Joke, self._keys_of,
+                                 self.entries.invalidate, 'stale_jokes')
+            self._listening = True
+
+    def get(self, user_id: int, joke_id: int, version: int):
+        """
+        Read-through lookup of the User's Joke content
+        :param user_id: owner's user_id
+        :param joke_id: Joke joke_id
+        :param version: User's current jokes_version, an entry
+        cached under another version is a miss
+        :return: content or None if the User has no such Joke
+        """
+        if self.enabled:
+            cached = self.entries.get((user_id, joke_id))
+            if cached is not None:
+                if cached[0] == version:
+                    return cached[1]
+                self.stale += 1
+
+        row = db.session.query(Joke.content).filter_by(
+            joke_id=joke_id, user_id=user_id).first()
+        if row is None:
+            return None
+
+        if self.enabled:
+            self.entries.put((user_id, joke_id), (version, row.content))
+        return row.content
+
+    def stats(self) -> dict:
+        stats = self.entries.stats()
+        # Stale entries were found by the LRU map but are misses here
+        stats.update(hits=stats['hits'] - self.stale,
+                     misses=stats['misses'] + self.stale, stale=self.stale)
+        return stats
+
+    @staticmethod
+    def _keys_of(joke) -> set:
+        return {(joke.user_id, joke.joke_id)}
@@ -0,0 +1,101 @@
+"""Thread-safe LRU map with optional expiry"""
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Keeps at most 'maxsize' entries, dropping the least recently
+    used one first. Entries older than 'ttl' seconds are treated
+    as absent; a ttl of None keeps them until evicted
+    """
+
+    def __init__(self, maxsize: int = 0, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Look the key up and count a hit or a miss
+        :param key: cache key
+        :param default: returned on a miss
+        :return: cached value or default
+        """
+        with self._lock:
+            value, stored = self._entries.get(key, (MISSING, None))
+            if value is not MISSING and self.ttl is not None \
+                    and time.monotonic() - stored > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                value = MISSING
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return dict(size=len(self._entries), hits=self.hits,
+                    misses=self.misses, evictions=self.evictions,
+                    expirations=self.expirations)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def invalidate_on_change(mapper_class, keys_of, invalidate, info_key):
+    """
+    Hook cache invalidation into the ORM. Keys are dropped
+    when a change is flushed and once more after commit,
+    so a concurrent reader cannot re-cache the old row
+    :param mapper_class: model whose changes are watched
+    :param keys_of: function of the changed instance to its cache keys
+    :param invalidate: function dropping the keys from the cache
+    :param info_key: Session.info key of the keys awaiting commit
+    :return: None
+    """
+    def changed(mapper, connection, target):
+        keys = keys_of(target)
+        invalidate(*keys)
+        session = Session.object_session(target)
+        if session is not None:
+            session.info.setdefault(info_key, set()).update(keys)
+
+    def committed(session):
+        invalidate(*session.info.pop(info_key, ()))
+
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(mapper_class, event_name, changed)
+    event.listen(Session, 'after_commit', committed)
@@ -0,0 +1,156 @@
+"""Retention of the Action log: rollup, archival and pruning"""
+import gzip
+import json
+import logging
+import os
+import time
+from collections import Counter
+from collections import defaultdict
+
+from sqlalchemy import bindparam
+from sqlalchemy import text
+
+from .models import Action
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+UPSERT_ROLLUP = text(
+    'INSERT INTO action_rollup (user_id, action_path, hour, count) '
+    'VALUES (:user_id, :action_path, :hour, :count) '
+    'ON CONFLICT (user_id, action_path, hour) '
+    'DO UPDATE SET count = count + excluded.count'
+).bindparams(bindparam('hour', type_=db.DateTime))
+
+
+def archive_path(archive_dir: str, day) -> str:
+    """
+    Date-partitioned archive file of the day's actions
+    :param archive_dir: archive root
+    :param day: date of the actions
+    :return: path as <root>/YYYY/MM/actions-YYYY-MM-DD.jsonl.gz
+    """
+    return os.path.join(archive_dir, day.strftime('%Y'), day.strftime('%m'),
+                        day.strftime('actions-%Y-%m-%d.jsonl.gz'))
+
+
+def archive_rows(rows: list, archive_dir: str):
+    """
+    Append the rows as JSON lines to the gzip file of their day.
+    Each call adds a gzip member, which readers see as one stream
+    :param rows: Action rows
+    :param archive_dir: archive root
+    :return: None
+    """
+    by_day = defaultdict(list)
+    for row in rows:
+        by_day[row.action_time.date()].append(row)
+
+    for day, day_rows in by_day.items():
+        path = archive_path(archive_dir, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, 'at', encoding='utf-8') as archive:
+            for row in day_rows:
+                archive.write(json.dumps(dict(
+                    action_id=row.action_id,
+                    user_id=row.user_id,
+                    user_ip_address=row.user_ip_address,
+                    action_time=row.action_time.isoformat(),
+                    action_path=row.action_path,
+                )) + '\n')
+            archive.flush()
+            os.fsync(archive.fileno())
+
+
+def rollup_rows(connection, rows: list) -> int:
+    """
+    Add the rows to the per-user, per-path, per-hour counts
+    :param connection: connection in an open transaction
+    :param rows: Action rows
+    :return: number of counts touched
+    """
+    counts = Counter(
+        (row.user_id, row.action_path,
+         row.action_time.replace(minute=0, second=0, microsecond=0))
+        for row in rows
+    )
+    connection.execute(UPSERT_ROLLUP, [
+        dict(user_id=user_id, action_path=path, hour=hour, count=count)
+        for (user_id, path, hour), count in counts.items()
+    ])
+    return len(counts)
+
+
+def maintain_actions(engine, cutoff, archive_dir: str,
+                     chunk_size: int = 5000, pause: float = 0.0) -> dict:
+    """
+    Roll up, archive and delete the Actions older than the cutoff,
+    chunk_size rows at a time. A chunk is archived before its
+    transaction writes, so the write lock is only held for the
+    rollup and the delete. Archiving is at-least-once: a chunk whose
+    transaction fails is archived again on the next run
+    :param engine: SQLAlchemy engine
+    :param cutoff: datetime, older Actions are moved out
+    :param archive_dir: archive root
+    :param chunk_size: rows per transaction
+    :param pause: seconds to sleep between chunks
+    :return: dict of counters
+    """
+    table = Action.__table__
+    stats = Counter(chunks=0, actions=0, rollups=0)
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                table.select()
+                .where(table.c.action_time < cutoff)
+                .order_by(table.c.action_id)
+                .limit(chunk_size)
+            ).fetchall()
+            if not rows:
+                break
+
+            archive_rows(rows, archive_dir)
+            stats['rollups'] += rollup_rows(connection, rows)
+            connection.execute(
+                table.delete()
+                .where(table.c.action_id.between(rows[0].action_id,
+                                                 rows[-1].action_id))
+                .where(table.c.action_time < cutoff)
+            )
+        stats['chunks'] += 1
+        stats['actions'] += len(rows)
+        logger.info('Moved %d actions up to action_id %d',
+                    len(rows), rows[-1].action_id)
+        if pause:
+            time.sleep(pause)
+    return dict(stats)
+
+
+def prune_counts(engine, granularity: str, cutoff,
+                 chunk_size: int = 5000, pause: float = 0.0) -> int:
+    """
+    Delete the pre-aggregated counts of a granularity older
+    than the cutoff, chunk_size rows per transaction
+    :param engine: SQLAlchemy engine
+    :param granularity: 'minute', 'hour' or 'day'
+    :param cutoff: datetime, older buckets are deleted
+    :param chunk_size: rows per transaction
+    :param pause: seconds to sleep between chunks
+    :return: number of deleted counts
+    """
+    statement = text(
+        'DELETE FROM action_count WHERE rowid IN '
+        '(SELECT rowid FROM action_count WHERE granularity = :granularity '
+        'AND bucket < :cutoff LIMIT :chunk_size)'
+    ).bindparams(bindparam('cutoff', type_=db.DateTime))
+    deleted = 0
+    while True:
+        with engine.begin() as connection:
+            result = connection.execute(statement, dict(
+                granularity=granularity, cutoff=cutoff,
+                chunk_size=chunk_size))
+        deleted += result.rowcount
+        if result.rowcount < chunk_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,348 @@
+"""Request metrics in the Prometheus text exposition format"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g
+from flask import has_request_context
+from flask import request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PHASES = ('auth', 'db', 'hashing', 'remote', 'serialization', 'action_log')
+
+HELP = {
+    'http_requests_total': ('counter', 'Requests by route, method and status'),
+    'http_request_duration_seconds': ('histogram',
+                                      'Request latency by route'),
+    'http_request_phase_seconds': ('histogram',
+                                   'Time spent per phase of a request'),
+    'db_queries_total': ('counter', 'SQL statements run by route'),
+    'prefetch_buffered_jokes': ('gauge', 'Prefetched jokes by source'),
+    'prefetch_imports_total': ('counter',
+                               'Imports served from the buffer or live'),
+    'prefetch_refills_total': ('counter',
+                               'Jokes prefetched and failed prefetches'),
+}
+
+
+class Metrics:
+    """
+    Counters and histograms of the requests of this process.
+    With METRICS_DIR set, every process writes its values to a
+    file there each METRICS_SYNC_INTERVAL seconds and render()
+    sums the files of all of them. A file not written for
+    METRICS_STALE_AFTER seconds is of an exited worker or an
+    earlier run: render() skips it and the next app started
+    removes it, a drop Prometheus takes as a counter reset
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.buckets = ()
+        self.directory = None
+        self.sync_interval = 5.0
+        self.stale_after = 60.0
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._path = None
+        self._path_pid = None
+        self._hooked = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the settings from the app config and
+        time every request, query and JSON response
+        :param app: Flask application
+        :return: None
+        """
+        self.enabled = app.config['METRICS_ENABLED']
+        self.buckets = tuple(app.config['METRICS_BUCKETS'])
+        self.directory = app.config['METRICS_DIR']
+        self.sync_interval = app.config['METRICS_SYNC_INTERVAL']
+        self.stale_after = app.config['METRICS_STALE_AFTER']
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.expire()
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+        if not self._hooked:
+            app.before_request(self._start_request)
+            app.after_request(self._end_request)
+            app.json_encoder = timed_json_encoder(self)
+            event.listen(Engine, 'before_cursor_execute', self._start_query)
+            event.listen(Engine, 'after_cursor_execute', self._end_query)
+            atexit.register(self.dump)
+            self._hooked = True
+
+    def inc(self, name: str, labels: tuple, amount: float = 1.0):
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0.0) + amount
+
+    def observe(self, name: str, labels: tuple, value: float):
+        """
+        Add a value to a histogram
+        :param name: metric name
+        :param labels: tuple of (label, value) pairs
+        :param value: observed value
+        :return: None
+        """
+        with self._lock:
+            key = (name, labels)
+            counts = self.histograms.get(key)
+            if counts is None:
+                # One count per bucket, then +Inf, sum and count
+                counts = self.histograms[key] = \
+                    [0] * (len(self.buckets) + 1) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-3] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def timed(self, phase: str):
+        """
+        Add the time spent in the block to a phase
+        of the current request, if there is one
+        :param phase: one of PHASES
+        :return: context manager
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.perf_counter() - started)
+
+    def add_phase(self, phase: str, seconds: float):
+        if self.enabled and has_request_context() and 'phases' in g:
+            g.phases[phase] = g.phases.get(phase, 0.0) + seconds
+
+    def add_collector(self, collector):
+        """
+        Add values kept elsewhere to every snapshot
+        :param collector: function returning a list of
+        (name, labels, value), summed over the workers
+        :return: None
+        """
+        self.collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        collected = [[name, list(labels), value]
+                     for collector in self.collectors
+                     for name, labels, value in collector()]
+        with self._lock:
+            return dict(
+                buckets=list(self.buckets),
+                counters=[[name, list(labels), value] for (name, labels),
+                          value in self.counters.items()] + collected,
+                histograms=[[name, list(labels), list(counts)]
+                            for (name, labels), counts
+                            in self.histograms.items()],
+            )
+
+    def dump(self):
+        """
+        Write this process' values for the other workers to sum
+        :return: None
+        """
+        if not self.directory:
+            return
+        path = self.path()
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(temporary, path)
+
+    def path(self) -> str:
+        """
+        File of this process, named by its pid and start time
+        so that a worker given a reused pid does not take over
+        the file of the exited one
+        :return: path in the metrics directory
+        """
+        if self._path_pid != os.getpid():
+            self._path = os.path.join(self.directory, 'metrics-%d-%d.json' % (
+                os.getpid(), time.time_ns()))
+            self._path_pid = os.getpid()
+        return self._path
+
+    def expire(self) -> int:
+        """
+        Remove the files, and leftover temporary files,
+        not written for stale_after seconds
+        :return: number of files removed
+        """
+        removed = 0
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*')):
+            if self._is_stale(path):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    continue
+        return removed
+
+    def collect(self) -> tuple:
+        """
+        Sum this process' values and those the other
+        workers wrote, skipping stale files
+        :return: (counters, histograms) dicts
+        """
+        snapshots = [self.snapshot()]
+        if self.directory:
+            own = self.path()
+            for path in glob.glob(os.path.join(self.directory,
+                                               'metrics-*.json')):
+                if path == own or self._is_stale(path):
+                    continue
+                try:
+                    with open(path) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    continue
+
+        counters, histograms = {}, {}
+        for snapshot in snapshots:
+            # Histograms of a different bucket layout cannot be summed
+            same_buckets = snapshot['buckets'] == list(self.buckets)
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0.0) + value
+            for name, labels, counts in snapshot['histograms']:
+                if not same_buckets:
+                    continue
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.setdefault(key, [0] * len(counts))
+                for index, value in enumerate(counts):
+                    total[index] += value
+        return counters, histograms
+
+    def render(self) -> str:
+        """
+        All metrics of all workers in the text exposition format
+        :return: text/plain; version=0.0.4 body
+        """
+        counters, histograms = self.collect()
+        lines = []
+        for name, (kind, description) in HELP.items():
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(sample(name, labels, value))
+            for (metric, labels), counts in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                bounds = [repr(float(bound)) for bound in self.buckets]
+                for bound, count in zip(bounds + ['+Inf'], counts):
+                    lines.append(sample(name + '_bucket', labels + (
+                        ('le', bound),), count))
+                lines.append(sample(name + '_sum', labels, counts[-2]))
+                lines.append(sample(name + '_count', labels, counts[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def _start_request(self):
+        if self.enabled:
+            g.phases = {}
+            g.queries = 0
+            g.request_started = time.perf_counter()
+
+    def _end_request(self, response):
+        if not self.enabled or 'request_started' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        self.inc('http_requests_total', (
+            ('route', route), ('method', request.method),
+            ('status', str(response.status_code))))
+        self.observe('http_request_duration_seconds',
+                     (('route', route),), elapsed)
+        for phase, seconds in g.phases.items():
+            self.observe('http_request_phase_seconds',
+                         (('route', route), ('phase', phase)), seconds)
+        if g.queries:
+            self.inc('db_queries_total', (('route', route),), g.queries)
+        self._ensure_dumper()
+        return response
+
+    def _start_query(self, connection, cursor, statement, parameters,
+                     context, executemany):
+        if self.enabled and has_request_context() and 'phases' in g:
+            connection.info.setdefault('query_started', []).append(
+                time.perf_counter())
+
+    def _end_query(self, connection, cursor, statement, parameters,
+                   context, executemany):
+        started = connection.info.get('query_started')
+        if started and has_request_context() and 'phases' in g:
+            self.add_phase('db', time.perf_counter() - started.pop())
+            g.queries += 1
+
+    def _is_stale(self, path: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(path) > self.stale_after
+        except OSError:
+            return False
+
+    def _ensure_dumper(self):
+        # Threads do not survive a fork, start one per process
+        if not self.directory or (
+                self._pid == os.getpid() and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='metrics-dumper', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            self.dump()
+
+
+def sample(name: str, labels: tuple, value) -> str:
+    """
+    One exposition line
+    :param name: sample name
+    :param labels: tuple of (label, value) pairs
+    :param value: number
+    :return: line without the newline
+    """
+    if labels:
+        name += '{%s}' % ','.join(
+            '%s="%s"' % (label, str(text).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+            for label, text in labels)
+    return '%s %s' % (name, repr(float(value)))
+
+
+def timed_json_encoder(metrics: Metrics):
+    """
+    JSON encoder of the app that times serialization
+    :param metrics: Metrics the time is added to
+    :return: JSONEncoder subclass
+    """
+    class TimedJSONEncoder(JSONEncoder):
+        def encode(self, value):
+            with metrics.timed('serialization'):
+                return super().encode(value)
+
+    return TimedJSONEncoder
@@ -0,0 +1,321 @@
+"""Versioned schema migrations of the database"""
+import logging
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from .analytics import ALL_USERS
+from .models import ActionCount
+from .models import ActionRollup
+from .models import JokeBand
+from .models import RevokedToken
+from .models import SchemaMigration
+from .models import content_digest
+from .models import index_minhash
+from .minhash import signature
+from .search import create_search_index
+
+logger = logging.getLogger(__name__)
+
+Migration = namedtuple('Migration', ['version', 'description', 'upgrade'])
+
+MIGRATIONS = []
+
+
+def migration(version: int, description: str):
+    """
+    Register the decorated function as a migration. It gets a
+    connection in an open transaction and must tolerate a schema
+    that db.create_all() already built at the latest models
+    :param version: unique, increasing version number
+    :param description: one line recorded with the version
+    :return: decorator
+    """
+    def register(function):
+        MIGRATIONS.append(Migration(version, description, function))
+        MIGRATIONS.sort(key=lambda item: item.version)
+        return function
+    return register
+
+
+def column_names(connection, table: str) -> set:
+    """
+    Names of the columns the table has in the database
+    :param connection: SQLAlchemy connection
+    :param table: table name
+    :return: set of column names
+    """
+    return {column['name']
+            for column in inspect(connection).get_columns(table)}
+
+
+def applied_versions(engine) -> set:
+    """
+    Versions recorded in the schema_migration table
+    :param engine: SQLAlchemy engine
+    :return: set of version numbers
+    """
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+    table = SchemaMigration.__table__
+    return {row.version for row in engine.execute(table.select())}
+
+
+def pending_migrations(engine) -> list:
+    """
+    Migrations not applied to the database yet, in order
+    :param engine: SQLAlchemy engine
+    :return: list of Migration
+    """
+    applied = applied_versions(engine)
+    return [item for item in MIGRATIONS if item.version not in applied]
+
+
+def schema_is_current(engine, metadata=None) -> bool:
+    """
+    Whether every migration is recorded and every table of the
+    metadata exists, in two queries, so that a starting worker
+    can skip upgrade_schema()
+    :param engine: SQLAlchemy engine
+    :param metadata: MetaData of the models, tables are not
+    checked if None
+    :return: False for a new or outdated database
+    """
+    table = SchemaMigration.__table__
+    try:
+        applied = {row.version
+                   for row in engine.execute(select([table.c.version]))}
+    except OperationalError:
+        # No schema_migration table yet
+        return False
+    if metadata is not None:
+        tables = {row.name for row in engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if not set(metadata.tables) <= tables:
+            return False
+    return all(item.version in applied for item in MIGRATIONS)
+
+
+@contextmanager
+def write_locked(engine):
+    """
+    Transaction holding the database write lock from its start,
+    other workers wait for it to end before they read
+    :param engine: SQLAlchemy engine
+    :return: context manager of the connection
+    """
+    with engine.begin() as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        yield connection
+
+
+def upgrade_schema(engine, metadata=None) -> list:
+    """
+    Create the missing tables of the metadata, then apply and
+    record every pending migration, each step in a write_locked()
+    transaction that reads the applied versions again. Workers
+    starting together on a new database take turns and skip
+    what another one already did
+    :param engine: SQLAlchemy engine
+    :param metadata: MetaData of the models, no tables are
+    created if None
+    :return: list of the Migration applied by this call
+    """
+    if metadata is not None:
+        with write_locked(engine) as connection:
+            metadata.create_all(connection)
+
+    table = SchemaMigration.__table__
+    applied = []
+    for item in MIGRATIONS:
+        with write_locked(engine) as connection:
+            table.create(connection, checkfirst=True)
+            if connection.execute(select([table.c.version]).where(
+                    table.c.version == item.version)).first():
+                continue
+            logger.info('Applying migration %d: %s',
+                        item.version, item.description)
+            item.upgrade(connection)
+            connection.execute(table.insert(), dict(
+                version=item.version,
+                description=item.description,
+                applied_at=datetime.now(),
+            ))
+        applied.append(item)
+    return applied
+
+
+@migration(1, 'Add user.joke_count')
+def add_joke_count(connection):
+    if 'joke_count' in column_names(connection, 'user'):
+        return
+    connection.execute(
+        'ALTER TABLE user ADD COLUMN '
+        'joke_count INTEGER NOT NULL DEFAULT 0'
+    )
+    connection.execute(
+        'UPDATE user SET joke_count = '
+        '(SELECT COUNT(*) FROM joke WHERE joke.user_id = user.id)'
+    )
+
+
+@migration(2, 'Add user.jokes_version')
+def add_jokes_version(connection):
+    if 'jokes_version' in column_names(connection, 'user'):
+        return
+    connection.execute(
+        'ALTER TABLE user ADD COLUMN '
+        'jokes_version INTEGER NOT NULL DEFAULT 0'
+    )
+
+
+@migration(3, 'Add joke.content_hash with a unique index')
+def add_content_hash(connection):
+    if 'content_hash' in column_names(connection, 'joke'):
+        return
+    connection.execute('ALTER TABLE joke ADD COLUMN content_hash VARCHAR(64)')
+    backfill_content_hash(connection)
+    connection.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_joke_content_hash '
+        'ON joke (content_hash)'
+    )
+
+
+def backfill_content_hash(connection):
+    """
+    Fill in joke.content_hash for existing rows.
+    Jokes that duplicate an older Joke keep a NULL hash,
+    since the unique index could not be built otherwise
+    :param connection: connection in an open transaction
+    :return: None
+    """
+    seen = set()
+    rows = connection.execute(
+        'SELECT joke_id, content FROM joke ORDER BY joke_id'
+    ).fetchall()
+    for joke_id, content in rows:
+        if content is None:
+            continue
+        digest = content_digest(content)
+        if digest in seen:
+            logger.warning('Joke %d duplicates an older joke', joke_id)
+            continue
+        seen.add(digest)
+        connection.execute(
+            'UPDATE joke SET content_hash = ? WHERE joke_id = ?',
+            (digest, joke_id)
+        )
+
+
+@migration(4, 'Index jokes and actions by user')
+def add_user_indexes(connection):
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_joke_user_id_joke_id '
+        'ON joke (user_id, joke_id)'
+    )
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_action_user_id_action_time '
+        'ON action (user_id, action_time)'
+    )
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS ix_action_action_time '
+        'ON action (action_time)'
+    )
+
+
+@migration(5, 'Add action_rollup')
+def add_action_rollup(connection):
+    ActionRollup.__table__.create(connection, checkfirst=True)
+
+
+# strftime() formats truncating a stored DateTime to a bucket
+BUCKET_FORMATS = {
+    'minute': '%Y-%m-%d %H:%M:00.000000',
+    'hour': '%Y-%m-%d %H:00:00.000000',
+    'day': '%Y-%m-%d 00:00:00.000000',
+}
+
+
+@migration(6, 'Add action_count and count the logged actions')
+def add_action_count(connection):
+    ActionCount.__table__.create(connection, checkfirst=True)
+    if connection.execute('SELECT 1 FROM action_count LIMIT 1').first():
+        return
+
+    # Archived actions only survive as hourly rollups,
+    # they are counted in the hour and day buckets
+    for granularity, bucket_format in BUCKET_FORMATS.items():
+        rolled_up = '' if granularity == 'minute' else (
+            'UNION ALL SELECT user_id, hour, action_path, count '
+            'FROM action_rollup'
+        )
+        for user_column in ('user_id', str(ALL_USERS)):
+            connection.execute(
+                'INSERT INTO action_count '
+                '(granularity, user_id, bucket, action_path, count) '
+                'SELECT ?, %s, strftime(?, moment), action_path, SUM(n) '
+                'FROM (SELECT user_id, action_time AS moment, action_path, '
+                '1 AS n FROM action %s) '
+                'GROUP BY 2, 3, 4' % (user_column, rolled_up),
+                (granularity, bucket_format)
+            )
+
+
+@migration(7, 'Add the joke_search full-text index')
+def add_joke_search(connection):
+    create_search_index(connection)
+    connection.execute(
+        "INSERT INTO joke_search (joke_search) VALUES ('rebuild')")
+
+
+@migration(8, 'Add joke.minhash and the joke_band LSH index')
+def add_minhash(connection):
+    if 'minhash' not in column_names(connection, 'joke'):
+        connection.execute('ALTER TABLE joke ADD COLUMN minhash BLOB')
+    JokeBand.__table__.create(connection, checkfirst=True)
+    backfill_minhash(connection)
+
+
+def backfill_minhash(connection):
+    """
+    Sign and index the Jokes that have no signature yet
+    :param connection: connection in an open transaction
+    :return: None
+    """
+    rows = connection.execute(
+        'SELECT joke_id, content FROM joke '
+        'WHERE minhash IS NULL AND content IS NOT NULL'
+    ).fetchall()
+    for joke_id, content in rows:
+        minhash = signature(content)
+        if minhash is None:
+            continue
+        connection.execute('UPDATE joke SET minhash = ? WHERE joke_id = ?',
+                           (minhash, joke_id))
+        index_minhash(connection, joke_id, minhash)
+
+
+@migration(9, 'Add revoked_token')
+def add_revoked_token(connection):
+    RevokedToken.__table__.create(connection, checkfirst=True)
+
+
+@migration(10, 'Never reuse the ids of pruned revoked_token rows')
+def autoincrement_revoked_token(connection):
+    # SQLite cannot add AUTOINCREMENT to a table, it is rebuilt
+    schema = connection.execute(
+        "SELECT sql FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'revoked_token'").scalar()
+    if schema is not None and 'AUTOINCREMENT' in schema.upper():
+        return
+    connection.execute('DROP INDEX IF EXISTS ix_revoked_token_expires')
+    connection.execute(
+        'ALTER TABLE revoked_token RENAME TO revoked_token_old')
+    RevokedToken.__table__.create(connection)
+    connection.execute(
+        'INSERT INTO revoked_token (id, jti, expires) '
+        'SELECT id, jti, expires FROM revoked_token_old')
+    connection.execute('DROP TABLE revoked_token_old')
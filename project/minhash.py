@@ -0,0 +1,96 @@
+"""MinHash signatures of Joke content and their LSH band buckets"""
+import hashlib
+import random
+import struct
+import unicodedata
+import zlib
+
+# Characters per shingle
+SHINGLE_SIZE = 4
+# Hash functions per signature, split into BANDS bands of ROWS values.
+# Two jokes of Jaccard similarity s share a band with probability
+# 1 - (1 - s ** ROWS) ** BANDS: 0.99 at s = 0.7, 0.12 at s = 0.3.
+# Changing these invalidates the stored signatures
+PERMUTATIONS = 64
+BANDS = 16
+ROWS = PERMUTATIONS // BANDS
+
+# Universal hashing h(x) = (a * x + b) mod PRIME, one (a, b) per
+# permutation, seeded so every process computes the same signature
+PRIME = (1 << 61) - 1
+_random = random.Random(20200530)
+COEFFICIENTS = [(_random.randrange(1, PRIME), _random.randrange(PRIME))
+                for _ in range(PERMUTATIONS)]
+
+SIGNATURE_FORMAT = '<%dI' % PERMUTATIONS
+
+
+def normalize(content: str) -> str:
+    """
+    Drop what rewording tends to change: case,
+    punctuation, compatibility forms and spacing
+    :param content: Joke text
+    :return: lower-case words separated by single spaces
+    """
+    content = unicodedata.normalize('NFKC', content).casefold()
+    return ' '.join(''.join(
+        character if character.isalnum() else ' '
+        for character in content
+    ).split())
+
+
+def shingles(content: str) -> set:
+    """
+    Hashes of the overlapping character SHINGLE_SIZE-grams
+    of the normalized content, or of all of it if shorter
+    :param content: Joke text
+    :return: set of 32-bit hashes, empty if there are no words
+    """
+    text = normalize(content).encode('utf-8')
+    if not text:
+        return set()
+    if len(text) <= SHINGLE_SIZE:
+        return {zlib.crc32(text)}
+    return {zlib.crc32(text[start:start + SHINGLE_SIZE])
+            for start in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def signature(content: str):
+    """
+    MinHash signature of the content, packed for storage
+    :param content: Joke text
+    :return: bytes, or None if the content has no words
+    """
+    hashes = shingles(content or '')
+    if not hashes:
+        return None
+    return struct.pack(SIGNATURE_FORMAT, *(
+        min((a * value + b) % PRIME for value in hashes) & 0xFFFFFFFF
+        for a, b in COEFFICIENTS
+    ))
+
+
+def similarity(first: bytes, second: bytes) -> float:
+    """
+    Estimated Jaccard similarity of two signatures
+    :param first: packed signature
+    :param second: packed signature
+    :return: share of equal values, 0.0 to 1.0
+    """
+    pairs = zip(struct.unpack(SIGNATURE_FORMAT, first),
+                struct.unpack(SIGNATURE_FORMAT, second))
+    return sum(left == right for left, right in pairs) / PERMUTATIONS
+
+
+def band_buckets(packed: bytes) -> list:
+    """
+    LSH bucket of every band of the signature, jokes
+    sharing any bucket are near-duplicate candidates
+    :param packed: packed signature
+    :return: BANDS distinct non-negative 63-bit integers
+    """
+    width = ROWS * 4
+    return [int.from_bytes(hashlib.blake2b(
+        bytes([band]) + packed[band * width:(band + 1) * width],
+        digest_size=8).digest(), 'little') >> 1
+        for band in range(BANDS)]
@@ -1,4 +1,26 @@
+import hashlib
+import unicodedata
+
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy.orm import validates
+
 from . import db
+from .minhash import band_buckets
+from .minhash import signature
+
+
+def content_digest(content: str) -> str:
+    """
+    SHA-256 of the Joke content normalized for duplicate
+    detection: NFKC form, case-folded, whitespace collapsed
+    :param content: Joke text
+    :return: 64 hex characters
+    """
+    normalized = ' '.join(
+        unicodedata.normalize('NFKC', content).casefold().split()
+    )
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
 
 
 class User(db.Model):
@@ -6,6 +28,12 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)
     password = db.Column(db.String(100), nullable=False)
+    # Denormalized number of the User's Jokes, see reserve_joke_slot()
+    joke_count = db.Column(db.Integer, nullable=False,
+                           default=0, server_default='0')
+    # Bumped on every change to the User's Jokes, served as ETag
+    jokes_version = db.Column(db.Integer, nullable=False,
+                              default=0, server_default='0')
     jokes = db.relationship('Joke', backref='user',
                             lazy=True, cascade='all, delete')
     actions = db.relationship('Action', backref='user',
@@ -17,18 +45,123 @@ class User(db.Model):
 
 class Joke(db.Model):
     """Table of Users' Jokes w/ many-to-one relationship w/ User"""
+    __table_args__ = (
+        # A User's Jokes in joke_id order, for /my-jokes pages
+        db.Index('ix_joke_user_id_joke_id', 'user_id', 'joke_id'),
+    )
     joke_id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text)
+    # Kept in step with content, see set_content_hash()
+    content_hash = db.Column(db.String(64), unique=True, index=True)
+    # MinHash signature of content, see project.minhash
+    minhash = db.Column(db.LargeBinary)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
                         nullable=False)
 
+    @validates('content')
+    def set_content_hash(self, key, content):
+        self.content_hash = None if content is None \
+            else content_digest(content)
+        self.minhash = None if content is None else signature(content)
+        return content
+
     def __repr__(self):
         return '<Joke %r>; of user %r' % (self.content, self.user_id)
 
 
+@event.listens_for(Joke, 'after_delete')
+def release_joke_slot(mapper, connection, target):
+    """
+    Decrement the owner's joke_count in the same
+    transaction that deletes the Joke
+    """
+    connection.execute(
+        User.__table__.update()
+        .where(User.id == target.user_id)
+        .where(User.joke_count > 0)
+        .values(joke_count=User.joke_count - 1,
+                jokes_version=User.jokes_version + 1)
+    )
+
+
+@event.listens_for(Joke, 'after_update')
+def bump_jokes_version(mapper, connection, target):
+    """
+    Invalidate the owner's ETag in the same
+    transaction that changes the Joke
+    """
+    connection.execute(
+        User.__table__.update()
+        .where(User.id == target.user_id)
+        .values(jokes_version=User.jokes_version + 1)
+    )
+
+
+class JokeBand(db.Model):
+    """Table of LSH band buckets of Jokes' MinHash signatures,
+    see project.near_duplicates"""
+    bucket = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    joke_id = db.Column(db.Integer, db.ForeignKey('joke.joke_id'),
+                        primary_key=True, index=True)
+
+    def __repr__(self):
+        return '<JokeBand %r> of joke_id %r' % (self.bucket, self.joke_id)
+
+
+def index_minhash(connection, joke_id: int, minhash):
+    """
+    Put the Joke into the buckets of its signature
+    :param connection: connection in the transaction writing the Joke
+    :param joke_id: Joke identity
+    :param minhash: packed signature or None
+    :return: None
+    """
+    index_minhashes(connection, [(joke_id, minhash)])
+
+
+def index_minhashes(connection, jokes: list):
+    """
+    Put several Jokes into their buckets with one statement
+    :param connection: connection in the transaction writing them
+    :param jokes: list of (joke_id, packed signature or None)
+    :return: None
+    """
+    rows = [dict(bucket=bucket, joke_id=joke_id)
+            for joke_id, minhash in jokes if minhash is not None
+            for bucket in band_buckets(minhash)]
+    if rows:
+        connection.execute(JokeBand.__table__.insert(), rows)
+
+
+def unindex_minhash(connection, joke_id: int):
+    connection.execute(
+        JokeBand.__table__.delete().where(JokeBand.joke_id == joke_id))
+
+
+@event.listens_for(Joke, 'after_insert')
+def add_joke_bands(mapper, connection, target):
+    index_minhash(connection, target.joke_id, target.minhash)
+
+
+@event.listens_for(Joke, 'after_update')
+def replace_joke_bands(mapper, connection, target):
+    if inspect(target).attrs.minhash.history.has_changes():
+        unindex_minhash(connection, target.joke_id)
+        index_minhash(connection, target.joke_id, target.minhash)
+
+
+@event.listens_for(Joke, 'after_delete')
+def remove_joke_bands(mapper, connection, target):
+    unindex_minhash(connection, target.joke_id)
+
+
 class Action(db.Model):
     """Table of logged Actions performed by registered Users
     w/ many-to-one relationship w/ User"""
+    __table_args__ = (
+        db.Index('ix_action_user_id_action_time', 'user_id', 'action_time'),
+        db.Index('ix_action_action_time', 'action_time'),
+    )
     action_id = db.Column(db.Integer, primary_key=True)
     user_ip_address = db.Column(db.String, nullable=False)
     action_time = db.Column(db.DateTime, nullable=False)
@@ -39,3 +172,56 @@ class Action(db.Model):
     def __repr__(self):
         return '<Action by user_id %r> registered at %r' % \
                (self.user_id, self.action_time)
+
+
+class ActionRollup(db.Model):
+    """Table of hourly counts of Actions moved out of the Action table,
+    see project.maintenance"""
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    action_path = db.Column(db.String, primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<ActionRollup of user_id %r> %r at %r: %r' % \
+               (self.user_id, self.action_path, self.hour, self.count)
+
+
+class ActionCount(db.Model):
+    """Table of Action counts per minute, hour and day bucket,
+    maintained as Actions are logged, see project.analytics"""
+    granularity = db.Column(db.String(6), primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    action_path = db.Column(db.String, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<ActionCount of user_id %r> %r per %s at %r: %r' % \
+               (self.user_id, self.action_path, self.granularity,
+                self.bucket, self.count)
+
+
+class RevokedToken(db.Model):
+    """Table of revoked JWTs until they expire,
+    see project.revocation"""
+    # Workers pick up revocations past the last id they saw, so ids
+    # of pruned rows must not be handed out again
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<RevokedToken %r> until %r' % (self.jti, self.expires)
+
+
+class SchemaMigration(db.Model):
+    """Table of applied schema migrations, see project.migrations"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<SchemaMigration %r> applied at %r' % \
+               (self.version, self.applied_at)
@@ -0,0 +1,107 @@
+"""Near-duplicate Jokes found through their LSH band buckets"""
+from .minhash import band_buckets
+from .minhash import similarity
+from .models import Joke
+from .models import JokeBand
+
+
+def find_near_duplicate(session, minhash, threshold: float,
+                        exclude: int = None, before: int = None):
+    """
+    The most similar Joke sharing a band bucket with the
+    signature, one index lookup per band plus the candidates
+    :param session: SQLAlchemy session
+    :param minhash: packed signature or None
+    :param threshold: least estimated Jaccard similarity, 0.0 to 1.0
+    :param exclude: joke_id never reported, the Joke itself on update
+    :param before: only consider Jokes of a lower joke_id if given
+    :return: (joke_id, similarity) or None
+    """
+    if minhash is None:
+        return None
+
+    candidates = session.query(Joke.joke_id, Joke.minhash).filter(
+        Joke.joke_id.in_(
+            session.query(JokeBand.joke_id).filter(
+                JokeBand.bucket.in_(band_buckets(minhash)))
+        ))
+    if exclude is not None:
+        candidates = candidates.filter(Joke.joke_id != exclude)
+    if before is not None:
+        candidates = candidates.filter(Joke.joke_id < before)
+
+    best = None
+    for joke_id, other in candidates:
+        if other is None:
+            continue
+        score = similarity(minhash, other)
+        if score >= threshold and (best is None or score > best[1]):
+            best = (joke_id, score)
+    return best
+
+
+def find_near_duplicates(session, minhashes: list, threshold: float,
+                         chunk_size: int = 500) -> list:
+    """
+    find_near_duplicate() of several signatures at once,
+    with one query per 'chunk_size' band buckets
+    :param session: SQLAlchemy session
+    :param minhashes: list of packed signatures or None
+    :param threshold: least estimated Jaccard similarity, 0.0 to 1.0
+    :param chunk_size: bound parameters per query
+    :return: list of (joke_id, similarity) or None, in order
+    """
+    wanted = {}
+    for position, minhash in enumerate(minhashes):
+        if minhash is not None:
+            for bucket in band_buckets(minhash):
+                wanted.setdefault(bucket, []).append(position)
+
+    buckets = list(wanted)
+    candidates = {}
+    for start in range(0, len(buckets), chunk_size):
+        rows = session.query(
+            JokeBand.bucket, Joke.joke_id, Joke.minhash
+        ).join(Joke, Joke.joke_id == JokeBand.joke_id).filter(
+            JokeBand.bucket.in_(buckets[start:start + chunk_size]))
+        for bucket, joke_id, other in rows:
+            for position in wanted[bucket]:
+                candidates.setdefault(position, {})[joke_id] = other
+
+    found = []
+    for position, minhash in enumerate(minhashes):
+        best = None
+        for joke_id, other in candidates.get(position, {}).items():
+            if other is None:
+                continue
+            score = similarity(minhash, other)
+            if score >= threshold and (best is None or score > best[1]):
+                best = (joke_id, score)
+        found.append(best)
+    return found
+
+
+def near_duplicates_in_catalogue(session, threshold: float,
+                                 batch_size: int = 500):
+    """
+    Walk the catalogue in joke_id order and report every Joke
+    that nearly duplicates an older one. The caller may delete
+    the reported Joke before asking for the next one
+    :param session: SQLAlchemy session
+    :param threshold: least estimated Jaccard similarity
+    :param batch_size: Jokes read at a time
+    :return: generator of (joke_id, original joke_id, similarity)
+    """
+    after = 0
+    while True:
+        batch = session.query(Joke.joke_id, Joke.minhash).filter(
+            Joke.joke_id > after).order_by(Joke.joke_id).limit(
+            batch_size).all()
+        if not batch:
+            return
+        for joke_id, minhash in batch:
+            found = find_near_duplicate(session, minhash, threshold,
+                                        before=joke_id)
+            if found is not None:
+                yield (joke_id,) + found
+        after = batch[-1].joke_id
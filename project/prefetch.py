@@ -0,0 +1,212 @@
+"""Buffers of prefetched jokes for /import-joke"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class SourceBuffer:
+    """Prefetched jokes of one source and their counters"""
+
+    def __init__(self, size: int, low_water: int,
+                 idle_timeout: float = None):
+        self.size = size
+        self.low_water = low_water
+        self.idle_timeout = idle_timeout
+        self.jokes = deque(maxlen=size or None)
+        self.active = False
+        self.last_demand = 0.0
+        self.failures = 0
+        self.retry_at = 0.0
+        self.hits = 0
+        self.fallbacks = 0
+        self.refills = 0
+        self.refill_errors = 0
+        self.refill_seconds = 0.0
+        self.refill_seconds_max = 0.0
+
+    @property
+    def needs_refill(self) -> bool:
+        # Nobody asked for a joke for idle_timeout, stop refilling
+        return self.active and len(self.jokes) <= self.low_water and (
+            self.idle_timeout is None or
+            time.monotonic() - self.last_demand <= self.idle_timeout)
+
+    @property
+    def refill_due(self) -> bool:
+        return self.needs_refill and time.monotonic() >= self.retry_at
+
+    def stats(self) -> dict:
+        served = self.hits + self.fallbacks
+        return dict(
+            buffered=len(self.jokes),
+            hits=self.hits,
+            fallbacks=self.fallbacks,
+            hit_rate=self.hits / served if served else 0.0,
+            refills=self.refills,
+            refill_errors=self.refill_errors,
+            refill_seconds_avg=(self.refill_seconds / self.refills
+                                if self.refills else 0.0),
+            refill_seconds_max=self.refill_seconds_max,
+            failures=self.failures,
+        )
+
+
+class JokePrefetcher:
+    """
+    Keeps up to 'buffer_size' jokes of every FOREIGN_API source.
+    A background thread tops a buffer up to its size once it
+    drops to 'low_water'. Buffers start filling the first time
+    their source is asked for a joke and stop once it has not
+    been asked for PREFETCH_IDLE_TIMEOUT seconds. After a failed
+    refill the source is left alone for PREFETCH_ERROR_BACKOFF
+    seconds, doubled on every failure in a row up to
+    PREFETCH_ERROR_BACKOFF_MAX. A source with a buffer_size
+    of 0 is always fetched live
+    """
+
+    def __init__(self, foreign_apis):
+        self.foreign_apis = foreign_apis
+        self.error_backoff = 1.0
+        self.error_backoff_max = 60.0
+        self.idle_timeout = None
+        self.buffers = {}
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        """
+        Make a buffer per source, foreign_apis must be set up first
+        :param app: Flask application
+        :return: None
+        """
+        self.error_backoff = app.config['PREFETCH_ERROR_BACKOFF']
+        self.error_backoff_max = app.config['PREFETCH_ERROR_BACKOFF_MAX']
+        self.idle_timeout = app.config['PREFETCH_IDLE_TIMEOUT']
+        self.buffers = {
+            name: SourceBuffer(settings['buffer_size'],
+                               settings['low_water'], self.idle_timeout)
+            for name, settings in self.foreign_apis.settings.items()
+        }
+
+    def fetch_joke(self, source: str) -> str:
+        """
+        Pop a prefetched joke or fetch one live if the buffer is empty
+        :param source: FOREIGN_API key
+        :return: joke text
+        :raise ForeignApiError: if the live fetch failed
+        """
+        buffer = self.buffers[source]
+        if not buffer.size:
+            return self.foreign_apis.fetch_joke(source)
+
+        buffer.active = True
+        buffer.last_demand = time.monotonic()
+        try:
+            content = buffer.jokes.popleft()
+        except IndexError:
+            buffer.fallbacks += 1
+            self._request_refill()
+            return self.foreign_apis.fetch_joke(source)
+
+        buffer.hits += 1
+        if buffer.needs_refill:
+            self._request_refill()
+        return content
+
+    def stats(self) -> dict:
+        """
+        Counters of every buffer
+        :return: dict of source name to its counters
+        """
+        return {name: buffer.stats() for name, buffer in self.buffers.items()}
+
+    def samples(self) -> list:
+        """
+        Counters of every buffer for project.metrics
+        :return: list of (metric name, labels, value)
+        """
+        samples = []
+        for name, buffer in self.buffers.items():
+            if not buffer.size:
+                continue
+            source = (('source', name),)
+            samples += [
+                ('prefetch_buffered_jokes', source, len(buffer.jokes)),
+                ('prefetch_imports_total', source + (('outcome', 'hit'),),
+                 buffer.hits),
+                ('prefetch_imports_total',
+                 source + (('outcome', 'fallback'),), buffer.fallbacks),
+                ('prefetch_refills_total', source + (('outcome', 'ok'),),
+                 buffer.refills),
+                ('prefetch_refills_total', source + (('outcome', 'error'),),
+                 buffer.refill_errors),
+            ]
+        return samples
+
+    def _request_refill(self):
+        self._ensure_refiller()
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _ensure_refiller(self):
+        # Threads do not survive a fork, start one per process
+        with self._wakeup:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='joke-prefetcher', daemon=True
+            )
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                self._wakeup.wait_for(self._any_refill_due,
+                                      timeout=self._next_retry_in())
+            for name, buffer in list(self.buffers.items()):
+                if buffer.refill_due:
+                    self._refill(name, buffer)
+
+    def _any_refill_due(self) -> bool:
+        return any(buffer.refill_due for buffer in self.buffers.values())
+
+    def _next_retry_in(self):
+        # Seconds until a buffer backing off may be refilled
+        waiting = [buffer.retry_at for buffer in self.buffers.values()
+                   if buffer.needs_refill]
+        if not waiting:
+            return None
+        return max(0.0, min(waiting) - time.monotonic())
+
+    def _refill(self, name: str, buffer: SourceBuffer) -> bool:
+        """
+        Top the buffer up to its size
+        :return: False if the source failed
+        """
+        while len(buffer.jokes) < buffer.size:
+            started = time.monotonic()
+            try:
+                content = self.foreign_apis.fetch_joke(name)
+            except Exception as error:
+                buffer.refill_errors += 1
+                buffer.failures += 1
+                backoff = min(self.error_backoff_max, self.error_backoff *
+                              2 ** (buffer.failures - 1))
+                buffer.retry_at = time.monotonic() + backoff
+                logger.warning('Could not prefetch from %s, next try in '
+                               '%.0fs: %s', name, backoff, error)
+                return False
+            elapsed = time.monotonic() - started
+            buffer.refills += 1
+            buffer.refill_seconds += elapsed
+            buffer.refill_seconds_max = max(buffer.refill_seconds_max,
+                                            elapsed)
+            buffer.jokes.append(content)
+            buffer.failures = 0
+        return True
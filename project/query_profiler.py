@@ -0,0 +1,124 @@
+"""Per-request SQL query counts, slow query log and N+1 detection"""
+import logging
+import time
+from collections import Counter
+
+from flask import g
+from flask import has_request_context
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised in strict mode when a request runs more queries
+    than the QUERY_BUDGETS of its route allow"""
+
+
+class QueryProfiler:
+    """
+    Times every statement run on behalf of a request. Statements
+    slower than SLOW_QUERY_THRESHOLD are logged, so are statements
+    repeated QUERY_REPEAT_THRESHOLD times within one request, the
+    sign of an N+1 loop. A request over the query budget of its
+    route is logged, or fails with QueryBudgetExceeded when
+    QUERY_BUDGET_STRICT is set, as the test suite does
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.slow_threshold = None
+        self.repeat_threshold = None
+        self.budgets = {}
+        self.strict = False
+        self._hooked = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the thresholds and budgets from the app config
+        :param app: Flask application
+        :return: None
+        """
+        self.enabled = app.config['QUERY_PROFILER_ENABLED']
+        self.slow_threshold = app.config['SLOW_QUERY_THRESHOLD']
+        self.repeat_threshold = app.config['QUERY_REPEAT_THRESHOLD']
+        self.budgets = app.config['QUERY_BUDGETS']
+        self.strict = app.config['QUERY_BUDGET_STRICT']
+        if not self._hooked:
+            app.before_request(self._start_request)
+            app.after_request(self._end_request)
+            event.listen(Engine, 'before_cursor_execute', self._start_query)
+            event.listen(Engine, 'after_cursor_execute', self._end_query)
+            self._hooked = True
+
+    @staticmethod
+    def queries() -> list:
+        """
+        Statements the current request ran so far
+        :return: list of (statement, seconds)
+        """
+        if has_request_context() and 'query_log' in g:
+            return list(g.query_log)
+        return []
+
+    def check(self, route: str, queries: list):
+        """
+        Log slow and repeated statements and enforce the budget
+        :param route: URL rule of the request
+        :param queries: list of (statement, seconds)
+        :return: None
+        :raise QueryBudgetExceeded: in strict mode, over the budget
+        """
+        for statement, seconds in queries:
+            if self.slow_threshold is not None and \
+                    seconds >= self.slow_threshold:
+                logger.warning('%s: slow query (%.3fs): %s',
+                               route, seconds, statement)
+
+        repeated = Counter(statement for statement, _ in queries)
+        for statement, times in repeated.items():
+            if times >= self.repeat_threshold:
+                logger.warning('%s: query ran %d times, N+1?: %s',
+                               route, times, statement)
+
+        budget = self.budgets.get(route)
+        if budget is None or len(queries) <= budget:
+            return
+        message = '%s ran %d queries, its budget is %d' % (
+            route, len(queries), budget)
+        if self.strict:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+    def _start_request(self):
+        if self.enabled:
+            g.query_log = []
+
+    def _end_request(self, response):
+        if self.enabled and 'query_log' in g:
+            route = request.url_rule.rule if request.url_rule \
+                else 'unmatched'
+            queries = g.pop('query_log')
+            logger.debug('%s: %d queries in %.3fs', route, len(queries),
+                         sum(seconds for _, seconds in queries))
+            self.check(route, queries)
+        return response
+
+    @staticmethod
+    def _start_query(connection, cursor, statement, parameters,
+                     context, executemany):
+        if has_request_context() and 'query_log' in g:
+            connection.info.setdefault('profiler_started', []).append(
+                time.perf_counter())
+
+    @staticmethod
+    def _end_query(connection, cursor, statement, parameters,
+                   context, executemany):
+        started = connection.info.get('profiler_started')
+        if started and has_request_context() and 'query_log' in g:
+            g.query_log.append((statement, time.perf_counter() -
+                                started.pop()))
@@ -0,0 +1,204 @@
+"""Token-bucket rate limits shared by the workers of one host"""
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import make_response
+from flask import request
+from flask_jwt_extended import get_jwt_identity
+from flask_jwt_extended import verify_jwt_in_request_optional
+
+CREATE_BUCKETS = (
+    'CREATE TABLE IF NOT EXISTS bucket ('
+    'key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+    'updated REAL NOT NULL, full_at REAL NOT NULL, '
+    'allowed INTEGER NOT NULL) WITHOUT ROWID'
+)
+
+# Refill by the elapsed time, then take a token if there is one.
+# SET expressions all see the row as it was before the update.
+# UPSERT with RETURNING needs SQLite 3.35
+REFILLED = 'min(:capacity, tokens + (:now - updated) * :rate)'
+TAKE_TOKEN = (
+    'INSERT INTO bucket (key, tokens, updated, full_at, allowed) '
+    'VALUES (:key, :capacity - 1, :now, :now + 1 / :rate, 1) '
+    'ON CONFLICT (key) DO UPDATE SET '
+    'tokens = {refilled} - ({refilled} >= 1), '
+    'full_at = :now + (:capacity - {refilled} + ({refilled} >= 1)) / :rate, '
+    'allowed = {refilled} >= 1, '
+    'updated = :now '
+    'RETURNING tokens, allowed'
+).format(refilled=REFILLED)
+
+# Fallback of TAKE_TOKEN, and for several buckets at once,
+# run in a BEGIN IMMEDIATE transaction
+SELECT_BUCKET = 'SELECT tokens, updated FROM bucket WHERE key = ?'
+PUT_BUCKET = ('INSERT OR REPLACE INTO bucket '
+              '(key, tokens, updated, full_at, allowed) '
+              'VALUES (?, ?, ?, ?, 1)')
+
+# A bucket that has refilled is the same as no bucket
+PRUNE_BUCKETS = 'DELETE FROM bucket WHERE full_at < ?'
+
+
+class RateLimiter:
+    """
+    Per-route token buckets keyed by client IP address and
+    by JWT identity, from the RATE_LIMITS config. The buckets are
+    rows of a SQLite file every worker process opens, so a check
+    is one local UPSERT and the limits hold across workers.
+    A request limited by several buckets takes a token from
+    every one of them or from none
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.path = None
+        self.limits = {}
+        self.prune_every = 1000
+        self.limited = 0
+        self.returning = True
+        self._checks = 0
+        self._local = threading.local()
+        self._hooked = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the limits from the app config and
+        check every request against them
+        :param app: Flask application
+        :return: None
+        """
+        self.enabled = app.config['RATE_LIMIT_ENABLED']
+        self.path = app.config['RATE_LIMIT_STORE']
+        self.prune_every = app.config['RATE_LIMIT_PRUNE_EVERY']
+        self.limits = app.config['RATE_LIMITS']
+        self.returning = sqlite3.sqlite_version_info >= (3, 35)
+        self._local = threading.local()
+        if not self._hooked:
+            app.before_request(self.limit_request)
+            self._hooked = True
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, not inherited over a fork
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid() or \
+                local.path != self.path:
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute(CREATE_BUCKETS)
+            local.connection = connection
+            local.pid = os.getpid()
+            local.path = self.path
+        return local.connection
+
+    def take(self, key: str, capacity: int, period: float) -> float:
+        """
+        Take a token from the bucket, refilled at
+        'capacity' tokens per 'period' seconds
+        :param key: bucket key
+        :param capacity: burst size
+        :param period: seconds to refill an empty bucket
+        :return: 0.0 if a token was taken, else seconds until there is one
+        """
+        return self.take_all([(key, capacity, period)])
+
+    def take_all(self, buckets: list) -> float:
+        """
+        Take a token from every bucket if each has one, else none
+        :param buckets: list of (key, capacity, period)
+        :return: 0.0 if the tokens were taken, else seconds
+        until every bucket has one
+        """
+        connection = self._connection()
+        if len(buckets) == 1 and self.returning:
+            key, capacity, period = buckets[0]
+            rate = capacity / period
+            tokens, allowed = connection.execute(TAKE_TOKEN, dict(
+                key=key, capacity=capacity, rate=rate, now=time.time(),
+            )).fetchone()
+            retry_after = 0.0 if allowed else (1 - tokens) / rate
+        else:
+            retry_after = self._take_in_transaction(connection, buckets)
+
+        self._checks += 1
+        if self._checks % self.prune_every == 0:
+            connection.execute(PRUNE_BUCKETS, (time.time(),))
+
+        if retry_after:
+            self.limited += 1
+        return retry_after
+
+    @staticmethod
+    def _take_in_transaction(connection, buckets: list) -> float:
+        # BEGIN IMMEDIATE holds the write lock from the
+        # first read, no other worker can take in between
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            refilled = []
+            retry_after = 0.0
+            for key, capacity, period in buckets:
+                rate = capacity / period
+                row = connection.execute(SELECT_BUCKET, (key,)).fetchone()
+                tokens = capacity if row is None else \
+                    min(capacity, row[0] + (now - row[1]) * rate)
+                if tokens < 1:
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+                refilled.append((key, tokens - 1, capacity, rate))
+            if not retry_after:
+                connection.executemany(PUT_BUCKET, [
+                    (key, tokens, now, now + (capacity - tokens) / rate)
+                    for key, tokens, capacity, rate in refilled])
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return retry_after
+
+    def limit_request(self):
+        """
+        Flask before_request hook, answers 429 Too Many Requests
+        with Retry-After once any bucket of the route is empty
+        :return: None or the 429 response
+        """
+        if not self.enabled or request.url_rule is None:
+            return None
+        limits = self.limits.get(request.url_rule.rule)
+        if not limits:
+            return None
+
+        buckets = []
+        for scope, (capacity, period) in limits.items():
+            client = self._client(scope)
+            if client is None:
+                continue
+            key = '%s|%s|%s' % (request.url_rule.rule, scope, client)
+            buckets.append((key, capacity, period))
+        retry_after = self.take_all(buckets) if buckets else 0.0
+        if not retry_after:
+            return None
+
+        response = make_response('Too many requests, try again later', 429)
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response
+
+    def reset(self):
+        self._connection().execute('DELETE FROM bucket')
+
+    @staticmethod
+    def _client(scope: str):
+        if scope == 'ip':
+            return request.remote_addr
+        # Requests without a valid token are refused by jwt_required
+        try:
+            verify_jwt_in_request_optional()
+        except Exception:
+            return None
+        return get_jwt_identity()
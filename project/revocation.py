@@ -0,0 +1,161 @@
+"""Denylist of revoked JWTs with a Bloom filter in front of the database"""
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from .models import RevokedToken
+from .models import db
+
+
+class BloomFilter:
+    """
+    Set membership in about 14.4 bits per key at a 0.001 error rate.
+    Never answers False for an added key, answers True for a key
+    that was not added with about 'error_rate' probability while
+    no more than 'capacity' keys are added
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate)
+                            / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # Double hashing, k positions out of two 64-bit hashes
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + index * second) % self.size
+                for index in range(self.hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+
+class TokenDenylist:
+    """
+    Revoked token ids, stored in the revoked_token table and
+    mirrored into a per-process Bloom filter. A token missing from
+    the filter is valid without any query, only filter hits are
+    looked up. Every process picks up the revocations made by the
+    others at most 'sync_interval' seconds late, with one query
+    """
+
+    def __init__(self, app=None):
+        self.capacity = 0
+        self.error_rate = 0.001
+        self.sync_interval = 1.0
+        self.filter = BloomFilter(1, self.error_rate)
+        self.checks = 0
+        self.lookups = 0
+        self.false_positives = 0
+        self._last_id = 0
+        self._synced_at = 0.0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the filter settings from the app config,
+        load() fills the filter once the tables exist
+        :param app: Flask application
+        :return: None
+        """
+        self.capacity = app.config['REVOKED_TOKENS_CAPACITY']
+        self.error_rate = app.config['REVOKED_TOKENS_ERROR_RATE']
+        self.sync_interval = app.config['REVOKED_TOKENS_SYNC_INTERVAL']
+
+    def load(self):
+        """
+        Rebuild the filter from the unexpired revocations,
+        sized for twice as many as there are
+        :return: number of loaded token ids
+        """
+        rows = db.session.query(RevokedToken.id, RevokedToken.jti).filter(
+            RevokedToken.expires > datetime.utcnow()).all()
+        new_filter = BloomFilter(max(self.capacity, 2 * len(rows)),
+                                 self.error_rate)
+        for _, jti in rows:
+            new_filter.add(jti)
+        last_id = db.session.query(db.func.max(RevokedToken.id)).scalar()
+        with self._lock:
+            self.filter = new_filter
+            self._last_id = last_id or 0
+            self._synced_at = time.monotonic()
+        return len(rows)
+
+    def revoke(self, jti: str, expires: datetime):
+        """
+        Store the revocation and add it to this process' filter
+        :param jti: token id
+        :param expires: UTC expiry of the token, the row is kept until
+        :return: None
+        """
+        db.session.add(RevokedToken(jti=jti, expires=expires))
+        try:
+            db.session.commit()
+        # Revoked already
+        except IntegrityError:
+            db.session.rollback()
+        with self._lock:
+            self.filter.add(jti)
+
+    def is_revoked(self, jti: str) -> bool:
+        """
+        Check the token id, the database only on a filter hit
+        :param jti: token id
+        :return: True if the token was revoked
+        """
+        self.checks += 1
+        self._sync()
+        if jti not in self.filter:
+            return False
+        self.lookups += 1
+        revoked = db.session.query(RevokedToken.id).filter_by(
+            jti=jti).first() is not None
+        if not revoked:
+            self.false_positives += 1
+        return revoked
+
+    def prune(self) -> int:
+        """
+        Delete the revocations of expired tokens, their ids
+        leave the filters when it is next rebuilt
+        :return: number of deleted rows
+        """
+        deleted = RevokedToken.query.filter(
+            RevokedToken.expires <= datetime.utcnow()).delete()
+        db.session.commit()
+        return deleted
+
+    def stats(self) -> dict:
+        return dict(checks=self.checks, lookups=self.lookups,
+                    false_positives=self.false_positives,
+                    filter_bits=self.filter.size,
+                    filter_hashes=self.filter.hashes)
+
+    def _sync(self):
+        # Revocations of the other processes, past the last seen id
+        if time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._synced_at < self.sync_interval:
+                return
+            self._synced_at = time.monotonic()
+            rows = db.session.query(RevokedToken.id, RevokedToken.jti).filter(
+                RevokedToken.id > self._last_id).all()
+            for row_id, jti in rows:
+                self.filter.add(jti)
+                self._last_id = max(self._last_id, row_id)
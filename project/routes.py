@@ -2,32 +2,74 @@ from flask import current_app as app
 from flask import jsonify
 from flask import request
 from flask import make_response
+from flask import Response
+from flask import stream_with_context
 
+# Unlike requests and multiprocessing, flask_restful and
+# flask_jwt_extended cannot wait for a first use: /register is a
+# Resource and every other route is wrapped in jwt_required when
+# this module is imported. Together they take about 6ms
 from flask_restful import Resource
 from flask_restful import Api
 from flask_restful import reqparse
 
 from sqlalchemy.exc import IntegrityError
 
+import base64
+import binascii
+import json
+
+from datetime import datetime
+
 from .models import User
 from .models import Joke
-from .models import Action
+from .models import content_digest
+from .models import index_minhashes
 from .models import db
 
-from . import bcrypt
-
-from datetime import datetime
+from . import action_log
+from . import user_cache
+from . import joke_cache
+from . import password_hasher
+from . import foreign_apis
+from . import prefetcher
+from . import token_denylist
+from . import metrics
+
+from .analytics import ALL_USERS
+from .analytics import GRANULARITIES
+from .analytics import bucket_range
+from .analytics import query_counts
+from .hashing import HashingBusy
+from .minhash import band_buckets
+from .minhash import signature
+from .minhash import similarity
+from .near_duplicates import find_near_duplicate
+from .near_duplicates import find_near_duplicates
+from .sampling import random_joke
+from .search import search_jokes
+from .foreign_api import ForeignApiError
 
 from flask_jwt_extended import JWTManager
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import create_access_token
 from flask_jwt_extended import get_jwt_identity
-
-import requests
+from flask_jwt_extended import get_raw_jwt
 
 jwt = JWTManager(app)
 
 
+@jwt.token_in_blacklist_loader
+def is_token_revoked(decrypted_token: dict) -> bool:
+    """
+    Refuse the tokens revoked by /logout
+    :param decrypted_token: JWT claims
+    :return: True if the token was revoked
+    """
+    with metrics.timed('auth'):
+        return token_denylist.is_revoked(decrypted_token['jti'])
+
+
 @app.route('/')
 def index():
     """
@@ -39,19 +81,15 @@ def index():
 
 def log_action(req_obj: request, user_id: int):
     """
-    This subroutine allows logging registered users' activity
+    This subroutine allows logging registered users' activity.
+    The row is queued and written in a batch by the
+    background writer, not committed with the request
     :param req_obj: current request context
     :param user_id: actor's user_id
     :return: None
     """
-    new_action = Action(
-        user_ip_address=req_obj.remote_addr,
-        action_time=datetime.now(),
-        action_path=req_obj.path,
-        user_id=user_id,
-    )
-    db.session.add(new_action)
-    db.session.commit()
+    with metrics.timed('action_log'):
+        action_log.record(req_obj, user_id)
 
 
 def compare(candidate: str, hashcode: str) -> bool:
@@ -60,20 +98,127 @@ def compare(candidate: str, hashcode: str) -> bool:
     :param candidate: candidate password
     :param hashcode: Bcrypt-hashed password
     :return: True if matched, else False
+    :raise HashingBusy: if the hashing pool is saturated
+    """
+    with metrics.timed('hashing'):
+        return password_hasher.check(hashcode, candidate)
+
+
+def upgrade_password_hash(user_id: int, candidate: str):
+    """
+    This subroutine re-hashes a just verified password
+    at the current cost factor. It is skipped when the
+    hashing pool is busy, the next login will retry
+    :param user_id: User identity
+    :param candidate: verified plain password
+    :return: None
+    """
+    try:
+        with metrics.timed('hashing'):
+            new_hash = password_hasher.generate(candidate)
+    except HashingBusy:
+        return
+    user = User.query.get(user_id)
+    if user:
+        user.password = new_hash
+        db.session.commit()
+
+
+def busy_response():
+    """
+    Back-pressure response for a saturated hashing pool
+    :return: 503 Service Unavailable
     """
-    return bcrypt.check_password_hash(hashcode, candidate)
+    response = make_response('Server is busy, try again later', 503)
+    response.headers['Retry-After'] = '1'
+    return response
 
 
 def within_bounds(user_id):
     """
     This subroutine check whether the User
-    has not reached the limit of available Jokes
+    has not reached the limit of available Jokes.
+    It is a cheap early check, reserve_joke_slot()
+    enforces the limit
     :param user_id: User identity
     :return: boolean True or False
     """
-    return len(
-        Joke.query.filter_by(user_id=user_id).all()
-    ) <= app.config['JOKES_LIMIT']
+    joke_count = db.session.query(User.joke_count).filter_by(
+        id=user_id).scalar()
+    return joke_count is not None and \
+        joke_count < app.config['JOKES_LIMIT']
+
+
+def reserve_joke_slot(user_id, count: int = 1) -> bool:
+    """
+    This subroutine atomically takes slots of
+    the User's Jokes quota within the current transaction.
+    Rolling the transaction back releases the slots
+    :param user_id: User identity
+    :param count: number of slots to take
+    :return: True if the slots were taken, False if they do not fit
+    """
+    result = db.session.execute(
+        User.__table__.update()
+        .where(User.id == user_id)
+        .where(User.joke_count + count <= app.config['JOKES_LIMIT'])
+        .values(joke_count=User.joke_count + count,
+                jokes_version=User.jokes_version + 1)
+    )
+    return result.rowcount == 1
+
+
+def is_near_duplicate(content: str, exclude: int = None) -> bool:
+    """
+    This subroutine checks the catalogue for a reworded
+    copy of the content, exact copies are left to the
+    unique content_hash
+    :param content: Joke text
+    :param exclude: joke_id of the Joke being updated
+    :return: True if a similar Joke exists
+    """
+    return find_near_duplicate(
+        db.session, signature(content),
+        app.config['NEAR_DUPLICATE_THRESHOLD'], exclude=exclude
+    ) is not None
+
+
+def jokes_version(user_id) -> int:
+    """
+    This subroutine reads the version of the User's
+    Jokes, a primary key lookup
+    :param user_id: User identity
+    :return: jokes_version, 0 if the User is gone
+    """
+    return db.session.query(User.jokes_version).filter_by(
+        id=user_id).scalar() or 0
+
+
+def collection_etag(user_id, version: int = None) -> str:
+    """
+    This subroutine builds the ETag of the User's Jokes
+    from their version
+    :param user_id: User identity
+    :param version: jokes_version, looked up if None
+    :return: ETag value
+    """
+    if version is None:
+        version = jokes_version(user_id)
+    return 'u%s-v%s' % (user_id, version)
+
+
+def not_modified(etag: str):
+    """
+    This subroutine answers a conditional GET whose
+    If-None-Match still matches the collection version
+    :param etag: current ETag
+    :return: 304 Not Modified response or None
+    """
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    return None
 
 
 class Registration(Resource):
@@ -110,10 +255,16 @@ class Registration(Resource):
                     error=app.config['BAD_PARAMETER']
                 ), 400)
 
+        try:
+            with metrics.timed('hashing'):
+                password = password_hasher.generate(
+                    Registration.parser.parse_args()['password'])
+        except HashingBusy:
+            return busy_response()
+
         new_user = User(
             username=Registration.parser.parse_args()['username'],
-            password=bcrypt.generate_password_hash(
-                Registration.parser.parse_args()['password'])
+            password=password
         )
         try:
             # Save the new user to the User table
@@ -140,27 +291,52 @@ def login():
     if not (request.form['username'] and request.form['password']):
         return make_response('Missing username/password', 401)
 
+    # Resolve the user once, from the cache if possible
+    credentials = user_cache.get(request.form['username'])
+
     # If requester user does not exist,
     # return 401 Unauthorized
-    if not User.query.filter_by(username=request.form['username']).first():
+    if not credentials:
         return make_response('No such user', 401)
 
     # If password and hash did not match, return
     # 401 Unauthorized
-    if not compare(candidate=request.form['password'],
-                   hashcode=User.query.filter_by(
-                       username=request.form['username']).first().password):
-        return make_response('Wrong password', 401)
-
-    access_token = create_access_token(
-        identity=User.query.filter_by(
-            username=request.form['username']).first().id
-    )
+    try:
+        if not compare(candidate=request.form['password'],
+                       hashcode=credentials.password):
+            return make_response('Wrong password', 401)
+    except HashingBusy:
+        return busy_response()
+
+    # Hashes stored at an older cost factor are upgraded
+    if password_hasher.needs_rehash(credentials.password):
+        upgrade_password_hash(credentials.id, request.form['password'])
+
+    with metrics.timed('auth'):
+        access_token = create_access_token(identity=credentials.id)
 
     # If credentials are correct, generate and return JWT
     return jsonify(access_token=access_token), 200
 
 
+@app.route('/logout', methods=['POST'])
+@jwt_required
+def logout():
+    """
+    The endpoint for revoking the JWT it is called with
+    :return: 200 OK
+    """
+    try:
+        claims = get_raw_jwt()
+        # Tokens made without expiry stay revoked for good
+        expires = datetime.utcfromtimestamp(claims['exp']) \
+            if 'exp' in claims else datetime.max
+        token_denylist.revoke(claims['jti'], expires)
+        return make_response('Logged out', 200)
+    finally:
+        log_action(request, get_jwt_identity())
+
+
 @app.route('/create-joke', methods=['PUT'])
 @jwt_required
 def create_joke():
@@ -192,20 +368,27 @@ def create_joke():
                                  'Max allowed size is 900 characters', 400)
         else:
 
-            this_joke = Joke.query.filter_by(
-                content=request.form['content']).first()
-
-            # Check if the User has this joke already
-            if this_joke:
+            if is_near_duplicate(request.form['content']):
                 return make_response('This joke already exists', 403)
 
+            # Take a slot of the quota in the same
+            # transaction as the insert
+            if not reserve_joke_slot(get_jwt_identity()):
+                db.session.rollback()
+                return make_response('Your jokes collection is full', 403)
+
             # Create and save new joke to Joke table
             new_joke = Joke(
                 content=request.form['content'],
                 user_id=get_jwt_identity()
             )
-            db.session.add(new_joke)
-            db.session.commit()
+            try:
+                db.session.add(new_joke)
+                db.session.commit()
+            # The unique content_hash refuses a joke that exists already
+            except IntegrityError:
+                db.session.rollback()
+                return make_response('This joke already exists', 403)
             return make_response('Joke created', 201)
     finally:
         log_action(request, get_jwt_identity())
@@ -234,31 +417,35 @@ def import_a_joke():
 
         # Check if server supports the source
         try:
-            assert request.form['source'] in app.config['FOREIGN_API']
+            assert request.form['source'] in foreign_apis
         except AssertionError:
             return make_response('This source is not supported', 404)
         else:
-            content = requests.get(
-                app.config['FOREIGN_API'][request.form['source']]
-            ).json()['joke']
+            try:
+                with metrics.timed('remote'):
+                    content = prefetcher.fetch_joke(request.form['source'])
+            except ForeignApiError:
+                return make_response('The source is not available', 502)
 
-            # Check if the User has this joke already
-            this_joke = Joke.query.filter_by(
-                content=content
-            ).first()
-
-            # If it is present, refuse action and return 403 Forbidden
-            if this_joke:
+            if is_near_duplicate(content):
                 return make_response('This joke already exists', 403)
 
-            # Else, create and save the new joke
+            if not reserve_joke_slot(get_jwt_identity()):
+                db.session.rollback()
+                return make_response('Your jokes collection is full', 403)
+
             new_joke = Joke(
                 content=content,
                 user_id=get_jwt_identity()
             )
 
-            db.session.add(new_joke)
-            db.session.commit()
+            try:
+                db.session.add(new_joke)
+                db.session.commit()
+            # If the joke is present, refuse action and return 403 Forbidden
+            except IntegrityError:
+                db.session.rollback()
+                return make_response('This joke already exists', 403)
 
             return make_response('Joke created', 201)
 
@@ -266,6 +453,120 @@ def import_a_joke():
         log_action(request, get_jwt_identity())
 
 
+@app.route('/create-jokes', methods=['PUT'])
+@jwt_required
+def create_jokes():
+    """
+    Protected endpoint for creating jokes in bulk,
+    the body is a JSON array of joke contents
+    :return: 201 Created if any joke was created, else 200 OK,
+    and the status of every item: 'created', 'duplicate',
+    'too long' or 'over quota'
+    """
+    try:
+        contents = request.get_json(silent=True)
+        # Check if the body is an array of strings of allowed size
+        assert isinstance(contents, list) and contents
+        assert all(isinstance(content, str) for content in contents)
+    except AssertionError:
+        return make_response('A JSON array of joke contents is required', 400)
+    else:
+
+        if len(contents) > app.config['BULK_JOKES_LIMIT']:
+            return make_response('Too many jokes in one request', 400)
+
+        statuses = [None] * len(contents)
+        digests = [content_digest(content) for content in contents]
+        minhashes = [signature(content) for content in contents]
+
+        # Jokes that exist already, found in one query
+        existing = {digest for (digest,) in db.session.query(
+            Joke.content_hash).filter(Joke.content_hash.in_(digests))}
+        # and their reworded copies, in one query per 500 band buckets
+        similar = find_near_duplicates(
+            db.session, minhashes, app.config['NEAR_DUPLICATE_THRESHOLD'])
+        # Band buckets of the jokes accepted so far in the batch
+        batch_buckets = {}
+
+        candidates = []
+        for index, content in enumerate(contents):
+            if len(content) > 900:
+                statuses[index] = 'too long'
+            elif digests[index] in existing or similar[index] or \
+                    near_duplicate_in_batch(minhashes, index, batch_buckets):
+                statuses[index] = 'duplicate'
+            else:
+                # A repeat within the batch is a duplicate as well
+                existing.add(digests[index])
+                if minhashes[index] is not None:
+                    for bucket in band_buckets(minhashes[index]):
+                        batch_buckets.setdefault(bucket, []).append(index)
+                candidates.append(index)
+
+        joke_count = db.session.query(User.joke_count).filter_by(
+            id=get_jwt_identity()).scalar() or 0
+        remaining = max(app.config['JOKES_LIMIT'] - joke_count, 0)
+        for index in candidates[remaining:]:
+            statuses[index] = 'over quota'
+        accepted = candidates[:remaining]
+
+        if accepted:
+            # Take the slots and insert the jokes in one transaction
+            if not reserve_joke_slot(get_jwt_identity(), len(accepted)):
+                db.session.rollback()
+                return make_response('Your jokes collection is full', 403)
+            try:
+                mappings = [dict(
+                    content=contents[index],
+                    content_hash=digests[index],
+                    minhash=minhashes[index],
+                    user_id=get_jwt_identity(),
+                ) for index in accepted]
+                db.session.bulk_insert_mappings(Joke, mappings)
+                # Bulk inserts skip the ORM events, index the
+                # signatures under the generated joke_ids here
+                index_minhashes(db.session.connection(), db.session.query(
+                    Joke.joke_id, Joke.minhash).filter(Joke.content_hash.in_(
+                        [mapping['content_hash'] for mapping in mappings])
+                ).all())
+                db.session.commit()
+            # Another request created one of the jokes meanwhile
+            except IntegrityError:
+                db.session.rollback()
+                return make_response('Jokes were created concurrently, '
+                                     'try again', 409)
+            for index in accepted:
+                statuses[index] = 'created'
+
+        return make_response(jsonify(
+            created=len(accepted),
+            results=[dict(index=index, status=status)
+                     for index, status in enumerate(statuses)],
+        ), 201 if accepted else 200)
+    finally:
+        log_action(request, get_jwt_identity())
+
+
+def near_duplicate_in_batch(minhashes: list, index: int,
+                            batch_buckets: dict) -> bool:
+    """
+    This subroutine checks a bulk item against
+    the items accepted before it in the same batch
+    :param minhashes: signatures of the batch
+    :param index: position of the item
+    :param batch_buckets: band bucket to positions of accepted items
+    :return: True if a similar item was accepted
+    """
+    if minhashes[index] is None:
+        return False
+    return any(
+        similarity(minhashes[index], minhashes[other]) >=
+        app.config['NEAR_DUPLICATE_THRESHOLD']
+        for bucket in band_buckets(minhashes[index])
+        for other in batch_buckets.get(bucket, ())
+    )
+
+
 @app.route('/get-joke-by-id')
 @jwt_required
 def get_joke_by_id():
@@ -280,44 +581,211 @@ def get_joke_by_id():
         return make_response('joke_id is a required parameter', 400)
     else:
         try:
-            joke_obj = Joke.query.filter_by(
-                joke_id=request.form['joke_id'],
-                user_id=get_jwt_identity()
-            ).first()
+            joke_id = int(request.form['joke_id'])
+        except ValueError:
+            return make_response('Nothing found', 404)
+        # Answer 304 before the Joke is loaded. The joke_id is in
+        # the body, not the URL, so the ETag has to name the Joke
+        version = jokes_version(get_jwt_identity())
+        etag = '%s-j%s' % (collection_etag(get_jwt_identity(), version),
+                           joke_id)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+        try:
+            # Entries cached before a write in another worker are misses
+            content = joke_cache.get(
+                user_id=get_jwt_identity(),
+                joke_id=joke_id,
+                version=version
+            )
             # Check if Joke by joke_id exists
-            assert joke_obj
+            assert content is not None
         except AssertionError:
             return make_response('Nothing found', 404)
         else:
-            return make_response(
-                joke_obj.content, 200
+            response = make_response(
+                content, 200
             )
+            response.set_etag(etag)
+            return response
+    finally:
+        log_action(request, get_jwt_identity())
+
+
+@app.route('/random-joke')
+@jwt_required
+def get_random_joke():
+    """
+    The endpoint for a Joke picked uniformly at random.
+    Optional parameter 'scope' all (default) for the whole
+    catalogue or me for the User's Jokes only
+    :return: 200 OK and the Joke in JSON
+    """
+    try:
+        try:
+            scope = request.values.get('scope', 'all')
+            assert scope in ('me', 'all')
+        except AssertionError:
+            return make_response('Bad scope', 400)
+
+        picked = random_joke(
+            db.session,
+            user_id=get_jwt_identity() if scope == 'me' else None,
+            attempts=app.config['RANDOM_JOKE_ATTEMPTS'],
+            max_ids=app.config['RANDOM_JOKE_MAX_IDS'],
+        )
+        # If there are no jokes, return 204 No Content
+        if picked is None:
+            return make_response('', 204)
+        joke_id, content = picked
+        return jsonify(joke_id=joke_id, content=content)
     finally:
         log_action(request, get_jwt_identity())
 
 
+def encode_cursor(joke_id: int) -> str:
+    """
+    This subroutine makes the opaque next-page token
+    :param joke_id: last joke_id of the page
+    :return: URL-safe token
+    """
+    return base64.urlsafe_b64encode(
+        str(joke_id).encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    """
+    This subroutine reads a token made by encode_cursor()
+    :param cursor: URL-safe token
+    :return: joke_id the next page starts after
+    :raise ValueError: if the token is malformed
+    """
+    try:
+        return int(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)).decode('ascii'))
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError(cursor)
+
+
+def stream_jokes(query):
+    """
+    This generator renders jokes as a JSON document piece by piece,
+    reading them from the database in batches
+    :param query: query of (joke_id, content) rows
+    :return: chunks of JSON
+    """
+    yield '{"jokes": ['
+    separator = ''
+    for joke_id, content in query.yield_per(
+            app.config['MY_JOKES_STREAM_BATCH']):
+        yield separator + json.dumps(dict(joke_id=joke_id, content=content))
+        separator = ', '
+    yield ']}'
+
+
 @app.route('/my-jokes')
 @jwt_required
 def get_my_jokes():
     """
-    The endpoint for retrieving all the Jokes
-    that belong to the User
-    :return: 200 OK and jokes in JSON
+    The endpoint for retrieving the Jokes
+    that belong to the User, a page at a time.
+    Optional parameters: 'cursor' from the previous page,
+    'limit' as page size, 'stream' to get all the jokes
+    after the cursor in one streamed response
+    :return: 200 OK and jokes in JSON w/ next_cursor,
+    null on the last page
     """
     try:
+        try:
+            after = 0
+            if request.values.get('cursor'):
+                after = decode_cursor(request.values['cursor'])
+            limit = int(request.values.get(
+                'limit', app.config['MY_JOKES_PAGE_SIZE']))
+            if not 0 < limit <= app.config['MY_JOKES_MAX_PAGE_SIZE']:
+                raise ValueError(limit)
+        except ValueError:
+            return make_response('Bad cursor or limit', 400)
+
+        # Answer 304 before any Joke is loaded
+        etag = collection_etag(get_jwt_identity())
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+
+        query = db.session.query(Joke.joke_id, Joke.content).filter(
+            Joke.user_id == get_jwt_identity(),
+            Joke.joke_id > after
+        ).order_by(Joke.joke_id)
+
+        if request.values.get('stream'):
+            response = Response(stream_with_context(stream_jokes(query)),
+                                mimetype='application/json')
+            response.set_etag(etag)
+            return response
+
+        # One extra row tells whether there is a next page
+        page = query.limit(limit + 1).all()
         # Check if User has jokes in the first place
-        all_jokes = Joke.query.filter_by(user_id=get_jwt_identity()).all()
-        assert all_jokes
+        assert page or after
     except AssertionError:
         # If none, return 204 No Content
         return make_response('', 204)
     else:
-        # Else, generate a dictionary as joke_id:content
-        result = {
-            k: v.content for (k, v) in enumerate(all_jokes)
-        }
-        # Return dictionary as JSON
-        return jsonify(result)
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(page[-1].joke_id)
+        response = jsonify(
+            jokes=[dict(joke_id=joke_id, content=content)
+                   for joke_id, content in page],
+            next_cursor=next_cursor,
+        )
+        response.set_etag(etag)
+        return response
+    finally:
+        log_action(request, get_jwt_identity())
+
+
+@app.route('/search-jokes')
+@jwt_required
+def search_my_jokes():
+    """
+    The endpoint for full-text search of Jokes, best match first.
+    Parameters: 'q' words that must all be present,
+    optional 'scope' me (default) or all for the whole catalogue,
+    'limit' as page size and 'offset' from the previous page
+    :return: 200 OK and jokes in JSON w/ next_offset,
+    null on the last page
+    """
+    try:
+        try:
+            terms = request.values.get('q', '')
+            assert terms.split()
+            assert request.values.get('scope', 'me') in ('me', 'all')
+            limit = int(request.values.get(
+                'limit', app.config['SEARCH_PAGE_SIZE']))
+            offset = int(request.values.get('offset', 0))
+            assert 0 < limit <= app.config['SEARCH_MAX_PAGE_SIZE']
+            assert offset >= 0
+        except (ValueError, AssertionError):
+            return make_response('Bad q, scope, limit or offset', 400)
+
+        user_id = None if request.values.get('scope') == 'all' \
+            else get_jwt_identity()
+        # One extra row tells whether there is a next page
+        page = search_jokes(db.session, terms, user_id,
+                            limit=limit + 1, offset=offset)
+        next_offset = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_offset = offset + limit
+        return jsonify(
+            jokes=[dict(joke_id=joke_id, content=content)
+                   for joke_id, content in page],
+            next_offset=next_offset,
+        )
     finally:
         log_action(request, get_jwt_identity())
 
@@ -353,8 +821,17 @@ def update_my_joke():
             if not this_joke:
                 return make_response('Nothing to patch', 404)
 
+            if is_near_duplicate(request.form['content'],
+                                 exclude=this_joke.joke_id):
+                return make_response('This joke already exists', 403)
+
             this_joke.content = request.form['content']
-            db.session.commit()
+            try:
+                db.session.commit()
+            # Patching a joke into a copy of another one is refused
+            except IntegrityError:
+                db.session.rollback()
+                return make_response('This joke already exists', 403)
             return make_response('', 204)
     finally:
         log_action(request, get_jwt_identity())
@@ -395,5 +872,66 @@ def delete_my_joke():
         log_action(request, get_jwt_identity())
 
 
+@app.route('/activity')
+@jwt_required
+def get_activity():
+    """
+    The endpoint for request counts over time, read from
+    pre-aggregated counts. Optional parameters:
+    'granularity' minute, hour (default) or day,
+    'start' and 'end' as ISO 8601 datetimes, end exclusive,
+    'path' to count one path only,
+    'scope' me (default) or all for every user together
+    :return: 200 OK and counts per bucket and path in JSON
+    """
+    try:
+        try:
+            granularity = request.values.get('granularity', 'hour')
+            assert granularity in GRANULARITIES
+            assert request.values.get('scope', 'me') in ('me', 'all')
+            start, end = (
+                datetime.fromisoformat(request.values[name])
+                if request.values.get(name) else None
+                for name in ('start', 'end')
+            )
+            start, end = bucket_range(
+                granularity, start, end,
+                app.config['ACTIVITY_DEFAULT_BUCKETS'])
+            width = GRANULARITIES[granularity][0]
+            assert start < end
+            assert (end - start) / width <= \
+                app.config['ACTIVITY_MAX_BUCKETS']
+        except (ValueError, AssertionError):
+            return make_response('Bad granularity, scope or time window', 400)
+
+        user_id = ALL_USERS if request.values.get('scope') == 'all' \
+            else get_jwt_identity()
+        counts = query_counts(granularity, user_id, start, end,
+                              request.values.get('path'))
+        return jsonify(
+            granularity=granularity,
+            start=start.isoformat(),
+            end=end.isoformat(),
+            total=sum(count for _, _, count in counts),
+            counts=[dict(bucket=bucket.isoformat(), path=path, count=count)
+                    for bucket, path, count in counts],
+        )
+    finally:
+        log_action(request, get_jwt_identity())
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    The endpoint for scraping request metrics
+    of every worker in the Prometheus text format
+    :return: 200 OK and the metrics
+    """
+    if not metrics.enabled:
+        return make_response('Metrics are disabled', 404)
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 api = Api(app)
 api.add_resource(Registration, '/register')
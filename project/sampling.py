@@ -0,0 +1,175 @@
+"""Uniform random picks of Jokes without sorting the table"""
+import random
+import threading
+import weakref
+from array import array
+from bisect import bisect_left
+from bisect import bisect_right
+
+from sqlalchemy import func
+
+from .models import Joke
+from .models import User
+
+
+class JokeIds:
+    """
+    Sorted joke_ids of a database, kept in this process to draw
+    from, at most 'max_ids' of them, 8 bytes each. The array goes
+    stale as other workers write, so it is only a list of
+    candidates: every drawn id is looked up in the database.
+    New Jokes are appended when the largest joke_id grows;
+    SQLite gives a new row the largest rowid plus one. Ids deleted
+    meanwhile are found out when drawn, and discarded. A catalogue
+    over max_ids is not kept at all, 'overflow' is set instead
+    """
+
+    def __init__(self, max_ids: int = 1000000):
+        self.max_ids = max_ids
+        self.overflow = False
+        self.ids = array('q')
+        self._lock = threading.Lock()
+
+    def sync(self, session):
+        """
+        Follow the largest joke_id: forget the ids past it
+        and load the ones added after the last known id
+        :param session: SQLAlchemy session
+        :return: None
+        """
+        largest = session.query(func.max(Joke.joke_id)).scalar() or 0
+        with self._lock:
+            if self.overflow:
+                return
+            del self.ids[bisect_right(self.ids, largest):]
+            last = self.ids[-1] if self.ids else 0
+            if largest > last:
+                room = self.max_ids - len(self.ids)
+                self.ids.extend(row.joke_id for row in session.query(
+                    Joke.joke_id).filter(Joke.joke_id > last)
+                    .order_by(Joke.joke_id).limit(room + 1))
+            if len(self.ids) > self.max_ids:
+                self.overflow = True
+                self.ids = array('q')
+
+    def reload(self, session):
+        with self._lock:
+            del self.ids[:]
+        self.sync(session)
+
+    def draw(self):
+        with self._lock:
+            return random.choice(self.ids) if self.ids else None
+
+    def discard(self, joke_id: int):
+        with self._lock:
+            index = bisect_left(self.ids, joke_id)
+            if index < len(self.ids) and self.ids[index] == joke_id:
+                del self.ids[index]
+
+
+# JokeIds of every database, by engine
+_catalogues = weakref.WeakKeyDictionary()
+_catalogues_lock = threading.Lock()
+
+
+def catalogue_ids(session, max_ids: int = 1000000) -> JokeIds:
+    """
+    JokeIds of the database the session is bound to
+    :param session: SQLAlchemy session
+    :param max_ids: bound of a new JokeIds
+    :return: JokeIds
+    """
+    engine = session.get_bind()
+    with _catalogues_lock:
+        ids = _catalogues.get(engine)
+        if ids is None:
+            ids = _catalogues[engine] = JokeIds(max_ids)
+        return ids
+
+
+def random_joke(session, user_id: int = None, attempts: int = 16,
+                max_ids: int = 1000000):
+    """
+    Pick a Joke uniformly at random with primary key lookups.
+    A User's Jokes are picked by rank: a random offset below
+    their joke_count into the (user_id, joke_id) index.
+    The whole catalogue is sampled from its JokeIds, one lookup
+    of the largest joke_id and one of the drawn Joke whatever
+    holes deletes left in the id space. A drawn id deleted by
+    another process is discarded and another one drawn.
+    A catalogue over max_ids is sampled by drawing ids up to the
+    largest one instead, see random_joke_by_id()
+    :param session: SQLAlchemy session
+    :param user_id: only pick among this User's Jokes if given
+    :param attempts: draws of deleted ids before the JokeIds
+    are reloaded, or ids drawn per query over max_ids
+    :param max_ids: most joke_ids kept per database
+    :return: (joke_id, content) or None if there are no Jokes
+    """
+    if user_id is not None:
+        return random_joke_of_user(session, user_id, attempts)
+
+    ids = catalogue_ids(session, max_ids)
+    ids.sync(session)
+    if ids.overflow:
+        return random_joke_by_id(session, attempts)
+    query = session.query(Joke.joke_id, Joke.content)
+    drawn_deleted = 0
+    while True:
+        drawn = ids.draw()
+        if drawn is None:
+            return None
+        row = query.filter(Joke.joke_id == drawn).first()
+        if row is not None:
+            return tuple(row)
+        ids.discard(drawn)
+        drawn_deleted += 1
+        if drawn_deleted == attempts:
+            # Mass deletes elsewhere, start over from the table
+            ids.reload(session)
+
+
+def random_joke_by_id(session, draws: int = 16):
+    """
+    Pick a Joke by drawing ids up to the largest joke_id, 'draws'
+    of them looked up in one query, until one exists. The first
+    drawn id that exists is taken, which keeps the pick uniform
+    whatever holes deletes left; the number of queries grows
+    as the id space gets sparser
+    :param session: SQLAlchemy session
+    :param draws: ids drawn per query
+    :return: (joke_id, content) or None if there are no Jokes
+    """
+    draws = max(1, draws)
+    while True:
+        largest = session.query(func.max(Joke.joke_id)).scalar()
+        if largest is None:
+            return None
+        drawn = [random.randint(1, largest) for _ in range(draws)]
+        found = dict(session.query(Joke.joke_id, Joke.content).filter(
+            Joke.joke_id.in_(set(drawn))))
+        for joke_id in drawn:
+            if joke_id in found:
+                return joke_id, found[joke_id]
+
+
+def random_joke_of_user(session, user_id: int, attempts: int = 16):
+    """
+    Pick one of the User's Jokes uniformly at random
+    :param session: SQLAlchemy session
+    :param user_id: User identity
+    :param attempts: retries when a concurrent delete shrank the list
+    :return: (joke_id, content) or None if the User has no Jokes
+    """
+    query = session.query(Joke.joke_id, Joke.content).filter(
+        Joke.user_id == user_id).order_by(Joke.joke_id)
+    for _ in range(attempts):
+        joke_count = session.query(User.joke_count).filter_by(
+            id=user_id).scalar()
+        if not joke_count:
+            return None
+        row = query.offset(random.randrange(joke_count)).first()
+        if row is not None:
+            return tuple(row)
+    return None
@@ -0,0 +1,105 @@
+"""Full-text search of Joke content over an SQLite FTS5 index"""
+from sqlalchemy import text
+
+# External content index over joke.content, rowid is joke.joke_id
+SEARCH_TABLE = 'joke_search'
+
+# The virtual table and the shadow tables FTS5 keeps its index in
+SEARCH_TABLES = {SEARCH_TABLE} | {
+    SEARCH_TABLE + suffix
+    for suffix in ('_data', '_idx', '_docsize', '_config')
+}
+
+CREATE_SEARCH_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS joke_search USING fts5("
+    "content, content='joke', content_rowid='joke_id', "
+    "tokenize='porter unicode61 remove_diacritics 2')"
+)
+
+# The triggers keep the index in the transaction changing the
+# joke table, whatever the change is made through
+CREATE_SEARCH_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS joke_search_insert "
+    "AFTER INSERT ON joke BEGIN "
+    "INSERT INTO joke_search (rowid, content) "
+    "VALUES (new.joke_id, new.content); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS joke_search_delete "
+    "AFTER DELETE ON joke BEGIN "
+    "INSERT INTO joke_search (joke_search, rowid, content) "
+    "VALUES ('delete', old.joke_id, old.content); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS joke_search_update "
+    "AFTER UPDATE OF content ON joke BEGIN "
+    "INSERT INTO joke_search (joke_search, rowid, content) "
+    "VALUES ('delete', old.joke_id, old.content); "
+    "INSERT INTO joke_search (rowid, content) "
+    "VALUES (new.joke_id, new.content); "
+    "END",
+)
+
+SEARCH = text(
+    'SELECT joke.joke_id, joke.content FROM joke_search '
+    'JOIN joke ON joke.joke_id = joke_search.rowid '
+    'WHERE joke_search MATCH :expression '
+    'AND (:user_id IS NULL OR joke.user_id = :user_id) '
+    'ORDER BY joke_search.rank, joke.joke_id '
+    'LIMIT :limit OFFSET :offset'
+)
+
+
+def create_search_index(connection):
+    """
+    Create the index and its triggers if they are missing
+    :param connection: connection in an open transaction
+    :return: None
+    """
+    connection.execute(CREATE_SEARCH_TABLE)
+    for statement in CREATE_SEARCH_TRIGGERS:
+        connection.execute(statement)
+
+
+def rebuild_search_index(engine):
+    """
+    Re-index every Joke and merge the index b-trees,
+    for data written while the triggers were missing
+    :param engine: SQLAlchemy engine
+    :return: number of indexed Jokes
+    """
+    with engine.begin() as connection:
+        create_search_index(connection)
+        connection.execute(
+            "INSERT INTO joke_search (joke_search) VALUES ('rebuild')")
+        connection.execute(
+            "INSERT INTO joke_search (joke_search) VALUES ('optimize')")
+        return connection.execute('SELECT COUNT(*) FROM joke').scalar()
+
+
+def match_expression(terms: str) -> str:
+    """
+    Quote every word of the user's input, so it is matched as
+    plain words that must all be present, never as FTS5 syntax
+    :param terms: search input
+    :return: FTS5 query, empty if there are no words
+    """
+    return ' '.join('"%s"' % word.replace('"', '""')
+                    for word in terms.split())
+
+
+def search_jokes(connection, terms: str, user_id: int = None,
+                 limit: int = 20, offset: int = 0) -> list:
+    """
+    Jokes matching every word, best bm25 rank first
+    :param connection: SQLAlchemy connection or session
+    :param terms: search input
+    :param user_id: only search this User's Jokes if given
+    :param limit: page size
+    :param offset: rows to skip
+    :return: list of (joke_id, content)
+    """
+    return connection.execute(SEARCH, dict(
+        expression=match_expression(terms), user_id=user_id,
+        limit=limit, offset=offset,
+    )).fetchall()
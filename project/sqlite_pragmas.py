@@ -0,0 +1,24 @@
+"""Per-connection PRAGMA settings for SQLite engines"""
+from sqlalchemy import event
+
+
+def apply_pragmas(engine, pragmas: dict):
+    """
+    Run the PRAGMA statements on every new connection of the engine.
+    journal_mode=WAL is stored in the database file, the rest
+    only lasts as long as the connection
+    :param engine: SQLAlchemy engine of a SQLite database
+    :param pragmas: dict of pragma name to value, applied in order
+    :return: None
+    """
+    statements = ['PRAGMA %s=%s' % (name, value)
+                  for name, value in pragmas.items()]
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
@@ -0,0 +1,265 @@
+"""Synthetic Users, Jokes and Actions bulk-loaded for scale testing"""
+import random
+import sqlite3
+import time
+from datetime import datetime
+from itertools import accumulate
+from itertools import islice
+
+from sqlalchemy import text
+
+from .analytics import count_logged_actions
+from .minhash import signature
+from .models import content_digest
+from .models import index_minhashes
+
+USERNAME = 'synthetic%d'
+
+# Share of the Actions logged on each path
+PATH_WEIGHTS = {
+    '/my-jokes': 30,
+    '/get-joke-by-id': 25,
+    '/random-joke': 12,
+    '/search-jokes': 10,
+    '/login': 8,
+    '/create-joke': 6,
+    '/update-joke': 3,
+    '/activity': 2,
+    '/import-joke': 2,
+    '/delete-joke': 1,
+    '/create-jokes': 1,
+}
+
+WORDS = (
+    'a', 'the', 'and', 'why', 'did', 'walks', 'into', 'bar', 'says', 'what',
+    'do', 'you', 'call', 'with', 'no', 'because', 'it', 'was', 'too', 'my',
+    'wife', 'told', 'me', 'stop', 'doctor', 'programmer', 'chicken', 'road',
+    'cross', 'other', 'side', 'knock', 'who', 'there', 'horse', 'long',
+    'face', 'cow', 'moo', 'fish', 'eyes', 'ghost', 'boo', 'bear', 'teddy',
+    'full', 'stuffed', 'atom', 'trust', 'make', 'everything', 'up', 'bug',
+    'feature', 'coffee', 'tea', 'skeleton', 'guts', 'scarecrow', 'award',
+    'outstanding', 'field', 'math', 'book', 'problems', 'calendar', 'days',
+    'numbered', 'elevator', 'uplifting', 'penguin', 'ice', 'breaker',
+    'pirate', 'arr', 'keyboard', 'space', 'lamp', 'light', 'joke', 'dad',
+    'pun', 'cheese', 'nacho', 'yours', 'banana', 'split', 'tomato', 'ketchup',
+    'computer', 'cold', 'windows', 'open', 'cat', 'purr', 'dog', 'bark',
+    'wizard', 'spell', 'vampire', 'bat', 'snowman', 'carrot', 'cookie',
+    'crumbs', 'moon', 'rocket', 'cactus', 'point', 'violin', 'string',
+)
+
+# Bound parameters per statement, the limit was raised in 3.32
+MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32) else 999
+
+
+def zipf_weights(rng: random.Random, bins: int, skew: float) -> list:
+    """
+    Weights of the bins following Zipf's law, 1 / rank ** skew,
+    with the ranks shuffled so that the hot bins are anywhere
+    :param rng: seeded random generator
+    :param bins: number of weights
+    :param skew: 0.0 is uniform, higher gets more skewed
+    :return: list of weights
+    """
+    weights = [1.0 / rank ** skew for rank in range(1, bins + 1)]
+    rng.shuffle(weights)
+    return weights
+
+
+def allocate(total: int, weights: list, cap: int = None) -> list:
+    """
+    Split the total between the bins in proportion to their
+    weights, none of them over the cap. What a capped bin
+    cannot take goes to the others
+    :param total: items to split
+    :param weights: weight of every bin
+    :param cap: most items of one bin, no limit if None
+    :return: list of counts, summing to the total unless
+    every bin is full
+    """
+    counts = [0] * len(weights)
+    open_bins = [index for index, weight in enumerate(weights) if weight > 0]
+    while total > 0 and open_bins:
+        share = sum(weights[index] for index in open_bins)
+        given = 0
+        for index in open_bins:
+            count = int(total * weights[index] / share)
+            if cap is not None:
+                count = min(count, cap - counts[index])
+            counts[index] += count
+            given += count
+        if not given:
+            # Less than one item per bin is left, heaviest bins first
+            heaviest = sorted(open_bins, key=weights.__getitem__,
+                              reverse=True)
+            for index in heaviest[:total]:
+                counts[index] += 1
+                given += 1
+        total -= given
+        if cap is not None:
+            open_bins = [index for index in open_bins if counts[index] < cap]
+    return counts
+
+
+def insert_rows(engine, table: str, columns: tuple, rows,
+                statement_rows: int = 500,
+                transaction_rows: int = 250000) -> int:
+    """
+    Load rows with multi-row INSERT statements, several
+    statements per transaction, past the ORM and its events
+    :param engine: SQLAlchemy engine
+    :param table: table name
+    :param columns: column names, in the order of the row values
+    :param rows: iterable of value tuples
+    :param statement_rows: rows per INSERT
+    :param transaction_rows: rows per transaction
+    :return: number of rows inserted
+    """
+    per_statement = max(1, min(statement_rows,
+                               MAX_VARIABLES // len(columns)))
+    head = 'INSERT INTO %s (%s) VALUES ' % (table, ', '.join(columns))
+    placeholders = '(%s)' % ', '.join('?' * len(columns))
+    full = head + ', '.join([placeholders] * per_statement)
+
+    rows = iter(rows)
+    inserted = 0
+    while True:
+        in_transaction = 0
+        with engine.begin() as connection:
+            cursor = connection.connection.cursor()
+            while in_transaction < transaction_rows:
+                chunk = list(islice(rows, per_statement))
+                if not chunk:
+                    break
+                statement = full if len(chunk) == per_statement \
+                    else head + ', '.join([placeholders] * len(chunk))
+                cursor.execute(statement,
+                               [value for row in chunk for value in row])
+                in_transaction += len(chunk)
+        inserted += in_transaction
+        if in_transaction < transaction_rows:
+            return inserted
+
+
+def make_joke(rng: random.Random, joke_id: int) -> str:
+    """
+    Joke text of 6 to 40 words, unique through its joke_id
+    :param rng: seeded random generator
+    :param joke_id: id of the Joke
+    :return: content
+    """
+    words = rng.choices(WORDS, k=rng.randint(6, 40))
+    return 'Joke #%d: %s.' % (joke_id, ' '.join(words).capitalize())
+
+
+def generate(engine, users: int, jokes: int, actions: int, password: str,
+             joke_skew: float = 1.0, action_skew: float = 1.0,
+             paths: dict = None, days: float = 30.0, joke_limit: int = None,
+             minhash: bool = False, seed: int = 0,
+             statement_rows: int = 500,
+             transaction_rows: int = 250000) -> dict:
+    """
+    Add Users, their Jokes and logged Actions to the database,
+    after the rows already there. Jokes and Actions are spread
+    over the Users by Zipf weights. The Actions are in time order
+    over the last 'days' days, and their activity counts are
+    added to action_count
+    :param engine: engine of a migrated database
+    :param users: Users to add
+    :param jokes: Jokes to add, fewer if every User reaches joke_limit
+    :param actions: Actions to add
+    :param password: password hash every User gets
+    :param joke_skew: Zipf exponent of the Jokes per User
+    :param action_skew: Zipf exponent of the Actions per User
+    :param paths: dict of action_path to weight, PATH_WEIGHTS if None
+    :param days: time span of the Actions
+    :param joke_limit: most Jokes of one User, no limit if None
+    :param minhash: compute MinHash signatures for near-duplicate
+    detection, slow at about 2.5ms a Joke, else they are left NULL
+    :param seed: seed of the random generator, for the same data
+    :param statement_rows: rows per INSERT
+    :param transaction_rows: rows per transaction
+    :return: dict of users, jokes, actions, counts added, the
+    first_user_id and the seconds it took
+    :raise ValueError: for negative amounts, or Jokes or Actions
+    without Users to own them
+    """
+    if min(users, jokes, actions) < 0:
+        raise ValueError('Users, jokes and actions cannot be negative')
+    if not users and (jokes or actions):
+        raise ValueError('Jokes and actions need at least one user')
+    if actions and not any(weight > 0 for weight in (
+            PATH_WEIGHTS if paths is None else paths).values()):
+        raise ValueError('Actions need a path of positive weight')
+
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    paths = PATH_WEIGHTS if paths is None else paths
+    with engine.connect() as connection:
+        first_user, first_joke, first_action = (connection.execute(text(
+            'SELECT coalesce(max(%s), 0) + 1 FROM %s' % (column, table)
+        )).scalar() for column, table in (
+            ('id', '"user"'), ('joke_id', 'joke'), ('action_id', 'action')))
+    user_ids = range(first_user, first_user + users)
+
+    joke_counts = allocate(jokes, zipf_weights(rng, users, joke_skew),
+                           joke_limit)
+    insert_rows(engine, '"user"',
+                ('id', 'username', 'password', 'joke_count',
+                 'jokes_version'),
+                ((user_id, USERNAME % user_id, password, count, 0)
+                 for user_id, count in zip(user_ids, joke_counts)),
+                statement_rows, transaction_rows)
+
+    owners = [user_id for user_id, count in zip(user_ids, joke_counts)
+              for _ in range(count)]
+    rng.shuffle(owners)
+
+    def joke_rows():
+        for joke_id, user_id in enumerate(owners, first_joke):
+            content = make_joke(rng, joke_id)
+            yield (joke_id, content, content_digest(content),
+                   signature(content) if minhash else None, user_id)
+
+    added_jokes = insert_rows(
+        engine, 'joke',
+        ('joke_id', 'content', 'content_hash', 'minhash', 'user_id'),
+        joke_rows(), statement_rows, transaction_rows)
+    if minhash:
+        with engine.begin() as connection:
+            index_minhashes(connection, connection.execute(text(
+                'SELECT joke_id, minhash FROM joke WHERE joke_id >= :first'
+            ), first=first_joke).fetchall())
+
+    # Cumulative weights are what random.choices() bisects
+    user_weights = list(accumulate(zipf_weights(rng, users, action_skew)))
+    path_names = list(paths)
+    path_weights = list(accumulate(paths[path] for path in path_names))
+    end = time.time()
+    start = end - days * 86400
+
+    def action_rows(block: int = 10000):
+        for offset in range(0, actions, block):
+            size = min(block, actions - offset)
+            actors = rng.choices(user_ids, cum_weights=user_weights, k=size)
+            logged = rng.choices(path_names, cum_weights=path_weights,
+                                 k=size)
+            for index, (user_id, path) in enumerate(zip(actors, logged)):
+                moment = start + (offset + index + rng.random()) * (
+                    end - start) / actions
+                yield ('10.%d.%d.%d' % (user_id >> 16 & 255,
+                                        user_id >> 8 & 255, user_id & 255),
+                       datetime.fromtimestamp(moment).strftime(
+                           '%Y-%m-%d %H:%M:%S.%f'),
+                       path, user_id)
+
+    added_actions = insert_rows(
+        engine, 'action',
+        ('user_ip_address', 'action_time', 'action_path', 'user_id'),
+        action_rows(), statement_rows, transaction_rows)
+    with engine.begin() as connection:
+        counts = count_logged_actions(connection, first_action) \
+            if added_actions else 0
+
+    return dict(users=users, jokes=added_jokes, actions=added_actions,
+                counts=counts, first_user_id=first_user,
+                seconds=time.perf_counter() - started)
@@ -1,12 +1,81 @@
 from project.models import db
 from project.models import Joke
+from project.models import JokeBand
+from project.models import RevokedToken
 from project.models import User
+from project.models import Action
+from project.models import ActionCount
+from project.models import content_digest
 from project import create_app
+from project import action_log
+from project import user_cache
+from project import joke_cache
+from project import password_hasher
+from project import foreign_apis
+from project import prefetcher
+from project import token_denylist
+from project import rate_limiter
+from project import metrics
+from project import query_profiler
+from project import action_buffer
+from project.action_buffer import ActionLog
+from project.migrations import MIGRATIONS
+from project.migrations import applied_versions
+from project.migrations import pending_migrations
+from project.migrations import schema_is_current
+from project.migrations import upgrade_schema
+from project.user_cache import Credentials
+from project.user_cache import UserCache
+from project.hashing import HashingBusy
+from project.hashing import PasswordHasher
+from project.hashing import cost_of
+from project.sqlite_pragmas import apply_pragmas
+from project.maintenance import archive_path
+from project.maintenance import maintain_actions
+from project.maintenance import prune_counts
+from project import analytics
+from project.analytics import GRANULARITIES
+from project.analytics import count_actions
+from project.analytics import count_logged_actions
+from project.minhash import BANDS
+from project.minhash import signature
+from project.minhash import similarity
+from project.near_duplicates import near_duplicates_in_catalogue
+from project.prefetch import JokePrefetcher
+from project.metrics import Metrics
+from project.query_profiler import QueryBudgetExceeded
+from project.rate_limit import RateLimiter
+from project.revocation import BloomFilter
+from project.revocation import TokenDenylist
+from project.sampling import catalogue_ids
+from project.sampling import random_joke
+from project.search import SEARCH_TABLES
+from project.search import match_expression
+from project.search import rebuild_search_index
+from project.synthetic import allocate
+from project.synthetic import generate
+from config import ProductionConfig
 import sys
 import os
 import unittest
 import json
 import random
+import gzip
+import multiprocessing
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import UnmappedInstanceError
 # Fixes the relative import issue for Travis CI
 sys.path.append(os.getcwd() + '/..')
@@ -31,7 +100,9 @@ class TestIfTablesExist(unittest.TestCase):
                     set(db.engine.table_names()).difference(
                         set([table.__tablename__ for table
                              in db.Model.__subclasses__()])
-                    )),
+                    ).difference(SEARCH_TABLES)
+                    # Where SQLite keeps the AUTOINCREMENT counters
+                    .difference({'sqlite_sequence'})),
                 0)
 
 
@@ -286,6 +357,8 @@ class BasicJokesResourceTestCase(unittest.TestCase):
     Test-case 1: create joke with proper parameters
     Test-case 2: attempt to create over-sized joke
     Test-case 3: attempt to create joke without content
+    Test-case 4: attempt to create the same joke twice
+    Test-case 5: attempt to create a re-cased/re-spaced copy
     """
 
     access_token = None
@@ -440,6 +513,26 @@ class BasicJokesResourceTestCase(unittest.TestCase):
 
         self.assertEqual(response.status_code, 403)
 
+    def test_attempt_create_reworded_whitespace_and_case(self):
+        """
+        Duplicates are detected on normalized content, so a copy
+        that differs only in case and whitespace is refused
+        """
+        BasicJokesResourceTestCase.create_joke(
+            content=app.config['FAKE_JOKE'],
+            access_token=self.access_token
+        )
+
+        response = BasicJokesResourceTestCase.create_joke(
+            content='  ' + app.config['FAKE_JOKE'].upper().replace(
+                ' ', '   '),
+            access_token=self.access_token,
+            feedback=True
+        )
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data, b'This joke already exists')
+
     def test_fail_on_omitting_content(self):
         """
         Test if omitting 'content' in request parameters
@@ -557,6 +650,9 @@ class GetAllJokeOfUserTestCase(unittest.TestCase):
     Test retrieving all User's jokes
     Test-case 1: User has jokes, request to retrieve
     Test-case 2: User has no jokes, request to retrieve
+    Test-case 3: User pages through jokes with the cursor
+    Test-case 4: User streams all jokes
+    Test-case 5: User passes a bad cursor or page size
     """
 
     access_token = None
@@ -617,6 +713,47 @@ class GetAllJokeOfUserTestCase(unittest.TestCase):
 
         self.assertEqual(response.status_code, 204)
 
+    def get_my_jokes(self, **params):
+        response = tester.get('/my-jokes', query_string=params, headers=dict(
+            Authorization='Bearer ' + self.access_token))
+        if not response.is_json:
+            return response, None
+        return response, json.loads(response.data.decode('utf-8'))
+
+    def test_pages_follow_the_cursor(self):
+        """
+        With a page size of 1 the two jokes come on two pages,
+        keyed by their real joke_id
+        """
+        response, first = self.get_my_jokes(limit=1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(first['jokes'], [dict(
+            joke_id=1, content=app.config['FAKE_JOKE'])])
+        self.assertTrue(first['next_cursor'])
+
+        response, second = self.get_my_jokes(
+            limit=1, cursor=first['next_cursor'])
+
+        self.assertEqual(second['jokes'], [dict(
+            joke_id=2, content=app.config['ANOTHER_FAKE_JOKE'])])
+        self.assertIsNone(second['next_cursor'])
+
+    def test_streamed_jokes(self):
+        """
+        The streaming mode returns every joke in one document
+        """
+        response, document = self.get_my_jokes(stream=1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([joke['joke_id'] for joke in document['jokes']],
+                         [1, 2])
+
+    def test_bad_cursor_or_limit(self):
+        for params in (dict(cursor='!!'), dict(limit=0), dict(limit='x')):
+            response, _ = self.get_my_jokes(**params)
+            self.assertEqual(response.status_code, 400)
+
     def tearDown(self):
         RegistrationResourceTestCase.delete_user(
             username=app.config['FAKE_USER']
@@ -630,6 +767,7 @@ class UpdateJokeTestCase(unittest.TestCase):
     Test-case 2: Joke does not exist, but patch it
     Test-case 3: Request to patch Joke but do not pass its joke_id
     Test-case 4: Request to patch existing Joke with huge string
+    Test-case 5: Request to patch Joke into a copy of another Joke
     """
 
     @staticmethod
@@ -653,7 +791,7 @@ class UpdateJokeTestCase(unittest.TestCase):
         """
         We presume that User has two non-identical jokes
         First, we assert that Joke.content by joke_id 1
-        is not equal to ANOTHER_FAKE_JOKE
+        is not equal to YET_ANOTHER_FAKE_JOKE
         :return: 204 No Content
         """
 
@@ -661,27 +799,47 @@ class UpdateJokeTestCase(unittest.TestCase):
             BasicJokesResourceTestCase.get_joke_object(
                 user_id=self.user_id,
                 by_joke_id=1,
-                content=app.config['ANOTHER_FAKE_JOKE']
+                content=app.config['YET_ANOTHER_FAKE_JOKE']
             ).content,
-            app.config['ANOTHER_FAKE_JOKE'])
+            app.config['YET_ANOTHER_FAKE_JOKE'])
 
         # Here we modify Joke.content by joke_id 1
-        # to match ANOTHER_FAKE_JOKE
+        # to match YET_ANOTHER_FAKE_JOKE
         response = UpdateJokeTestCase.send_patch(
             joke_id=1,
             access_token=self.access_token,
-            content=app.config['ANOTHER_FAKE_JOKE']
+            content=app.config['YET_ANOTHER_FAKE_JOKE']
         )
 
         self.assertEqual(response.status_code, 204)
 
         # Here we assert that Joke.content by joke_id 1
-        # is now equal to ANOTHER_FAKE_JOKE
+        # is now equal to YET_ANOTHER_FAKE_JOKE
+        self.assertEqual(
+            BasicJokesResourceTestCase.get_joke_object(
+                user_id=self.user_id, by_joke_id=1
+            ).content,
+            app.config['YET_ANOTHER_FAKE_JOKE'])
+
+    def test_attempt_to_patch_into_existing_joke(self):
+        """
+        Joke content is unique, so patching joke_id 1
+        into a copy of ANOTHER_FAKE_JOKE is refused
+        :return: 403 Forbidden
+        """
+        response = UpdateJokeTestCase.send_patch(
+            joke_id=1,
+            access_token=self.access_token,
+            content=app.config['ANOTHER_FAKE_JOKE']
+        )
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data, b'This joke already exists')
         self.assertEqual(
             BasicJokesResourceTestCase.get_joke_object(
                 user_id=self.user_id, by_joke_id=1
             ).content,
-            app.config['ANOTHER_FAKE_JOKE'])
+            app.config['FAKE_JOKE'])
 
     def test_attempt_to_patch_nonexistent_joke(self):
         response = UpdateJokeTestCase.send_patch(
@@ -874,5 +1032,2214 @@ class TestImportJokeTestCase(unittest.TestCase):
         self.assertEqual(response.data, b'This source is not supported')
 
 
+class ActionLogTestCase(unittest.TestCase):
+    """
+    Test the write-behind Action log
+    Test-case 1: queued actions are written on flush
+    Test-case 2: overflowing the queue counts dropped entries
+    Test-case 3: protected endpoints queue an action
+    Test-case 4: actions are kept when counting them fails,
+    and counted on the next flush
+    """
+
+    class FakeRequest:
+        remote_addr = '127.0.0.1'
+        path = '/action-log-test'
+
+    def make_action_log(self, queue_size, policy='drop-newest'):
+        """
+        Build a standalone ActionLog with a small queue
+        :param queue_size: queue bound
+        :param policy: overflow policy
+        :return: ActionLog
+        """
+        action_log = ActionLog()
+        action_log.init_app(app)
+        action_log.queue.maxsize = queue_size
+        action_log.overflow_policy = policy
+        # Keep the background writer out of the way
+        action_log._ensure_writer = lambda: None
+        return action_log
+
+    @staticmethod
+    def count_test_actions():
+        with app.app_context():
+            return Action.query.filter_by(
+                action_path='/action-log-test').count()
+
+    def test_flush_writes_queued_actions(self):
+        action_log = self.make_action_log(queue_size=10)
+        for _ in range(3):
+            action_log.record(self.FakeRequest, user_id=0)
+
+        self.assertEqual(action_log.pending, 3)
+        self.assertEqual(action_log.flush(), 3)
+        self.assertEqual(action_log.pending, 0)
+        self.assertEqual(self.count_test_actions(), 3)
+
+    def test_overflow_counts_dropped_entries(self):
+        for policy in ('drop-newest', 'drop-oldest'):
+            action_log = self.make_action_log(queue_size=2, policy=policy)
+            for _ in range(5):
+                action_log.record(self.FakeRequest, user_id=0)
+
+            self.assertEqual(action_log.pending, 2)
+            self.assertEqual(action_log.dropped, 3)
+            action_log.flush()
+
+    def test_protected_endpoint_queues_action(self):
+        access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        user_id = RegistrationResourceTestCase.get_user_id(
+            app.config['FAKE_USER'])
+
+        tester.get('/my-jokes', headers=dict(
+            Authorization='Bearer ' + access_token))
+        action_log.flush()
+
+        with app.app_context():
+            self.assertTrue(Action.query.filter_by(
+                user_id=user_id, action_path='/my-jokes').first())
+
+    @staticmethod
+    def count_test_day():
+        with app.app_context():
+            return db.session.query(func.sum(ActionCount.count)).filter_by(
+                granularity='day',
+                action_path='/action-log-test').scalar() or 0
+
+    def test_failed_counts_keep_actions(self):
+        action_log = self.make_action_log(queue_size=10)
+        for _ in range(3):
+            action_log.record(self.FakeRequest, user_id=0)
+        counted = self.count_test_day()
+
+        def fail(connection, *args):
+            raise RuntimeError('action_count is locked')
+
+        functions = (action_buffer.count_actions,
+                     action_buffer.count_logged_actions)
+        action_buffer.count_actions = fail
+        action_buffer.count_logged_actions = fail
+        try:
+            self.assertEqual(action_log.flush(), 3)
+        finally:
+            (action_buffer.count_actions,
+             action_buffer.count_logged_actions) = functions
+
+        self.assertEqual(self.count_test_actions(), 3)
+        self.assertEqual(action_log.written, 3)
+        self.assertEqual(action_log.dropped, 0)
+        self.assertEqual(action_log.uncounted, 3)
+        self.assertEqual(self.count_test_day(), counted)
+
+        # The next flush counts them from the table
+        action_log.flush()
+
+        self.assertEqual(action_log.uncounted, 0)
+        # User 0 is ALL_USERS as well, every action is counted twice
+        self.assertEqual(self.count_test_day(), counted + 6)
+
+    def tearDown(self):
+        with app.app_context():
+            Action.query.filter_by(
+                action_path='/action-log-test').delete()
+            db.session.commit()
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class JokeCounterTestCase(unittest.TestCase):
+    """
+    Test the denormalized User.joke_count
+    Test-case 1: creating and deleting jokes keeps the count in sync
+    Test-case 2: creating a joke over the limit is refused
+    """
+
+    def setUp(self):
+        self.access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        self.user_id = RegistrationResourceTestCase.get_user_id(
+            app.config['FAKE_USER']
+        )
+        self.jokes_limit = app.config['JOKES_LIMIT']
+
+    def get_joke_count(self):
+        with app.app_context():
+            return User.query.get(self.user_id).joke_count
+
+    def test_count_follows_create_and_delete(self):
+        for content in (app.config['FAKE_JOKE'],
+                        app.config['ANOTHER_FAKE_JOKE']):
+            BasicJokesResourceTestCase.create_joke(
+                content=content, access_token=self.access_token)
+        self.assertEqual(self.get_joke_count(), 2)
+
+        # A refused duplicate does not take a slot
+        BasicJokesResourceTestCase.create_joke(
+            content=app.config['FAKE_JOKE'], access_token=self.access_token)
+        self.assertEqual(self.get_joke_count(), 2)
+
+        this_joke = BasicJokesResourceTestCase.get_joke_object(
+            user_id=self.user_id, content=app.config['FAKE_JOKE'])
+        DeleteJokeTestCase.delete_joke_by_joke_id(
+            joke_id=this_joke.joke_id, access_token=self.access_token)
+        self.assertEqual(self.get_joke_count(), 1)
+
+    def test_create_over_the_limit_is_refused(self):
+        app.config['JOKES_LIMIT'] = 1
+        BasicJokesResourceTestCase.create_joke(
+            content=app.config['FAKE_JOKE'], access_token=self.access_token)
+
+        response = BasicJokesResourceTestCase.create_joke(
+            content=app.config['ANOTHER_FAKE_JOKE'],
+            access_token=self.access_token,
+            feedback=True
+        )
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data, b'Your jokes collection is full')
+        self.assertEqual(self.get_joke_count(), 1)
+
+    def tearDown(self):
+        app.config['JOKES_LIMIT'] = self.jokes_limit
+        DeleteJokeTestCase.delete_all_user_jokes(self.user_id)
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class UserCacheTestCase(unittest.TestCase):
+    """
+    Test the username -> credentials cache behind /login
+    Test-case 1: a repeated login is served from the cache
+    Test-case 2: deleting and re-registering a user invalidates it
+    Test-case 3: the cache stays within its size bound
+    Test-case 4: a change by another worker is seen after the TTL
+    """
+
+    def setUp(self):
+        RegistrationResourceTestCase.register_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+
+    def test_repeated_login_hits_the_cache(self):
+        LoginTestCase.login_fake_user(
+            app.config['FAKE_USER'], app.config['FAKE_USER_PASSWORD'])
+        hits = user_cache.hits
+
+        response = LoginTestCase.login_fake_user(
+            app.config['FAKE_USER'], app.config['FAKE_USER_PASSWORD'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(user_cache.hits, hits + 1)
+
+    def test_delete_and_register_again_invalidates(self):
+        LoginTestCase.login_fake_user(
+            app.config['FAKE_USER'], app.config['FAKE_USER_PASSWORD'])
+        RegistrationResourceTestCase.delete_user(app.config['FAKE_USER'])
+
+        response = LoginTestCase.login_fake_user(
+            app.config['FAKE_USER'], app.config['FAKE_USER_PASSWORD'])
+        self.assertEqual(response.data, b'No such user')
+
+        RegistrationResourceTestCase.register_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['JOKE_FAKE_USER_PASSWORD']
+        )
+        response = LoginTestCase.login_fake_user(
+            app.config['FAKE_USER'], app.config['JOKE_FAKE_USER_PASSWORD'])
+
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            self.assertEqual(
+                user_cache.get(app.config['FAKE_USER']).id,
+                RegistrationResourceTestCase.get_user_id(
+                    app.config['FAKE_USER']))
+
+    def test_cache_is_bounded(self):
+        cache = UserCache()
+        cache.entries.maxsize = 2
+        for user_id, username in enumerate(('first', 'second', 'third')):
+            cache.put(username, Credentials(user_id, 'hash'))
+
+        self.assertEqual(len(cache), 2)
+        with app.app_context():
+            self.assertIsNone(cache.get('first'))
+
+    def test_change_by_another_worker_expires(self):
+        ttl = user_cache.entries.ttl
+        user_cache.entries.ttl = 0.05
+        try:
+            LoginTestCase.login_fake_user(
+                app.config['FAKE_USER'], app.config['FAKE_USER_PASSWORD'])
+            # Past the ORM, as another worker deletes the user
+            with app.app_context(), db.engine.begin() as connection:
+                connection.execute(User.__table__.delete().where(
+                    User.username == app.config['FAKE_USER']))
+            time.sleep(0.1)
+
+            response = LoginTestCase.login_fake_user(
+                app.config['FAKE_USER'], app.config['FAKE_USER_PASSWORD'])
+        finally:
+            user_cache.entries.ttl = ttl
+
+        self.assertEqual(response.data, b'No such user')
+
+    def tearDown(self):
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class PasswordHashingTestCase(unittest.TestCase):
+    """
+    Test the pooled password hashing
+    Test-case 1: a hash at an older cost is upgraded on login
+    Test-case 2: a saturated pool answers 503 with Retry-After
+    Test-case 3: a pool whose worker died is replaced
+    Test-case 4: a timed out call keeps its slot until it finishes
+    """
+
+    def setUp(self):
+        self.rounds = password_hasher.rounds
+        self.slots = password_hasher._slots
+
+    @staticmethod
+    def get_stored_cost(username):
+        return cost_of(
+            RegistrationResourceTestCase.get_user_object(username).password)
+
+    def test_login_upgrades_old_cost_hash(self):
+        password_hasher.rounds = 4
+        RegistrationResourceTestCase.register_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        self.assertEqual(self.get_stored_cost(app.config['FAKE_USER']), 4)
+
+        password_hasher.rounds = 5
+        response = LoginTestCase.login_fake_user(
+            app.config['FAKE_USER'], app.config['FAKE_USER_PASSWORD'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_stored_cost(app.config['FAKE_USER']), 5)
+
+        # The upgraded hash still verifies
+        response = LoginTestCase.login_fake_user(
+            app.config['FAKE_USER'], app.config['FAKE_USER_PASSWORD'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_saturated_pool_answers_503(self):
+        password_hasher._slots = threading.BoundedSemaphore(1)
+        password_hasher._slots.acquire()
+
+        response = RegistrationResourceTestCase.register_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD'],
+            feedback=True
+        )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertIsNone(RegistrationResourceTestCase.get_user_object(
+            app.config['FAKE_USER']))
+
+    @staticmethod
+    def make_hasher(slots, timeout=5.0):
+        hasher = PasswordHasher()
+        hasher.rounds = 4
+        hasher.workers = 1
+        hasher.timeout = timeout
+        hasher._slots = threading.BoundedSemaphore(slots)
+        return hasher
+
+    # Run in a new interpreter, a pool process left behind
+    # makes it hang at exit
+    BROKEN_POOL = '''
+import os
+import threading
+from project.hashing import HashingBusy, PasswordHasher, cost_of
+
+hasher = PasswordHasher()
+hasher.rounds, hasher.workers, hasher.timeout = 4, 1, 5.0
+hasher._slots = threading.BoundedSemaphore(2)
+try:
+    hasher._run(os._exit, 1)
+except HashingBusy:
+    print('busy')
+print(cost_of(hasher.generate('password')))
+hasher.shutdown()
+'''
+
+    def test_broken_pool_is_replaced(self):
+        finished = subprocess.run(
+            [sys.executable, '-c', self.BROKEN_POOL], capture_output=True,
+            text=True, timeout=60,
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__)))))
+
+        self.assertEqual(finished.returncode, 0, finished.stderr)
+        self.assertEqual(finished.stdout.split(), ['busy', '4'])
+        self.assertNotIn('Traceback', finished.stderr)
+
+    def test_timed_out_call_keeps_its_slot(self):
+        hasher = self.make_hasher(slots=1, timeout=0.2)
+        try:
+            with self.assertRaises(HashingBusy):
+                hasher._run(time.sleep, 1.0)
+            # Still running in the pool
+            with self.assertRaises(HashingBusy):
+                hasher._run(time.sleep, 0)
+
+            time.sleep(1.5)
+            self.assertIsNone(hasher._run(time.sleep, 0))
+        finally:
+            hasher.shutdown()
+
+    def tearDown(self):
+        password_hasher.rounds = self.rounds
+        password_hasher._slots = self.slots
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class BulkCreateJokesTestCase(unittest.TestCase):
+    """
+    Test creating jokes in bulk
+    Test-case 1: every item gets its own status
+    Test-case 2: items over the remaining quota are refused
+    Test-case 3: a body that is not an array of strings is refused
+    Test-case 4: one action is logged for the batch
+    """
+
+    def setUp(self):
+        self.access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        self.user_id = RegistrationResourceTestCase.get_user_id(
+            app.config['FAKE_USER']
+        )
+        self.jokes_limit = app.config['JOKES_LIMIT']
+
+    def create_jokes(self, contents):
+        return tester.put('/create-jokes', json=contents, headers=dict(
+            Authorization='Bearer ' + self.access_token))
+
+    @staticmethod
+    def statuses(response):
+        return [item['status'] for item in json.loads(
+            response.data.decode('utf-8'))['results']]
+
+    def test_statuses_of_items(self):
+        BasicJokesResourceTestCase.create_joke(
+            content=app.config['FAKE_JOKE'], access_token=self.access_token)
+
+        response = self.create_jokes([
+            app.config['ANOTHER_FAKE_JOKE'],
+            app.config['FAKE_JOKE'],
+            BasicJokesResourceTestCase.humongous_string,
+            app.config['ANOTHER_FAKE_JOKE'].upper(),
+            app.config['YET_ANOTHER_FAKE_JOKE'],
+        ])
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.statuses(response), [
+            'created', 'duplicate', 'too long', 'duplicate', 'created'])
+        self.assertEqual(GetAllJokeOfUserTestCase.get_user_joke_count(
+            self.user_id), 3)
+        with app.app_context():
+            self.assertEqual(User.query.get(self.user_id).joke_count, 3)
+
+    def test_items_over_quota(self):
+        app.config['JOKES_LIMIT'] = 2
+        BasicJokesResourceTestCase.create_joke(
+            content=app.config['FAKE_JOKE'], access_token=self.access_token)
+
+        response = self.create_jokes([app.config['ANOTHER_FAKE_JOKE'],
+                                      app.config['YET_ANOTHER_FAKE_JOKE']])
+
+        self.assertEqual(self.statuses(response), ['created', 'over quota'])
+        self.assertEqual(GetAllJokeOfUserTestCase.get_user_joke_count(
+            self.user_id), 2)
+
+    def test_malformed_body(self):
+        for body in ([], {'content': 'x'}, ['fine', 42]):
+            response = self.create_jokes(body)
+            self.assertEqual(response.status_code, 400)
+
+    def count_bulk_actions(self):
+        action_log.flush()
+        with app.app_context():
+            return Action.query.filter_by(
+                user_id=self.user_id, action_path='/create-jokes').count()
+
+    def test_one_action_per_batch(self):
+        before = self.count_bulk_actions()
+
+        self.create_jokes([app.config['FAKE_JOKE'],
+                           app.config['ANOTHER_FAKE_JOKE']])
+
+        self.assertEqual(self.count_bulk_actions(), before + 1)
+
+    def tearDown(self):
+        app.config['JOKES_LIMIT'] = self.jokes_limit
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class ConditionalGetTestCase(unittest.TestCase):
+    """
+    Test ETags of the joke read endpoints
+    Test-case 1: a matching If-None-Match yields 304
+    Test-case 2: every kind of write changes the ETag
+    Test-case 3: get-joke-by-id honours the ETag as well
+    Test-case 4: every Joke of get-joke-by-id has its own ETag
+    """
+
+    def setUp(self):
+        retrieve_joke_test_case_object = RetrieveJokeTestCase()
+        retrieve_joke_test_case_object.setUp()
+
+        self.access_token = retrieve_joke_test_case_object.access_token
+        self.user_id = retrieve_joke_test_case_object.user_id
+
+    def get_my_jokes(self, etag=None):
+        headers = dict(Authorization='Bearer ' + self.access_token)
+        if etag:
+            headers['If-None-Match'] = etag
+        return tester.get('/my-jokes', headers=headers)
+
+    def test_matching_etag_yields_304(self):
+        etag = self.get_my_jokes().headers['ETag']
+
+        response = self.get_my_jokes(etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_writes_change_the_etag(self):
+        writes = [
+            lambda: BasicJokesResourceTestCase.create_joke(
+                content=app.config['ANOTHER_FAKE_JOKE'],
+                access_token=self.access_token),
+            lambda: UpdateJokeTestCase.send_patch(
+                joke_id=1, access_token=self.access_token,
+                content=app.config['YET_ANOTHER_FAKE_JOKE']),
+            lambda: DeleteJokeTestCase.delete_joke_by_joke_id(
+                joke_id=1, access_token=self.access_token),
+        ]
+        for write in writes:
+            etag = self.get_my_jokes().headers['ETag']
+            write()
+            self.assertEqual(self.get_my_jokes(etag).status_code, 200)
+
+    def test_get_joke_by_id_yields_304(self):
+        headers = dict(Authorization='Bearer ' + self.access_token)
+        etag = tester.get('/get-joke-by-id', data=dict(joke_id=1),
+                          headers=headers).headers['ETag']
+        headers['If-None-Match'] = etag
+
+        response = tester.get('/get-joke-by-id', data=dict(joke_id=1),
+                              headers=headers)
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_get_joke_by_id_etag_names_the_joke(self):
+        BasicJokesResourceTestCase.create_joke(
+            content=app.config['ANOTHER_FAKE_JOKE'],
+            access_token=self.access_token)
+        headers = dict(Authorization='Bearer ' + self.access_token)
+        etags = [tester.get('/get-joke-by-id', data=dict(joke_id=joke_id),
+                            headers=headers).headers['ETag']
+                 for joke_id in (1, 2)]
+        headers['If-None-Match'] = etags[0]
+
+        response = tester.get('/get-joke-by-id', data=dict(joke_id=2),
+                              headers=headers)
+
+        self.assertTrue(etags[0].endswith('-j1"'))
+        self.assertNotEqual(etags[0], etags[1])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data,
+                         app.config['ANOTHER_FAKE_JOKE'].encode())
+
+    def tearDown(self):
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class JokeCacheTestCase(unittest.TestCase):
+    """
+    Test the read-through cache behind get-joke-by-id
+    Test-case 1: a repeated read is a cache hit
+    Test-case 2: update and delete invalidate the entry
+    Test-case 3: entries expire after the TTL
+    Test-case 4: the cache can be switched off
+    Test-case 5: a write in another worker makes the entry a miss
+    """
+
+    def setUp(self):
+        retrieve_joke_test_case_object = RetrieveJokeTestCase()
+        retrieve_joke_test_case_object.setUp()
+
+        self.access_token = retrieve_joke_test_case_object.access_token
+        self.user_id = retrieve_joke_test_case_object.user_id
+        self.ttl = joke_cache.entries.ttl
+        self.enabled = joke_cache.enabled
+
+    def get_joke(self):
+        return RetrieveJokeTestCase.get_joke_by_id(
+            joke_id=1, access_token=self.access_token)
+
+    def test_repeated_read_hits(self):
+        self.get_joke()
+        hits = joke_cache.stats()['hits']
+
+        response = self.get_joke()
+
+        self.assertEqual(response.data, app.config['FAKE_JOKE'].encode())
+        self.assertEqual(joke_cache.stats()['hits'], hits + 1)
+
+    def test_update_and_delete_invalidate(self):
+        self.get_joke()
+        UpdateJokeTestCase.send_patch(
+            joke_id=1, access_token=self.access_token,
+            content=app.config['YET_ANOTHER_FAKE_JOKE'])
+
+        self.assertEqual(self.get_joke().data,
+                         app.config['YET_ANOTHER_FAKE_JOKE'].encode())
+
+        DeleteJokeTestCase.delete_joke_by_joke_id(
+            joke_id=1, access_token=self.access_token)
+
+        self.assertEqual(self.get_joke().status_code, 404)
+
+    def test_entries_expire(self):
+        joke_cache.entries.ttl = 0.05
+        self.get_joke()
+        time.sleep(0.1)
+        expirations = joke_cache.stats()['expirations']
+
+        self.get_joke()
+
+        self.assertEqual(joke_cache.stats()['expirations'], expirations + 1)
+
+    def test_cache_switched_off(self):
+        joke_cache.enabled = False
+        self.get_joke()
+        hits = joke_cache.stats()['hits']
+
+        self.assertEqual(self.get_joke().status_code, 200)
+        self.assertEqual(joke_cache.stats()['hits'], hits)
+
+    def test_write_in_another_worker_is_a_miss(self):
+        self.get_joke()
+        # Another worker's write is not seen by this process' ORM
+        with app.app_context(), db.engine.begin() as connection:
+            connection.execute(
+                Joke.__table__.update().where(Joke.joke_id == 1).values(
+                    content=app.config['YET_ANOTHER_FAKE_JOKE']))
+            connection.execute(
+                User.__table__.update().where(User.id == self.user_id)
+                .values(jokes_version=User.jokes_version + 1))
+        stats = joke_cache.stats()
+
+        self.assertEqual(self.get_joke().data,
+                         app.config['YET_ANOTHER_FAKE_JOKE'].encode())
+        self.assertEqual(joke_cache.stats()['hits'], stats['hits'])
+        self.assertEqual(joke_cache.stats()['stale'], stats['stale'] + 1)
+
+    def tearDown(self):
+        joke_cache.entries.ttl = self.ttl
+        joke_cache.enabled = self.enabled
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class SqlitePragmasTestCase(unittest.TestCase):
+    """
+    Test the production SQLite profile
+    Test-case 1: every pooled connection gets the PRAGMAs
+    """
+
+    def test_production_pragmas_are_applied(self):
+        directory = tempfile.mkdtemp()
+        engine = create_engine(
+            'sqlite:///' + os.path.join(directory, 'pragmas.db'),
+            **ProductionConfig.SQLALCHEMY_ENGINE_OPTIONS)
+        apply_pragmas(engine, ProductionConfig.SQLITE_PRAGMAS)
+        try:
+            with engine.connect() as connection:
+                self.assertEqual(connection.execute(
+                    'PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(connection.execute(
+                    'PRAGMA synchronous').scalar(), 1)
+                self.assertEqual(connection.execute(
+                    'PRAGMA busy_timeout').scalar(), 5000)
+                self.assertEqual(connection.execute(
+                    'PRAGMA temp_store').scalar(), 2)
+        finally:
+            engine.dispose()
+            shutil.rmtree(directory)
+
+
+class MigrationsTestCase(unittest.TestCase):
+    """
+    Test the versioned migrations against the original schema
+    Test-case 1: the joke count is backfilled
+    Test-case 2: content hashes are backfilled
+    Test-case 3: the user indexes are created
+    Test-case 4: activity counts are backfilled from logged actions
+    Test-case 5: existing and new jokes are indexed for search
+    Test-case 6: existing jokes get MinHash signatures
+    Test-case 7: applied migrations are recorded and not run again
+    Test-case 8: a schema built by create_all() migrates cleanly
+    Test-case 9: the schema is current once every migration is applied
+    Test-case 10: revoked_token is rebuilt to never reuse ids
+    Test-case 11: workers upgrading a new database together take turns
+    Test-case 12: a model table without a migration is still created
+    """
+
+    def setUp(self):
+        # The tables as the first release created them
+        self.engine = create_engine('sqlite://')
+        self.engine.execute(
+            'CREATE TABLE user (id INTEGER PRIMARY KEY, '
+            'username VARCHAR(20) UNIQUE, password VARCHAR(100))')
+        self.engine.execute(
+            'CREATE TABLE joke (joke_id INTEGER PRIMARY KEY, '
+            'content TEXT, user_id INTEGER)')
+        self.engine.execute(
+            'CREATE TABLE action (action_id INTEGER PRIMARY KEY, '
+            'user_ip_address VARCHAR, action_time DATETIME, '
+            'action_path VARCHAR, user_id INTEGER)')
+
+    def index_names(self, table):
+        return {index['name']
+                for index in inspect(self.engine).get_indexes(table)}
+
+    def test_joke_count_is_backfilled(self):
+        self.engine.execute("INSERT INTO user VALUES (1, 'someone', 'hash')")
+        self.engine.execute(
+            "INSERT INTO joke VALUES (1, 'one', 1), (2, 'two', 1)")
+
+        upgrade_schema(self.engine)
+
+        self.assertEqual(self.engine.execute(
+            'SELECT joke_count FROM user WHERE id = 1').scalar(), 2)
+
+    def test_content_hash_is_backfilled(self):
+        self.engine.execute("INSERT INTO joke VALUES (1, 'One joke', 1), "
+                            "(2, 'one  JOKE', 1), (3, 'Two', 1)")
+
+        upgrade_schema(self.engine)
+
+        hashes = self.engine.execute(
+            'SELECT content_hash FROM joke ORDER BY joke_id').fetchall()
+        self.assertEqual(hashes, [(content_digest('One joke'),), (None,),
+                                  (content_digest('Two'),)])
+        self.assertIn('ix_joke_content_hash', self.index_names('joke'))
+
+    def test_user_indexes_are_created(self):
+        upgrade_schema(self.engine)
+
+        self.assertIn('ix_joke_user_id_joke_id', self.index_names('joke'))
+        self.assertTrue({'ix_action_user_id_action_time',
+                         'ix_action_action_time'} <=
+                        self.index_names('action'))
+
+    def test_action_counts_are_backfilled(self):
+        self.engine.execute(
+            "INSERT INTO action VALUES "
+            "(1, 'ip', '2020-05-30 10:01:00.000000', '/login', 1), "
+            "(2, 'ip', '2020-05-30 10:02:00.000000', '/login', 2)")
+
+        upgrade_schema(self.engine)
+
+        self.assertEqual(self.engine.execute(
+            "SELECT user_id, bucket, count FROM action_count "
+            "WHERE granularity = 'hour' ORDER BY user_id").fetchall(), [
+            (0, '2020-05-30 10:00:00.000000', 2),
+            (1, '2020-05-30 10:00:00.000000', 1),
+            (2, '2020-05-30 10:00:00.000000', 1),
+        ])
+
+    def test_existing_jokes_are_searchable(self):
+        self.engine.execute(
+            "INSERT INTO joke VALUES (1, 'A horse walks into a bar', 1)")
+
+        upgrade_schema(self.engine)
+        self.engine.execute(
+            "INSERT INTO joke (joke_id, content, user_id) "
+            "VALUES (2, 'Two horses', 1)")
+
+        self.assertEqual(self.engine.execute(
+            "SELECT rowid FROM joke_search WHERE joke_search MATCH 'horse' "
+            "ORDER BY rowid").fetchall(), [(1,), (2,)])
+
+    def test_jokes_are_signed(self):
+        self.engine.execute(
+            "INSERT INTO joke VALUES (1, 'A horse walks into a bar', 1)")
+
+        upgrade_schema(self.engine)
+
+        self.assertEqual(self.engine.execute(
+            'SELECT minhash FROM joke').scalar(),
+            signature('A horse walks into a bar'))
+        self.assertEqual(self.engine.execute(
+            'SELECT COUNT(*) FROM joke_band WHERE joke_id = 1').scalar(),
+            BANDS)
+
+    def test_migrations_are_recorded(self):
+        applied = upgrade_schema(self.engine)
+
+        self.assertEqual([item.version for item in applied],
+                         [item.version for item in MIGRATIONS])
+        self.assertEqual(applied_versions(self.engine),
+                         {item.version for item in MIGRATIONS})
+        self.assertEqual(upgrade_schema(self.engine), [])
+        self.assertEqual(pending_migrations(self.engine), [])
+
+    def test_latest_schema_migrates_cleanly(self):
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+
+        upgrade_schema(engine)
+
+        self.assertEqual(pending_migrations(engine), [])
+
+    def test_schema_is_current(self):
+        self.assertFalse(schema_is_current(self.engine))
+        upgrade_schema(self.engine)
+        self.assertTrue(schema_is_current(self.engine))
+
+        self.engine.execute('DELETE FROM schema_migration WHERE version = ?',
+                            MIGRATIONS[-1].version)
+
+        self.assertFalse(schema_is_current(self.engine))
+
+    def test_workers_upgrade_in_turns(self):
+        directory = tempfile.mkdtemp()
+        path = 'sqlite:///' + os.path.join(directory, 'new.db')
+        barrier = threading.Barrier(4)
+        errors = []
+
+        def start_worker():
+            engine = create_engine(path)
+            try:
+                barrier.wait()
+                upgrade_schema(engine, db.Model.metadata)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                engine.dispose()
+
+        workers = [threading.Thread(target=start_worker) for _ in range(4)]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            self.assertEqual(errors, [])
+            engine = create_engine(path)
+            self.assertEqual(sorted(row.version for row in engine.execute(
+                'SELECT version FROM schema_migration')),
+                [item.version for item in MIGRATIONS])
+            self.assertTrue(schema_is_current(engine, db.Model.metadata))
+            engine.dispose()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_table_without_migration_is_created(self):
+        upgrade_schema(self.engine, db.Model.metadata)
+        self.assertTrue(schema_is_current(self.engine, db.Model.metadata))
+        # As if JokeBand had been added without a migration
+        self.engine.execute('DROP TABLE joke_band')
+
+        self.assertTrue(schema_is_current(self.engine))
+        self.assertFalse(schema_is_current(self.engine, db.Model.metadata))
+        self.assertEqual(upgrade_schema(self.engine, db.Model.metadata), [])
+        self.assertIn('joke_band', inspect(self.engine).get_table_names())
+
+    def test_revoked_token_ids_are_not_reused(self):
+        # The table as migration 9 created it
+        self.engine.execute(
+            'CREATE TABLE revoked_token (id INTEGER PRIMARY KEY, '
+            'jti VARCHAR(36) NOT NULL UNIQUE, expires DATETIME NOT NULL)')
+        self.engine.execute('CREATE INDEX ix_revoked_token_expires '
+                            'ON revoked_token (expires)')
+        self.engine.execute(
+            "INSERT INTO revoked_token VALUES (1, 'one', '2020-01-01'), "
+            "(2, 'two', '2020-01-01')")
+
+        upgrade_schema(self.engine)
+        self.engine.execute('DELETE FROM revoked_token WHERE id = 2')
+        self.engine.execute("INSERT INTO revoked_token (jti, expires) "
+                            "VALUES ('three', '2020-01-01')")
+
+        self.assertEqual(self.engine.execute(
+            'SELECT id, jti FROM revoked_token ORDER BY id').fetchall(),
+            [(1, 'one'), (3, 'three')])
+        self.assertIn('ix_revoked_token_expires',
+                      self.index_names('revoked_token'))
+
+
+class ActionMaintenanceTestCase(unittest.TestCase):
+    """
+    Test the Action retention job
+    Test-case 1: old actions are rolled up, archived and deleted
+    Test-case 2: recent actions are kept
+    Test-case 3: a second run adds to the existing hourly counts
+    Test-case 4: old per-minute activity counts are pruned
+    """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        db.metadata.create_all(self.engine)
+        self.archive_dir = tempfile.mkdtemp()
+        self.now = datetime(2020, 6, 2, 12, 30)
+
+    def add_actions(self, *times, path='/my-jokes'):
+        self.engine.execute(Action.__table__.insert(), [dict(
+            user_ip_address='127.0.0.1', action_time=action_time,
+            action_path=path, user_id=1) for action_time in times])
+
+    def rollups(self):
+        return self.engine.execute(
+            'SELECT action_path, hour, count FROM action_rollup '
+            'ORDER BY hour, action_path').fetchall()
+
+    def maintain(self):
+        return maintain_actions(self.engine, cutoff=self.now - timedelta(
+            days=1), archive_dir=self.archive_dir, chunk_size=2)
+
+    def test_old_actions_are_moved_out(self):
+        self.add_actions(datetime(2020, 5, 30, 10, 1),
+                         datetime(2020, 5, 30, 10, 59),
+                         datetime(2020, 5, 31, 23, 0))
+        self.add_actions(datetime(2020, 5, 30, 10, 5), path='/login')
+
+        stats = self.maintain()
+
+        self.assertEqual(stats['actions'], 4)
+        self.assertEqual(stats['chunks'], 2)
+        self.assertEqual(self.engine.execute(
+            'SELECT COUNT(*) FROM action').scalar(), 0)
+        self.assertEqual(self.rollups(), [
+            ('/login', '2020-05-30 10:00:00.000000', 1),
+            ('/my-jokes', '2020-05-30 10:00:00.000000', 2),
+            ('/my-jokes', '2020-05-31 23:00:00.000000', 1),
+        ])
+
+        path = archive_path(self.archive_dir, date(2020, 5, 30))
+        with gzip.open(path, 'rt', encoding='utf-8') as archive:
+            archived = [json.loads(line) for line in archive]
+        self.assertEqual(sorted(row['action_id'] for row in archived),
+                         [1, 2, 4])
+
+    def test_recent_actions_are_kept(self):
+        self.add_actions(self.now - timedelta(hours=1))
+
+        self.assertEqual(self.maintain()['actions'], 0)
+        self.assertEqual(self.engine.execute(
+            'SELECT COUNT(*) FROM action').scalar(), 1)
+
+    def test_second_run_adds_to_counts(self):
+        self.add_actions(datetime(2020, 5, 30, 10, 1))
+        self.maintain()
+        self.add_actions(datetime(2020, 5, 30, 10, 2))
+        self.maintain()
+
+        self.assertEqual(self.rollups(), [
+            ('/my-jokes', '2020-05-30 10:00:00.000000', 2)])
+
+    def test_old_minute_counts_are_pruned(self):
+        with self.engine.begin() as connection:
+            count_actions(connection, [dict(
+                user_id=1, action_path='/login', action_time=action_time)
+                for action_time in (datetime(2020, 5, 1, 10, 1),
+                                    datetime(2020, 6, 2, 10, 1))])
+
+        deleted = prune_counts(self.engine, 'minute',
+                               cutoff=self.now - timedelta(days=1),
+                               chunk_size=1)
+
+        # Per user and for all users together
+        self.assertEqual(deleted, 2)
+        self.assertEqual(self.engine.execute(
+            "SELECT granularity, COUNT(*) FROM action_count "
+            "GROUP BY granularity ORDER BY granularity").fetchall(),
+            [('day', 4), ('hour', 4), ('minute', 2)])
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+
+class ActivityTestCase(unittest.TestCase):
+    """
+    Test the activity analytics endpoint
+    Test-case 1: logged actions are counted per path
+    Test-case 2: the counts of all users include the User's
+    Test-case 3: counts of one path only
+    Test-case 4: bad parameters are refused
+    """
+
+    def setUp(self):
+        self.access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        # User ids are reused, drop counts left by earlier test users
+        action_log.flush()
+        self.delete_counts()
+        for _ in range(3):
+            tester.get('/my-jokes', headers=dict(
+                Authorization='Bearer ' + self.access_token))
+        action_log.flush()
+
+    def get_activity(self, **params):
+        response = tester.get('/activity', query_string=params, headers=dict(
+            Authorization='Bearer ' + self.access_token))
+        if not response.is_json:
+            return response, None
+        return response, json.loads(response.data.decode('utf-8'))
+
+    @staticmethod
+    def count_of(document, path):
+        return sum(item['count'] for item in document['counts']
+                   if item['path'] == path)
+
+    def test_actions_are_counted(self):
+        for granularity in GRANULARITIES:
+            response, document = self.get_activity(granularity=granularity)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.count_of(document, '/my-jokes'), 3)
+
+    def test_all_users_include_the_user(self):
+        _, document = self.get_activity(scope='all', granularity='day')
+
+        self.assertGreaterEqual(self.count_of(document, '/my-jokes'), 3)
+
+    def test_one_path_only(self):
+        self.get_activity()
+        action_log.flush()
+
+        _, document = self.get_activity(path='/my-jokes')
+
+        self.assertEqual({item['path'] for item in document['counts']},
+                         {'/my-jokes'})
+        self.assertEqual(document['total'], 3)
+
+    def test_bad_parameters(self):
+        for params in (dict(granularity='week'), dict(scope='them'),
+                       dict(start='yesterday'),
+                       dict(start='2020-01-02', end='2020-01-01'),
+                       dict(granularity='minute', start='2000-01-01')):
+            response, _ = self.get_activity(**params)
+            self.assertEqual(response.status_code, 400)
+
+    @staticmethod
+    def delete_counts():
+        with app.app_context():
+            user_id = User.query.filter_by(
+                username=app.config['FAKE_USER']).first().id
+            ActionCount.query.filter(
+                ActionCount.user_id == user_id).delete()
+            db.session.commit()
+
+    def tearDown(self):
+        self.delete_counts()
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class SearchJokesTestCase(unittest.TestCase):
+    """
+    Test full-text search of jokes
+    Test-case 1: matching jokes are found, word forms included
+    Test-case 2: the index follows updates and deletes
+    Test-case 3: the User's jokes or the whole catalogue
+    Test-case 4: results come a page at a time
+    Test-case 5: FTS5 syntax in the input is matched as plain words
+    Test-case 6: bad parameters are refused
+    Test-case 7: the index can be rebuilt
+    """
+
+    jokes = [
+        'Zebracorns never pay for their drinks',
+        'A zebracorn walks into a bar',
+        'Why did the zebracorn cross the road',
+    ]
+
+    def setUp(self):
+        self.access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        for content in self.jokes:
+            BasicJokesResourceTestCase.create_joke(
+                content=content, access_token=self.access_token)
+
+    def search(self, **params):
+        response = tester.get(
+            '/search-jokes', query_string=params, headers=dict(
+                Authorization='Bearer ' + self.access_token))
+        if not response.is_json:
+            return response, None
+        return response, json.loads(response.data.decode('utf-8'))
+
+    @staticmethod
+    def contents(document):
+        return sorted(item['content'] for item in document['jokes'])
+
+    def test_matching_jokes_are_found(self):
+        response, document = self.search(q='zebracorn')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.contents(document), sorted(self.jokes))
+
+        _, document = self.search(q='walking BAR')
+        self.assertEqual(self.contents(document), [self.jokes[1]])
+
+    def test_index_follows_changes(self):
+        joke_id = self.search(q='road')[1]['jokes'][0]['joke_id']
+
+        tester.patch('/update-joke', data=dict(
+            joke_id=joke_id, content='The zebracorn crossed the river'),
+            headers=dict(Authorization='Bearer ' + self.access_token))
+        self.assertEqual(self.search(q='road')[1]['jokes'], [])
+        self.assertEqual(len(self.search(q='river')[1]['jokes']), 1)
+
+        tester.delete('/delete-joke', data=dict(joke_id=joke_id),
+                      headers=dict(Authorization='Bearer ' +
+                                   self.access_token))
+        self.assertEqual(self.search(q='river')[1]['jokes'], [])
+
+    def test_scope(self):
+        other_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['JOKE_FAKE_USER'],
+            password=app.config['JOKE_FAKE_USER_PASSWORD']
+        )
+        BasicJokesResourceTestCase.create_joke(
+            content='The zebracorn of another user', access_token=other_token)
+        try:
+            self.assertEqual(len(self.search(q='zebracorn')[1]['jokes']), 3)
+            self.assertEqual(len(self.search(
+                q='zebracorn', scope='all')[1]['jokes']), 4)
+        finally:
+            RegistrationResourceTestCase.delete_user(
+                username=app.config['JOKE_FAKE_USER']
+            )
+
+    def test_pages(self):
+        seen = []
+        offset = 0
+        while offset is not None:
+            _, document = self.search(q='zebracorn', limit=2, offset=offset)
+            seen.extend(item['content'] for item in document['jokes'])
+            offset = document['next_offset']
+
+        self.assertEqual(sorted(seen), sorted(self.jokes))
+
+    def test_syntax_is_plain_words(self):
+        self.assertEqual(match_expression('bar" OR *'), '"bar""" "OR" "*"')
+
+        response, document = self.search(q='zebracorn NEAR( "bar')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(document['jokes'], [])
+
+    def test_bad_parameters(self):
+        for params in (dict(), dict(q='  '), dict(q='bar', scope='them'),
+                       dict(q='bar', limit=0), dict(q='bar', offset=-1),
+                       dict(q='bar', limit='many')):
+            response, _ = self.search(**params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_rebuild(self):
+        with app.app_context():
+            db.engine.execute("INSERT INTO joke_search (joke_search) "
+                              "VALUES ('delete-all')")
+            self.assertEqual(self.search(q='zebracorn')[1]['jokes'], [])
+
+            indexed = rebuild_search_index(db.engine)
+
+            self.assertEqual(indexed, Joke.query.count())
+        self.assertEqual(len(self.search(q='zebracorn')[1]['jokes']), 3)
+
+    def tearDown(self):
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class RandomJokeTestCase(unittest.TestCase):
+    """
+    Test picking random jokes
+    Test-case 1: picks are uniform despite holes in the id space
+    Test-case 2: picks of one User are uniform among their jokes
+    Test-case 3: a sparse id space is sampled uniformly
+    Test-case 4: the endpoint answers with the User's joke
+    Test-case 5: nothing is picked when there are no jokes
+    Test-case 6: jokes added and deleted by another process are followed
+    Test-case 7: a catalogue over max_ids is sampled without the ids
+    """
+
+    draws = 3000
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        db.Model.metadata.create_all(self.engine, tables=[
+            User.__table__, Joke.__table__, JokeBand.__table__])
+        self.session = sessionmaker(bind=self.engine)()
+        self.session.add_all([
+            User(id=1, username='one', password='hash', joke_count=3),
+            User(id=2, username='two', password='hash', joke_count=3),
+        ])
+        # Holes left by deleted jokes
+        for joke_id, user_id in ((1, 1), (2, 2), (5, 2), (6, 1), (9, 2),
+                                 (10, 1)):
+            self.session.add(Joke(joke_id=joke_id, user_id=user_id,
+                                  content='Joke %d' % joke_id))
+        self.session.commit()
+
+    def pick_counts(self, **kwargs):
+        counts = {}
+        for _ in range(self.draws):
+            joke_id, _ = random_joke(self.session, **kwargs)
+            counts[joke_id] = counts.get(joke_id, 0) + 1
+        return counts
+
+    def assertUniform(self, counts, joke_ids):
+        self.assertEqual(set(counts), set(joke_ids))
+        expected = self.draws / len(joke_ids)
+        for count in counts.values():
+            self.assertLess(abs(count - expected), expected * 0.25)
+
+    def test_catalogue_picks_are_uniform(self):
+        self.assertUniform(self.pick_counts(), [1, 2, 5, 6, 9, 10])
+
+    def test_user_picks_are_uniform(self):
+        self.assertUniform(self.pick_counts(user_id=2), [2, 5, 9])
+
+    def test_sparse_id_space(self):
+        self.session.add(Joke(joke_id=10 ** 6, user_id=1,
+                              content='Joke %d' % 10 ** 6))
+        self.session.commit()
+
+        self.assertUniform(self.pick_counts(), [1, 2, 5, 6, 9, 10, 10 ** 6])
+
+    def test_endpoint(self):
+        access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        try:
+            headers = dict(Authorization='Bearer ' + access_token)
+            response = tester.get('/random-joke',
+                                  query_string=dict(scope='me'),
+                                  headers=headers)
+            self.assertEqual(response.status_code, 204)
+
+            BasicJokesResourceTestCase.create_joke(
+                content=app.config['FAKE_JOKE'], access_token=access_token)
+            response = tester.get('/random-joke',
+                                  query_string=dict(scope='me'),
+                                  headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                json.loads(response.data.decode('utf-8'))['content'],
+                app.config['FAKE_JOKE'])
+
+            response = tester.get('/random-joke', headers=headers)
+            self.assertEqual(response.status_code, 200)
+
+            response = tester.get('/random-joke',
+                                  query_string=dict(scope='them'),
+                                  headers=headers)
+            self.assertEqual(response.status_code, 400)
+        finally:
+            RegistrationResourceTestCase.delete_user(
+                username=app.config['FAKE_USER']
+            )
+
+    def test_no_jokes(self):
+        self.session.query(Joke).delete()
+        self.session.query(User).update(dict(joke_count=0))
+        self.session.commit()
+
+        self.assertIsNone(random_joke(self.session))
+        self.assertIsNone(random_joke(self.session, user_id=1))
+
+    def test_changes_of_another_process(self):
+        random_joke(self.session)
+        # Past the session, as another worker writes
+        with self.engine.begin() as connection:
+            connection.execute(Joke.__table__.delete().where(
+                Joke.joke_id.in_([1, 6, 10])))
+            connection.execute(Joke.__table__.insert(), [
+                dict(joke_id=joke_id, user_id=1, content='Joke %d' % joke_id)
+                for joke_id in (10, 11)])
+
+        self.assertUniform(self.pick_counts(attempts=1), [2, 5, 9, 10, 11])
+
+    def test_catalogue_over_max_ids(self):
+        self.assertUniform(self.pick_counts(max_ids=5), [1, 2, 5, 6, 9, 10])
+
+        ids = catalogue_ids(self.session)
+        self.assertTrue(ids.overflow)
+        self.assertEqual(len(ids.ids), 0)
+
+    def tearDown(self):
+        self.session.close()
+
+
+class NearDuplicateTestCase(unittest.TestCase):
+    """
+    Test near-duplicate joke detection
+    Test-case 1: reworded copies have similar signatures
+    Test-case 2: a reworded copy of a joke is refused
+    Test-case 3: a joke cannot be patched into a reworded copy
+    Test-case 4: bulk items that are reworded copies are duplicates
+    Test-case 5: the catalogue is searched for near-duplicates
+    """
+
+    reworded = 'A horse, and a pigeon walked into a bar!'
+
+    def setUp(self):
+        self.access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        self.headers = dict(Authorization='Bearer ' + self.access_token)
+
+    def test_signatures(self):
+        original = signature(app.config['FAKE_JOKE'])
+
+        self.assertEqual(similarity(original, signature(
+            'a HORSE and a pigeon -- walk into a bar')), 1.0)
+        self.assertGreaterEqual(similarity(original, signature(
+            self.reworded)), app.config['NEAR_DUPLICATE_THRESHOLD'])
+        self.assertLess(similarity(original, signature(
+            app.config['ANOTHER_FAKE_JOKE'])), 0.1)
+        self.assertIsNone(signature('?!...'))
+
+    def test_reworded_copy_is_refused(self):
+        BasicJokesResourceTestCase.create_joke(
+            content=app.config['FAKE_JOKE'], access_token=self.access_token)
+
+        response = BasicJokesResourceTestCase.create_joke(
+            content=self.reworded, access_token=self.access_token,
+            feedback=True)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data, b'This joke already exists')
+
+    def test_patch_into_reworded_copy(self):
+        for content in (app.config['FAKE_JOKE'],
+                        app.config['ANOTHER_FAKE_JOKE']):
+            BasicJokesResourceTestCase.create_joke(
+                content=content, access_token=self.access_token)
+        with app.app_context():
+            joke_id = Joke.query.filter_by(
+                content=app.config['ANOTHER_FAKE_JOKE']).first().joke_id
+
+        response = tester.patch('/update-joke', data=dict(
+            joke_id=joke_id, content=self.reworded), headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
+        # Rewording a joke is not a copy of itself
+        response = tester.patch('/update-joke', data=dict(
+            joke_id=joke_id,
+            content=app.config['ANOTHER_FAKE_JOKE'].upper()),
+            headers=self.headers)
+        self.assertEqual(response.status_code, 204)
+
+    def test_bulk_items(self):
+        BasicJokesResourceTestCase.create_joke(
+            content=app.config['FAKE_JOKE'], access_token=self.access_token)
+
+        response = tester.put('/create-jokes', json=[
+            self.reworded,
+            app.config['YET_ANOTHER_FAKE_JOKE'],
+            app.config['YET_ANOTHER_FAKE_JOKE'] + ' Really.',
+        ], headers=self.headers)
+
+        self.assertEqual(BulkCreateJokesTestCase.statuses(response), [
+            'duplicate', 'created', 'duplicate'])
+        with app.app_context():
+            joke_id = Joke.query.filter_by(
+                content=app.config['YET_ANOTHER_FAKE_JOKE']).first().joke_id
+            # The created joke is indexed like any other
+            self.assertEqual(JokeBand.query.filter_by(
+                joke_id=joke_id).count(), BANDS)
+
+    def test_catalogue(self):
+        engine = create_engine('sqlite://')
+        db.Model.metadata.create_all(engine, tables=[
+            User.__table__, Joke.__table__, JokeBand.__table__])
+        session = sessionmaker(bind=engine)()
+        for content in (app.config['FAKE_JOKE'],
+                        app.config['ANOTHER_FAKE_JOKE'],
+                        self.reworded):
+            session.add(Joke(content=content, user_id=1))
+        session.commit()
+
+        found = list(near_duplicates_in_catalogue(
+            session, app.config['NEAR_DUPLICATE_THRESHOLD'], batch_size=2))
+
+        self.assertEqual([(joke_id, original_id)
+                          for joke_id, original_id, _ in found], [(3, 1)])
+
+        session.delete(session.query(Joke).get(1))
+        session.commit()
+        self.assertEqual(session.query(JokeBand).count(), 2 * BANDS)
+        session.close()
+
+    def tearDown(self):
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class TokenRevocationTestCase(unittest.TestCase):
+    """
+    Test revoking tokens
+    Test-case 1: the Bloom filter has no false negatives
+    and few false positives
+    Test-case 2: a token is refused after logout, others are not
+    Test-case 3: tokens missing from the filter are not looked up
+    Test-case 4: other workers pick up the revocation
+    Test-case 5: the filter is rebuilt without expired revocations
+    Test-case 6: ids of pruned revocations are not reused
+    """
+
+    def setUp(self):
+        self.access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+
+    def get(self, access_token):
+        return tester.get('/my-jokes', headers=dict(
+            Authorization='Bearer ' + access_token))
+
+    def logout(self, access_token):
+        return tester.post('/logout', headers=dict(
+            Authorization='Bearer ' + access_token))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for number in range(1000):
+            bloom.add('in-%d' % number)
+
+        self.assertTrue(all('in-%d' % number in bloom
+                            for number in range(1000)))
+        false_positives = sum('out-%d' % number in bloom
+                              for number in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_logout(self):
+        other_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+
+        self.assertEqual(self.logout(self.access_token).status_code, 200)
+
+        self.assertEqual(self.get(self.access_token).status_code, 401)
+        self.assertEqual(self.logout(self.access_token).status_code, 401)
+        self.assertNotEqual(self.get(other_token).status_code, 401)
+
+    def test_valid_tokens_are_not_looked_up(self):
+        lookups = token_denylist.lookups
+
+        for _ in range(5):
+            self.get(self.access_token)
+
+        self.assertEqual(token_denylist.lookups, lookups)
+
+    def test_other_workers(self):
+        worker = TokenDenylist(app)
+        with app.app_context():
+            worker.load()
+            self.logout(self.access_token)
+            jti = RevokedToken.query.order_by(
+                RevokedToken.id.desc()).first().jti
+
+            worker.sync_interval = 3600
+            self.assertFalse(worker.is_revoked(jti))
+            worker.sync_interval = 0
+            self.assertTrue(worker.is_revoked(jti))
+
+    def test_rebuild(self):
+        with app.app_context():
+            db.session.add(RevokedToken(
+                jti='expired', expires=datetime.utcnow() - timedelta(1)))
+            db.session.commit()
+            self.logout(self.access_token)
+            worker = TokenDenylist(app)
+
+            loaded = worker.load()
+
+            self.assertEqual(loaded, RevokedToken.query.filter(
+                RevokedToken.expires > datetime.utcnow()).count())
+            self.assertNotIn('expired', worker.filter)
+            self.assertGreaterEqual(token_denylist.prune(), 1)
+            self.assertIsNone(
+                RevokedToken.query.filter_by(jti='expired').first())
+
+    def test_pruned_ids_are_not_reused(self):
+        with app.app_context():
+            token_denylist.prune()
+            db.session.add_all([RevokedToken(
+                jti='expired-%d' % number,
+                expires=datetime.utcnow() - timedelta(1))
+                for number in range(2)])
+            db.session.commit()
+            worker = TokenDenylist(app)
+            worker.load()
+            token_denylist.prune()
+
+            self.logout(self.access_token)
+
+            jti = RevokedToken.query.order_by(
+                RevokedToken.id.desc()).first().jti
+            worker.sync_interval = 0
+            self.assertTrue(worker.is_revoked(jti))
+
+    def tearDown(self):
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+def take_tokens(path, attempts, results):
+    """Rate limit checks of one forked worker"""
+    limiter = RateLimiter()
+    limiter.path = path
+    results.put(sum(limiter.take('shared', 20, 3600) == 0.0
+                    for _ in range(attempts)))
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """
+    Test the token-bucket rate limits
+    Test-case 1: a bucket refills at its rate
+    Test-case 2: worker processes share the buckets
+    Test-case 3: requests over the IP limit get 429 and Retry-After
+    Test-case 4: the per-user limit does not touch other users
+    Test-case 5: a request denied by one bucket takes from none
+    Test-case 6: SQLite before 3.35 takes tokens without RETURNING
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.limits = app.config['RATE_LIMITS']
+        app.config['RATE_LIMIT_ENABLED'] = True
+        app.config['RATE_LIMIT_STORE'] = os.path.join(
+            self.directory, 'buckets.db')
+        app.config['RATE_LIMITS'] = {
+            '/login': {'ip': (3, 60)},
+            '/create-jokes': {'user': (2, 60)},
+        }
+        rate_limiter.init_app(app)
+
+    def test_refill(self):
+        self.assertEqual(rate_limiter.take('key', 2, 0.2), 0.0)
+        self.assertEqual(rate_limiter.take('key', 2, 0.2), 0.0)
+
+        retry_after = rate_limiter.take('key', 2, 0.2)
+        self.assertGreater(retry_after, 0.0)
+        self.assertLessEqual(retry_after, 0.1)
+
+        time.sleep(retry_after)
+        self.assertEqual(rate_limiter.take('key', 2, 0.2), 0.0)
+
+    def test_workers_share_buckets(self):
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        workers = [context.Process(target=take_tokens, args=(
+            app.config['RATE_LIMIT_STORE'], 10, results)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        taken = sum(results.get(timeout=30) for _ in workers)
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(taken, 20)
+
+    def test_ip_limit(self):
+        statuses = [tester.post('/login', data=dict(
+            username='nobody', password='nothing')).status_code
+            for _ in range(4)]
+
+        self.assertEqual(statuses, [401, 401, 401, 429])
+        response = tester.post('/login', data=dict(
+            username='nobody', password='nothing'))
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+
+    def test_user_limit(self):
+        app.config['RATE_LIMITS']['/login'] = {}
+        tokens = [LoginTestCase.quick_setup_fake_user(
+            username=username, password=password)
+            for username, password in (
+                (app.config['FAKE_USER'], app.config['FAKE_USER_PASSWORD']),
+                (app.config['JOKE_FAKE_USER'],
+                 app.config['JOKE_FAKE_USER_PASSWORD']))]
+        try:
+            statuses = [tester.put('/create-jokes', json=[], headers=dict(
+                Authorization='Bearer ' + tokens[0])).status_code
+                for _ in range(3)]
+            self.assertEqual(statuses, [400, 400, 429])
+
+            response = tester.put('/create-jokes', json=[], headers=dict(
+                Authorization='Bearer ' + tokens[1]))
+            self.assertEqual(response.status_code, 400)
+        finally:
+            for username in (app.config['FAKE_USER'],
+                             app.config['JOKE_FAKE_USER']):
+                RegistrationResourceTestCase.delete_user(username=username)
+
+    def test_denied_request_takes_from_no_bucket(self):
+        for returning in (True, False):
+            rate_limiter.returning = returning
+            rate_limiter.reset()
+            self.assertEqual(rate_limiter.take('user', 1, 60), 0.0)
+
+            buckets = [('ip', 2, 60), ('user', 1, 60)]
+            self.assertGreater(rate_limiter.take_all(buckets), 0.0)
+            self.assertGreater(rate_limiter.take_all(buckets), 0.0)
+
+            # Both denials left the ip bucket full
+            self.assertEqual(rate_limiter.take('ip', 2, 60), 0.0)
+            self.assertEqual(rate_limiter.take('ip', 2, 60), 0.0)
+            self.assertGreater(rate_limiter.take('ip', 2, 60), 0.0)
+
+    def test_without_returning(self):
+        rate_limiter.returning = False
+        self.test_refill()
+        self.test_ip_limit()
+
+    def tearDown(self):
+        app.config['RATE_LIMIT_ENABLED'] = False
+        app.config['RATE_LIMITS'] = self.limits
+        rate_limiter.init_app(app)
+        shutil.rmtree(self.directory)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """
+    Test the request metrics
+    Test-case 1: requests are counted and timed per route and status
+    Test-case 2: phases of a request are timed
+    Test-case 3: histograms are cumulative
+    Test-case 4: the values of other workers are summed
+    Test-case 5: every worker writes its own file
+    Test-case 6: stale files are skipped and removed on start
+    """
+
+    def setUp(self):
+        metrics.init_app(app)
+
+    @staticmethod
+    def scrape():
+        response = tester.get('/metrics')
+        return response, response.data.decode('utf-8')
+
+    @staticmethod
+    def value(text, line_start):
+        for line in text.splitlines():
+            if line.startswith(line_start + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return None
+
+    def test_requests_are_counted(self):
+        for _ in range(2):
+            tester.get('/')
+        tester.get('/no-such-page')
+
+        response, text = self.scrape()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertEqual(self.value(text, 'http_requests_total'
+                                    '{route="/",method="GET",status="204"}'),
+                         2.0)
+        self.assertEqual(self.value(
+            text, 'http_requests_total'
+                  '{route="unmatched",method="GET",status="404"}'), 1.0)
+        self.assertEqual(self.value(
+            text, 'http_request_duration_seconds_count{route="/"}'), 2.0)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+
+    def test_phases_are_timed(self):
+        access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        try:
+            tester.get('/my-jokes', headers=dict(
+                Authorization='Bearer ' + access_token))
+        finally:
+            RegistrationResourceTestCase.delete_user(
+                username=app.config['FAKE_USER']
+            )
+
+        _, text = self.scrape()
+
+        for route, phase in (('/login', 'hashing'), ('/login', 'auth'),
+                             ('/login', 'db'), ('/login', 'serialization'),
+                             ('/my-jokes', 'auth'),
+                             ('/my-jokes', 'action_log')):
+            self.assertGreaterEqual(self.value(
+                text, 'http_request_phase_seconds_count'
+                      '{route="%s",phase="%s"}' % (route, phase)), 1.0)
+        self.assertGreater(self.value(
+            text, 'db_queries_total{route="/login"}'), 0.0)
+
+    def test_cumulative_histograms(self):
+        worker = Metrics()
+        worker.buckets = (0.1, 1.0)
+        for value in (0.05, 0.5, 5.0):
+            worker.observe('http_request_duration_seconds',
+                           (('route', '/'),), value)
+
+        text = worker.render()
+
+        for bound, count in (('0.1', 1), ('1.0', 2), ('+Inf', 3)):
+            self.assertEqual(self.value(
+                text, 'http_request_duration_seconds_bucket'
+                      '{route="/",le="%s"}' % bound), count)
+        self.assertEqual(self.value(
+            text, 'http_request_duration_seconds_sum{route="/"}'), 5.55)
+
+    def test_workers_are_summed(self):
+        directory = tempfile.mkdtemp()
+        try:
+            workers = [Metrics(), Metrics()]
+            for worker in workers:
+                worker.directory = directory
+                worker.buckets = (1.0,)
+                worker.inc('http_requests_total', (('route', '/'),))
+                worker.observe('http_request_duration_seconds',
+                               (('route', '/'),), 0.5)
+            # The other worker's file, as its own process wrote it
+            with open(os.path.join(directory, 'metrics-0.json'), 'w') as f:
+                json.dump(workers[1].snapshot(), f)
+
+            text = workers[0].render()
+
+            self.assertEqual(self.value(
+                text, 'http_requests_total{route="/"}'), 2.0)
+            self.assertEqual(self.value(
+                text, 'http_request_duration_seconds_bucket'
+                      '{route="/",le="1.0"}'), 2.0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_every_worker_has_its_own_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # Same pid, as a worker given the pid of an exited one
+            workers = [Metrics(), Metrics()]
+            for worker in workers:
+                worker.directory = directory
+                worker.inc('http_requests_total', (('route', '/'),))
+                worker.dump()
+
+            self.assertEqual(len(os.listdir(directory)), 2)
+            self.assertEqual(self.value(
+                workers[0].render(), 'http_requests_total{route="/"}'), 2.0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stale_files_are_dropped(self):
+        directory = tempfile.mkdtemp()
+        try:
+            worker, exited = Metrics(), Metrics()
+            for each in (worker, exited):
+                each.directory = directory
+                each.inc('http_requests_total', (('route', '/'),))
+            exited.dump()
+            old = time.time() - worker.stale_after - 1
+            os.utime(exited.path(), (old, old))
+
+            self.assertEqual(self.value(
+                worker.render(), 'http_requests_total{route="/"}'), 1.0)
+            self.assertEqual(worker.expire(), 1)
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+class QueryProfilerTestCase(unittest.TestCase):
+    """
+    Test the per-request query profiler
+    Test-case 1: a request over its budget fails in strict mode
+    Test-case 2: and is only logged otherwise
+    Test-case 3: slow and repeated statements are logged
+    Test-case 4: bulk creation runs the same queries for any batch size
+    """
+
+    def setUp(self):
+        self.access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+        self.budgets = dict(app.config['QUERY_BUDGETS'])
+
+    def get_my_jokes(self):
+        return tester.get('/my-jokes', headers=dict(
+            Authorization='Bearer ' + self.access_token))
+
+    def test_strict_budget(self):
+        app.config['QUERY_BUDGETS']['/my-jokes'] = 0
+        query_profiler.init_app(app)
+
+        with self.assertRaises(QueryBudgetExceeded):
+            self.get_my_jokes()
+
+    def test_logged_budget(self):
+        app.config['QUERY_BUDGETS']['/my-jokes'] = 0
+        app.config['QUERY_BUDGET_STRICT'] = False
+        query_profiler.init_app(app)
+
+        with self.assertLogs('project.query_profiler', 'WARNING') as logs:
+            response = self.get_my_jokes()
+
+        self.assertEqual(response.status_code, 204)
+        self.assertIn('/my-jokes ran', logs.output[0])
+
+    def test_slow_and_repeated_statements(self):
+        with self.assertLogs('project.query_profiler', 'WARNING') as logs:
+            query_profiler.check('/somewhere', [('SELECT 1', 0.0)] * 5 + [
+                ('SELECT 2', app.config['SLOW_QUERY_THRESHOLD'])])
+
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('slow query', logs.output[0])
+        self.assertIn('ran 5 times', logs.output[1])
+
+    def test_bulk_create_queries(self):
+        response = tester.put('/create-jokes', json=[
+            'Bulk joke %s' % content_digest(str(number))
+            for number in range(20)
+        ], headers=dict(Authorization='Bearer ' + self.access_token))
+
+        # The strict budget of /create-jokes would have failed it
+        self.assertEqual(response.status_code, 201)
+
+    def tearDown(self):
+        app.config['QUERY_BUDGETS'] = self.budgets
+        app.config['QUERY_BUDGET_STRICT'] = True
+        query_profiler.init_app(app)
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class StubJokeServer:
+    """
+    Local HTTP/1.1 server standing in for a FOREIGN_API source.
+    Answers are taken from 'answers' as (status, body, delay)
+    tuples, a unique joke is served once they run out
+    """
+
+    @staticmethod
+    def joke(number: int) -> str:
+        # Unlike enough to pass the near-duplicate check
+        return 'Stub joke %s' % content_digest(str(number))
+
+    def __init__(self):
+        self.answers = []
+        self.client_ports = []
+        self.served = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.client_ports.append(self.client_address[1])
+                stub.served += 1
+                if stub.answers:
+                    status, body, delay = stub.answers.pop(0)
+                else:
+                    status, body, delay = 200, json.dumps(dict(
+                        joke=StubJokeServer.joke(stub.served))), 0
+                time.sleep(delay)
+                payload = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/api' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def register(self, source, **settings):
+        """
+        Add the stub as a source of the app
+        :param source: FOREIGN_API key
+        :param settings: overrides of FOREIGN_API_DEFAULTS
+        :return: None
+        """
+        app.config['FOREIGN_API'][source] = dict(url=self.url, **settings)
+        foreign_apis.init_app(app)
+        prefetcher.init_app(app)
+
+    @staticmethod
+    def unregister(source):
+        app.config['FOREIGN_API'].pop(source, None)
+        foreign_apis.init_app(app)
+        prefetcher.init_app(app)
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ForeignApiClientTestCase(unittest.TestCase):
+    """
+    Test importing jokes through the pooled client, against a stub
+    Test-case 1: import a joke from the stub
+    Test-case 2: a 5xx answer is retried
+    Test-case 3: a source slower than the read timeout yields 502
+    Test-case 4: consecutive imports reuse one connection
+    """
+
+    def setUp(self):
+        self.stub = StubJokeServer()
+        self.stub.register('stub-jokes', backoff=0.01, read_timeout=0.5,
+                           buffer_size=0)
+        self.access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+
+    def import_joke(self):
+        return tester.put('/import-joke', data=dict(source='stub-jokes'),
+                          headers=dict(
+            Authorization='Bearer ' + self.access_token)
+        )
+
+    def test_import_from_stub(self):
+        response = self.import_joke()
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(BasicJokesResourceTestCase.get_joke_object(
+            user_id=RegistrationResourceTestCase.get_user_id(
+                app.config['FAKE_USER']),
+            content=StubJokeServer.joke(1)))
+
+    def test_server_error_is_retried(self):
+        self.stub.answers.append((500, '{}', 0))
+
+        response = self.import_joke()
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.stub.served, 2)
+
+    def test_slow_source_times_out(self):
+        self.stub.register('stub-jokes', retries=0, read_timeout=0.1,
+                           buffer_size=0)
+        self.stub.answers.append((200, '{"joke": "late"}', 0.5))
+
+        response = self.import_joke()
+
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(response.data, b'The source is not available')
+
+    def test_connection_is_reused(self):
+        self.import_joke()
+        self.import_joke()
+
+        self.assertEqual(self.stub.served, 2)
+        self.assertEqual(len(set(self.stub.client_ports)), 1)
+
+    def tearDown(self):
+        StubJokeServer.unregister('stub-jokes')
+        self.stub.shutdown()
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class PrefetchBufferTestCase(unittest.TestCase):
+    """
+    Test the buffers of prefetched foreign jokes
+    Test-case 1: an empty buffer falls back to a live fetch and refills
+    Test-case 2: a filled buffer serves imports without the source
+    Test-case 3: a failing source is retried with a growing backoff
+    Test-case 4: a buffer nobody imports from is not refilled
+    Test-case 5: the buffers are on /metrics
+    """
+
+    def setUp(self):
+        self.stub = StubJokeServer()
+        self.stub.register('stub-jokes', buffer_size=3, low_water=1)
+        self.access_token = LoginTestCase.quick_setup_fake_user(
+            username=app.config['FAKE_USER'],
+            password=app.config['FAKE_USER_PASSWORD']
+        )
+
+    def import_joke(self):
+        return tester.put('/import-joke', data=dict(source='stub-jokes'),
+                          headers=dict(
+            Authorization='Bearer ' + self.access_token)
+        )
+
+    @staticmethod
+    def wait_for_buffer(size, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if len(prefetcher.buffers['stub-jokes'].jokes) >= size:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_empty_buffer_falls_back_and_refills(self):
+        response = self.import_joke()
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(self.wait_for_buffer(3))
+        stats = prefetcher.stats()['stub-jokes']
+        self.assertEqual(stats['fallbacks'], 1)
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['refills'], 3)
+
+    def test_filled_buffer_serves_imports(self):
+        self.import_joke()
+        self.assertTrue(self.wait_for_buffer(3))
+        served = self.stub.served
+
+        # Above the low-water mark the source is not asked at all
+        self.assertEqual(self.import_joke().status_code, 201)
+        self.assertEqual(self.stub.served, served)
+
+        # The joke came out of the buffer, in the order it was fetched
+        user_id = RegistrationResourceTestCase.get_user_id(
+            app.config['FAKE_USER'])
+        self.assertTrue(BasicJokesResourceTestCase.get_joke_object(
+            user_id=user_id, content=StubJokeServer.joke(2)))
+
+        stats = prefetcher.stats()['stub-jokes']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['hit_rate'], 1 / 2)
+
+    class DownSource:
+        settings = dict(down=dict(buffer_size=2, low_water=0))
+
+        @staticmethod
+        def fetch_joke(source):
+            raise ConnectionError('%s is down' % source)
+
+    def make_prefetcher(self, **config):
+        down = JokePrefetcher(self.DownSource())
+        down.init_app(type('App', (), dict(config=dict(dict(
+            PREFETCH_ERROR_BACKOFF=1.0, PREFETCH_ERROR_BACKOFF_MAX=4.0,
+            PREFETCH_IDLE_TIMEOUT=60.0), **config)))())
+        down.buffers['down'].active = True
+        down.buffers['down'].last_demand = time.monotonic()
+        return down
+
+    def test_failing_source_backs_off(self):
+        down = self.make_prefetcher()
+        buffer = down.buffers['down']
+        backoffs = []
+        for _ in range(5):
+            self.assertTrue(buffer.refill_due)
+            started = time.monotonic()
+            self.assertFalse(down._refill('down', buffer))
+            backoffs.append(round(buffer.retry_at - started))
+            self.assertFalse(buffer.refill_due)
+            buffer.retry_at = 0.0
+
+        self.assertEqual(backoffs, [1, 2, 4, 4, 4])
+        self.assertEqual(buffer.stats()['refill_errors'], 5)
+
+    def test_idle_buffer_is_not_refilled(self):
+        down = self.make_prefetcher(PREFETCH_IDLE_TIMEOUT=0.05)
+        self.assertTrue(down.buffers['down'].needs_refill)
+
+        time.sleep(0.1)
+
+        self.assertFalse(down.buffers['down'].needs_refill)
+        self.assertIsNone(down._next_retry_in())
+
+    def test_buffers_on_metrics(self):
+        self.import_joke()
+        self.assertTrue(self.wait_for_buffer(3))
+
+        text = tester.get('/metrics').data.decode('utf-8')
+
+        self.assertIn('prefetch_buffered_jokes{source="stub-jokes"} 3.0',
+                      text)
+        self.assertIn('prefetch_imports_total'
+                      '{source="stub-jokes",outcome="fallback"} 1.0', text)
+        self.assertIn('# TYPE prefetch_buffered_jokes gauge', text)
+
+    def tearDown(self):
+        StubJokeServer.unregister('stub-jokes')
+        self.stub.shutdown()
+        RegistrationResourceTestCase.delete_user(
+            username=app.config['FAKE_USER']
+        )
+
+
+class SyntheticDataTestCase(unittest.TestCase):
+    """
+    Test the synthetic data generator
+    Test-case 1: the total is split by weight, under the cap
+    Test-case 2: counts of Jokes and Actions match the rows
+    Test-case 3: the same seed makes the same data
+    Test-case 4: a second load goes after the rows already there
+    Test-case 5: counts aggregated by SQL match counts per batch
+    Test-case 6: and SQLite before 3.24 counts the same without UPSERT
+    Test-case 7: jokes or actions without users are rejected up front
+    """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        db.Model.metadata.create_all(self.engine, tables=[
+            User.__table__, Joke.__table__, JokeBand.__table__,
+            Action.__table__, ActionCount.__table__])
+
+    def load(self, **kwargs):
+        options = dict(users=20, jokes=300, actions=1000, password='hash',
+                       joke_limit=40, statement_rows=7,
+                       transaction_rows=100, seed=3)
+        options.update(kwargs)
+        return generate(self.engine, **options)
+
+    def scalar(self, statement):
+        with self.engine.connect() as connection:
+            return connection.execute(statement).scalar()
+
+    def test_allocation(self):
+        self.assertEqual(allocate(10, [1, 1, 1, 1, 1]), [2] * 5)
+        counts = allocate(100, [10, 1, 1, 1], cap=40)
+        self.assertEqual(sum(counts), 100)
+        self.assertEqual(max(counts), 40)
+        self.assertEqual(allocate(100, [1, 1], cap=30), [30, 30])
+
+    def test_counts_match_rows(self):
+        stats = self.load()
+
+        self.assertEqual((stats['users'], stats['jokes'], stats['actions']),
+                         (20, 300, 1000))
+        self.assertEqual(self.scalar('SELECT count(*) FROM joke'), 300)
+        self.assertEqual(self.scalar('SELECT max(joke_count) FROM user'), 40)
+        # joke_count of every User is the number of its Jokes
+        self.assertEqual(self.scalar(
+            'SELECT count(*) FROM user WHERE joke_count != (SELECT '
+            'count(*) FROM joke WHERE joke.user_id = user.id)'), 0)
+        for granularity in GRANULARITIES:
+            self.assertEqual(self.scalar(
+                "SELECT sum(count) FROM action_count WHERE user_id = 0 "
+                "AND granularity = '%s'" % granularity), 1000)
+
+    def test_same_seed_same_data(self):
+        self.load()
+        first = self.scalar('SELECT group_concat(content_hash) FROM joke')
+        self.setUp()
+        self.load()
+
+        self.assertEqual(
+            self.scalar('SELECT group_concat(content_hash) FROM joke'), first)
+
+    def test_loads_are_appended(self):
+        self.load()
+        self.load(seed=4, minhash=True)
+
+        self.assertEqual(self.scalar('SELECT count(*) FROM user'), 40)
+        self.assertEqual(self.scalar('SELECT count(*) FROM joke'), 600)
+        self.assertEqual(self.scalar(
+            'SELECT count(DISTINCT joke_id) FROM joke_band'), 300)
+        self.assertEqual(self.scalar(
+            "SELECT sum(count) FROM action_count WHERE user_id = 0 "
+            "AND granularity = 'day'"), 2000)
+
+    def test_sql_counts_match_batch_counts(self):
+        moment = datetime(2020, 5, 17, 13, 45, 30, 250)
+        actions = [dict(user_ip_address='127.0.0.1', user_id=user_id,
+                        action_path=path, action_time=moment + delta)
+                   for user_id, path, delta in (
+                       (1, '/my-jokes', timedelta()),
+                       (1, '/my-jokes', timedelta(seconds=20)),
+                       (2, '/login', timedelta(minutes=20)),
+                       (1, '/my-jokes', timedelta(hours=11)))]
+        with self.engine.begin() as connection:
+            connection.execute(Action.__table__.insert(), actions)
+            count_logged_actions(connection)
+            by_sql = connection.execute(
+                ActionCount.__table__.select()).fetchall()
+            connection.execute(ActionCount.__table__.delete())
+            count_actions(connection, actions)
+            by_batch = connection.execute(
+                ActionCount.__table__.select()).fetchall()
+
+        self.assertEqual(sorted(by_sql), sorted(by_batch))
+
+    def test_counts_without_upsert(self):
+        self.test_sql_counts_match_batch_counts()
+        with self.engine.begin() as connection:
+            by_upsert = connection.execute(
+                ActionCount.__table__.select()).fetchall()
+            connection.execute(ActionCount.__table__.delete())
+
+        analytics.UPSERT = False
+        try:
+            with self.engine.begin() as connection:
+                # Counted twice, the second time onto existing counts
+                count_logged_actions(connection, 1, 2)
+                count_logged_actions(connection, 3)
+                doubled = connection.execute(
+                    ActionCount.__table__.select()).fetchall()
+                connection.execute(ActionCount.__table__.delete())
+                actions = [dict(row) for row in connection.execute(
+                    Action.__table__.select())]
+                count_actions(connection, actions)
+                by_batch = connection.execute(
+                    ActionCount.__table__.select()).fetchall()
+        finally:
+            analytics.UPSERT = True
+
+        self.assertEqual(sorted(doubled), sorted(by_upsert))
+        self.assertEqual(sorted(by_batch), sorted(by_upsert))
+
+    def test_rejects_rows_without_users(self):
+        for options in (dict(users=0, jokes=0), dict(users=0, actions=0),
+                        dict(jokes=-1), dict(paths={'/login': 0})):
+            with self.assertRaises(ValueError):
+                self.load(**options)
+
+        self.assertEqual(self.scalar('SELECT count(*) FROM user'), 0)
+        self.assertEqual(self.load(users=0, jokes=0, actions=0)['users'], 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,88 @@
+"""Process-wide username -> credentials cache used by /login"""
+from collections import namedtuple
+
+from sqlalchemy.orm.attributes import get_history
+
+from .lru import LRUCache
+from .lru import invalidate_on_change
+from .models import User
+from .models import db
+
+Credentials = namedtuple('Credentials', ['id', 'password'])
+
+
+class UserCache:
+    """
+    Bounded LRU map of username to Credentials(id, password hash).
+    Entries are dropped whenever a User row is inserted, updated
+    or deleted through the ORM of this process. Other workers
+    only see the change once the entry is USER_CACHE_TTL
+    seconds old; checking a version per login would cost the
+    same query the cache saves
+    """
+
+    def __init__(self, app=None):
+        self.entries = LRUCache()
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Read the cache settings from the app config
+        :param app: Flask application
+        :return: None
+        """
+        self.entries.maxsize = app.config['USER_CACHE_SIZE']
+        self.entries.ttl = app.config['USER_CACHE_TTL']
+        self.entries.clear()
+        if not self._listening:
+            invalidate_on_change(User, self._usernames_of,
+                                 self.invalidate, 'stale_usernames')
+            self._listening = True
+
+    @property
+    def hits(self) -> int:
+        return self.entries.hits
+
+    @property
+    def misses(self) -> int:
+        return self.entries.misses
+
+    def get(self, username: str):
+        """
+        Read-through lookup of the User's credentials
+        :param username: user's name
+        :return: Credentials or None if there is no such user
+        """
+        credentials = self.entries.get(username)
+        if credentials is not None:
+            return credentials
+
+        row = db.session.query(User.id, User.password).filter_by(
+            username=username).first()
+        if row is None:
+            return None
+
+        credentials = Credentials(*row)
+        self.entries.put(username, credentials)
+        return credentials
+
+    def put(self, username: str, credentials: Credentials):
+        self.entries.put(username, credentials)
+
+    def invalidate(self, *usernames):
+        self.entries.invalidate(*usernames)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _usernames_of(user) -> set:
+        # Both the old and the new name of a renamed User
+        usernames = set(get_history(user, 'username').sum())
+        usernames.discard(None)
+        return usernames
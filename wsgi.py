@@ -1,4 +1,7 @@
 from project import create_app
 
 app = create_app()
-app.run()
+
+# Pool processes import this module again, they must not serve
+if __name__ == '__main__':
+    app.run()